@@ -1,7 +1,198 @@
-from js import Response, fetch, Object, Headers
+from js import Response, Object, Headers, TextEncoder, TransformStream, caches
+from pyodide.ffi import create_proxy, to_js
+import asyncio
+import codecs
 import json
 from datetime import datetime
+import gzip
 import hashlib
+import random
+import re
+import time
+from urllib.parse import parse_qs, quote, urlencode, urlsplit
+
+import gazetteer
+import geohash
+import telemetry as log
+from cache import SingleFlight, TieredCache
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen
+from deadline import Deadline, DeadlineExceeded, run_with_timeout
+from metrics import MetricsRegistry
+from popularity import PopularityTracker
+from query_parser import (
+    MAX_COMPARE_LOCATIONS, PARSE_STATS, fast_parse, fast_path_hit_rate, normalize_query, parse_local_query, record_parse
+)
+from upstream_client import FetchClient
+from weather_snapshot import WeatherSnapshot
+
+try:
+    import brotli
+except ImportError:
+    # Brotli is optional; without it the page is served gzip-compressed
+    brotli = None
+
+# Validated Workers AI parses keyed on the normalised query text. A query always
+# parses the same way, so entries can live for a day.
+PARSE_CACHE = TieredCache("parse", max_entries=512, ttl=24 * 60 * 60)
+
+# One canonical snapshot per location (current conditions plus a 7-day
+# forecast in both unit systems) that every timeframe and unit variant is
+# derived from. Snapshots expire after WeatherAPI's next 15-minute update.
+SNAPSHOT_DAYS = 7
+TIMEFRAME_FORECAST_DAYS = {"tomorrow": 3, "7d": 7}
+# Expired snapshots are kept for WEATHER_STALE_TTL as the last known good
+# weather, served (marked stale) when WeatherAPI is down or its breaker is open.
+SNAPSHOT_CACHE_TTL = 15 * 60
+MIN_WEATHER_CACHE_TTL = 60
+WEATHER_STALE_TTL = 6 * 60 * 60
+
+# Stale-while-revalidate: a snapshot that expired less than
+# WEATHER_REVALIDATE_WINDOW ago is served as-is while one background refresh
+# per location replaces it, so busy locations never wait on WeatherAPI
+WEATHER_REVALIDATE_WINDOW = 10 * 60
+WEATHER_REVALIDATING = set()
+WEATHER_CACHE = TieredCache(
+    "weather",
+    max_entries=256,
+    ttl=SNAPSHOT_CACHE_TTL,
+    encode=WeatherSnapshot.to_dict,
+    decode=WeatherSnapshot.from_dict,
+    stale_ttl=WEATHER_STALE_TTL
+)
+
+# Coordinates (from request.cf for "what's the weather here?" queries, or typed
+# as "lat,lon") are snapped to the centre of their geohash cell. Precision 4
+# cells are 20km by at most 39km, about as fine as IP geolocation is, so
+# users in and around a city share one snapshot and WeatherAPI never sees
+# their exact position
+GEO_BUCKET_PRECISION = 4
+COORDINATES_PATTERN = re.compile(r"^\s*(-?\d{1,2}(?:\.\d+)?)\s*,\s*(-?\d{1,3}(?:\.\d+)?)\s*$")
+
+# Locations WeatherAPI answered 400 "not found" for, keyed like WEATHER_CACHE,
+# so misspelled places fail fast instead of calling upstream on every request
+NOT_FOUND_TTL = 24 * 60 * 60
+NOT_FOUND_CACHE = TieredCache("notfound", max_entries=512, ttl=NOT_FOUND_TTL)
+
+# Limericks keyed on (canonical location, condition, 5°C temperature bucket).
+# Each key holds a small pool of variants so repeat visitors still see variety;
+# once the pool is full, requests are served from it without calling the LLM.
+LIMERICK_POOL_SIZE = 3
+LIMERICK_TEMPERATURE_BUCKET = 5
+LIMERICK_CACHE = TieredCache("limerick", max_entries=256, ttl=6 * 60 * 60)
+LIMERICK_STATS = {"hits": 0, "misses": 0}
+
+# Global history entries waiting for the next batched KV write
+HISTORY_FLUSH_WINDOW = 0.5
+PENDING_HISTORY = []
+HISTORY_FLUSH = None
+
+# Serialised history for GET /api/history, updated on write
+HISTORY_RESPONSE_TTL = 5
+HISTORY_STALE_WHILE_REVALIDATE = 30
+HISTORY_RESPONSE_CACHE = {"body": None, "etag": None, "expires_at": 0}
+HISTORY_RESPONSE_STATS = {"ok": 0, "not_modified": 0}
+
+# Chat page caching: revalidated hourly via its content-hash ETag
+CHAT_PAGE_MAX_AGE = 60 * 60
+CHAT_PAGE_STALE_WHILE_REVALIDATE = 24 * 60 * 60
+
+# POST /api/chat/batch: items run concurrently, bounded so a large batch
+# doesn't queue behind the Workers limit of six open outbound connections
+BATCH_MAX_ITEMS = 100
+BATCH_DEFAULT_CONCURRENCY = 6
+BATCH_MAX_CONCURRENCY = 20
+
+# POST /chat time budget (seconds). Parse and weather each get at most their
+# cap of what is left; the optional limerick gets the remainder and is skipped
+# when less than MIN_LIMERICK_BUDGET is left.
+REQUEST_DEADLINE = 10.0
+STAGE_BUDGETS = {"parse": 4.0, "weather": 4.0}
+MIN_LIMERICK_BUDGET = 1.0
+
+# Per-call upstream timeouts (seconds), independent of any request deadline
+UPSTREAM_TIMEOUTS = {"parse_ai": 4.0, "weatherapi": 3.0, "limerick_ai": 6.0}
+
+# Per-upstream circuit breakers. Each opens for 30s when half of its last 20
+# calls failed (timeout, network error, 429 or 5xx) or 80% were slow, then
+# probes with one call before closing again. While open, calls fail at once:
+# weather falls back to the last known good snapshot and limericks are skipped.
+BREAKERS = {
+    "parse_ai": CircuitBreaker("parse_ai", slow_call_ms=3000),
+    "weatherapi": CircuitBreaker("weatherapi", slow_call_ms=2000),
+    "limerick_ai": CircuitBreaker("limerick_ai", slow_call_ms=5000),
+}
+CIRCUIT_STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# Idempotent GETs to these upstreams are hedged: if the first request hasn't
+# answered within the upstream's recent p95 latency, a second one is sent and
+# whichever answers first is used. Until HEDGE_MIN_SAMPLES calls have been
+# timed the delay is HEDGE_DEFAULT_DELAY. Set HEDGE_UPSTREAMS to a
+# comma-separated list to override, or to "" to turn hedging off.
+DEFAULT_HEDGE_UPSTREAMS = {"weatherapi"}
+HEDGE_UPSTREAMS = set(DEFAULT_HEDGE_UPSTREAMS)
+HEDGE_MIN_SAMPLES = 20
+HEDGE_DEFAULT_DELAY = 1.0
+HEDGE_MIN_DELAY = 0.05
+
+# Requests per location, estimated with a fixed-size count-min sketch and
+# top-k heap in each isolate and merged into KV at most once a minute per
+# isolate. GET /api/top-locations lists the merged ranking (at most
+# POPULARITY.k entries) and may be cached for TOP_LOCATIONS_MAX_AGE seconds.
+POPULARITY = PopularityTracker()
+TOP_LOCATIONS_DEFAULT_LIMIT = 10
+TOP_LOCATIONS_MAX_AGE = 60
+
+# GET /api/weather responses are stored in the Workers Cache API
+# (caches.default) under a canonical URL (canonical location, units,
+# timeframe), so repeats from the same colo are answered before any parsing
+# or KV access. They are cacheable until the snapshot expires, but for at
+# least WEATHER_API_MIN_MAX_AGE seconds; stale fallbacks only for that long.
+WEATHER_API_UNITS = ("metric", "imperial")
+WEATHER_API_TIMEFRAMES = ("now", "today", "tomorrow", "7d")
+WEATHER_API_MIN_MAX_AGE = 60
+
+# Scheduled pre-warming (cron trigger in wrangler.toml, every 5 minutes). Of
+# the PREWARM_TOP_N most-requested locations, those whose snapshot is missing
+# or expires within PREWARM_HORIZON seconds are refreshed, most popular
+# first, with at most PREWARM_BUDGET WeatherAPI calls per run (2,880 a day at
+# the defaults). PREWARM_LIMERICKS = "true" also fills their limerick pools.
+# The PREWARM_* env vars override the defaults.
+PREWARM_TOP_N = 20
+PREWARM_BUDGET = 10
+PREWARM_HORIZON = 6 * 60
+PREWARM_CONCURRENCY = 4
+
+# Single-flight groups coalescing identical in-flight upstream calls
+PARSE_FLIGHTS = SingleFlight()
+WEATHER_FLIGHTS = SingleFlight()
+LIMERICK_FLIGHTS = SingleFlight()
+
+# Aggregated request, stage and upstream metrics for GET /api/metrics. Set
+# METRICS_TOKEN to require "Authorization: Bearer <token>" for scrapes.
+METRICS = MetricsRegistry("weatherappy")
+METRICS.describe("requests_total", "Requests by route, method and status")
+METRICS.describe("request_duration_seconds", "Request duration by route")
+METRICS.describe("stage_duration_seconds", "Time spent in each stage per request")
+METRICS.describe("upstream_responses_total", "Upstream responses by HTTP status (error = no response, timeout = cancelled)")
+METRICS.describe("upstream_duration_seconds", "Time to an upstream response, per request sent")
+METRICS.describe("hedges_total", "Hedged requests sent (fired) and answered before the original (won)")
+METRICS.describe("deadline_exceeded_total", "Request stages cancelled for running out of time")
+METRICS.describe("stale_responses_total", "Weather served from the last known good snapshot, by cause")
+METRICS.describe("weather_revalidations_total", "Background refreshes of recently expired snapshots, by result")
+METRICS.describe("prewarm_total", "Locations handled by scheduled pre-warming, by result")
+METRICS.describe("circuit_state", "Upstream circuit breaker state (0 closed, 1 half-open, 2 open)")
+METRICS.describe("circuit_opened_total", "Times each upstream circuit breaker opened")
+METRICS.describe("circuit_rejected_total", "Upstream calls failed fast by an open circuit breaker")
+METRICS.describe("edge_cache_total", "GET /api/weather lookups in the Workers Cache API by result")
+METRICS.describe("parse_total", "Parsed queries by source")
+METRICS.describe("cache_lookups_total", "Cache lookups by cache and result")
+METRICS.describe("cache_hit_ratio", "Memory plus KV hits over all lookups")
+METRICS.describe("upstream_calls_total", "Upstream cache misses that started a call or joined one in flight")
+METRICS_ROUTES = {"/", "/chat", "/api/history", "/api/chat/batch", "/api/metrics", "/api/top-locations", "/api/weather"}
+
+# All WeatherAPI.com and Workers AI calls go through this client; the bench
+# harness swaps in upstream_client.RecordingClient or ReplayClient
+UPSTREAM_CLIENT = FetchClient()
 
 # HTML template for the chat interface
 HTML_TEMPLATE = """
@@ -74,6 +265,29 @@ HTML_TEMPLATE = """
             text-align: center;
             border: 1px solid #e5e7eb;
         }
+        .comparison {
+            width: 100%;
+            border-collapse: collapse;
+            margin-top: 15px;
+            font-size: 0.95em;
+        }
+        .comparison th, .comparison td {
+            padding: 10px 12px;
+            border: 1px solid #e5e7eb;
+            text-align: left;
+        }
+        .comparison th {
+            background: #f9fafb;
+            color: #1f2937;
+        }
+        .comparison td.error {
+            color: #dc2626;
+        }
+        .stale {
+            margin-top: 10px;
+            color: #92400e;
+            font-size: 0.9em;
+        }
         .limerick {
             background: #fff5e6;
             border-left: 4px solid #f6821f;
@@ -249,9 +463,10 @@ HTML_TEMPLATE = """
 
     <script>
          // Load chat history on page load
-         async function loadHistory() {
+         // (revalidate=true skips the browser's fresh copy and asks with If-None-Match)
+         async function loadHistory(revalidate) {
              try {
-                 const response = await fetch('/api/history');
+                 const response = await fetch('/api/history', { cache: revalidate ? 'no-cache' : 'default' });
                  const history = await response.json();
                  
                  const historyList = document.getElementById('historyList');
@@ -273,7 +488,7 @@ HTML_TEMPLATE = """
          }
          
          // Load history when page loads
-         window.addEventListener('DOMContentLoaded', loadHistory);
+         window.addEventListener('DOMContentLoaded', () => loadHistory(false));
          
          async function sendQuery() {
              const input = document.getElementById('queryInput');
@@ -295,68 +510,31 @@ HTML_TEMPLATE = """
              chatBox.scrollTop = chatBox.scrollHeight;
             
             try {
+                // Ask for a streamed response: the weather arrives first and
+                // the limerick is rendered token by token as it is written
                 const response = await fetch('/chat', {
                     method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ query })
+                    headers: { 'Content-Type': 'application/json', 'Accept': 'application/x-ndjson' },
+                    body: JSON.stringify({ query, stream: true })
                 });
                 
-                const data = await response.json();
-                
-                // Remove loading
-                const loadingDiv = chatBox.querySelector('.loading');
-                if (loadingDiv) loadingDiv.remove();
-                
-                // Display result
-                let html = '<div class="message">';
-                
-                 if (data.error) {
-                     html += `<div class="error">${data.error}</div>`;
-                 } else {
-                     html += `<h3>📍 ${data.location}</h3>`;
-                     
-                     // Check if this is current weather or forecast
-                     if (data.forecast && data.forecast.length > 0) {
-                         // Forecast data
-                         html += '<h4 style="margin-top: 15px; color: #667eea;">📅 Weather Forecast</h4>';
-                         html += '<div style="margin-top: 10px;">';
-                         
-                         data.forecast.forEach(day => {
-                             html += '<div style="background: #f9fafb; padding: 14px; margin: 10px 0; border-radius: 10px; border-left: 4px solid #f6821f; border: 1px solid #e5e7eb;">';
-                             html += `<div style="font-weight: 600; color: #1f2937; margin-bottom: 6px; font-size: 1.05em;">${formatDate(day.date)}</div>`;
-                             html += `<div style="color: #5a6c7d; margin-bottom: 4px;">${day.condition.replace(/[🌡️☀️🌧️❄️🌨⛅🌤🌦🌩⛈🌫]/g, '').trim()}</div>`;
-                             html += `<div style="color: #5a6c7d;">High: <strong style="color: #f6821f;">${day.high}</strong> | Low: <strong style="color: #3b82f6;">${day.low}</strong></div>`;
-                             html += '</div>';
-                         });
-                         
-                         html += '</div>';
-                     } else {
-                         // Current weather data
-                         html += '<div class="weather-info">';
-                         if (data.temperature) html += `<div class="weather-item"><strong>Temp</strong><br>${data.temperature}</div>`;
-                         if (data.condition) {
-                             const cleanCondition = data.condition.replace(/[🌡️☀️🌧️❄️🌨⛅🌤🌦🌩⛈🌫]/g, '').trim();
-                             html += `<div class="weather-item"><strong>Condition</strong><br>${cleanCondition}</div>`;
-                         }
-                          if (data.humidity !== undefined) html += `<div class="weather-item"><strong>💧 Humidity</strong><br>${data.humidity}%</div>`;
-                          if (data.wind) html += `<div class="weather-item"><strong>💨 Wind</strong><br>${data.wind}</div>`;
-                         html += '</div>';
-                     }
-                     
-                     if (data.limerick) {
-                         html += `<div class="limerick">${data.limerick}</div>`;
-                     }
-                 }
-                
-                html += '</div>';
-                chatBox.innerHTML += html;
-                chatBox.scrollTop = chatBox.scrollHeight;
+                const contentType = response.headers.get('Content-Type') || '';
+                if (contentType.includes('application/x-ndjson') && response.body) {
+                    await readChatStream(response.body, chatBox);
+                } else {
+                    // Errors are returned as a plain JSON response
+                    const data = await response.json();
+                    const loadingDiv = chatBox.querySelector('.loading');
+                    if (loadingDiv) loadingDiv.remove();
+                    renderResult(data, chatBox);
+                }
                 
                 // Clear input
                 input.value = '';
                 
-                // Reload history to show the new query
-                loadHistory();
+                // Reload history to show the new query once the background
+                // history write has been flushed
+                setTimeout(() => loadHistory(true), 1000);
                 
             } catch (error) {
                 const loadingDiv = chatBox.querySelector('.loading');
@@ -369,6 +547,141 @@ HTML_TEMPLATE = """
             }
         }
         
+         // Read newline-delimited JSON events from a streamed /chat response
+         async function readChatStream(body, chatBox) {
+             const reader = body.getReader();
+             const decoder = new TextDecoder();
+             let buffer = '';
+             let limerickDiv = null;
+             
+             while (true) {
+                 const { done, value } = await reader.read();
+                 if (done) break;
+                 buffer += decoder.decode(value, { stream: true });
+                 
+                 const lines = buffer.split('\\n');
+                 buffer = lines.pop();
+                 for (const line of lines) {
+                     if (!line.trim()) continue;
+                     const event = JSON.parse(line);
+                     
+                     if (event.type === 'weather') {
+                         const loadingDiv = chatBox.querySelector('.loading');
+                         if (loadingDiv) loadingDiv.remove();
+                         const message = renderResult(event.data, chatBox);
+                         
+                         limerickDiv = document.createElement('div');
+                         limerickDiv.className = 'limerick';
+                         limerickDiv.textContent = '✍️ Writing a limerick...';
+                         limerickDiv.dataset.pending = 'true';
+                         message.appendChild(limerickDiv);
+                     } else if (event.type === 'limerick_token' && limerickDiv) {
+                         if (limerickDiv.dataset.pending) {
+                             limerickDiv.textContent = '';
+                             delete limerickDiv.dataset.pending;
+                         }
+                         limerickDiv.textContent += event.text;
+                     } else if (event.type === 'limerick' && limerickDiv) {
+                         // Final, cleaned-up limerick (or null if generation failed)
+                         if (event.text) {
+                             limerickDiv.textContent = event.text;
+                             delete limerickDiv.dataset.pending;
+                         } else {
+                             limerickDiv.remove();
+                         }
+                     }
+                     chatBox.scrollTop = chatBox.scrollHeight;
+                 }
+             }
+         }
+         
+         // Render a weather result (or error) as a new message in the chat box
+         function renderResult(data, chatBox) {
+             let html = '';
+             
+             if (data.error) {
+                 html += `<div class="error">${data.error}</div>`;
+             } else if (data.comparison) {
+                 html += '<h3>📊 Weather Comparison</h3>';
+                 html += renderComparison(data.comparison);
+             } else {
+                 html += `<h3>📍 ${data.location}</h3>`;
+                 
+                 // Check if this is current weather or forecast
+                 if (data.forecast && data.forecast.length > 0) {
+                     // Forecast data
+                     html += '<h4 style="margin-top: 15px; color: #667eea;">📅 Weather Forecast</h4>';
+                     html += '<div style="margin-top: 10px;">';
+                     
+                     data.forecast.forEach(day => {
+                         html += '<div style="background: #f9fafb; padding: 14px; margin: 10px 0; border-radius: 10px; border-left: 4px solid #f6821f; border: 1px solid #e5e7eb;">';
+                         html += `<div style="font-weight: 600; color: #1f2937; margin-bottom: 6px; font-size: 1.05em;">${formatDate(day.date)}</div>`;
+                         html += `<div style="color: #5a6c7d; margin-bottom: 4px;">${day.condition.replace(/[🌡️☀️🌧️❄️🌨⛅🌤🌦🌩⛈🌫]/g, '').trim()}</div>`;
+                         html += `<div style="color: #5a6c7d;">High: <strong style="color: #f6821f;">${day.high}</strong> | Low: <strong style="color: #3b82f6;">${day.low}</strong></div>`;
+                         html += '</div>';
+                     });
+                     
+                     html += '</div>';
+                 } else {
+                     // Current weather data
+                     html += '<div class="weather-info">';
+                     if (data.temperature) html += `<div class="weather-item"><strong>Temp</strong><br>${data.temperature}</div>`;
+                     if (data.condition) {
+                         const cleanCondition = data.condition.replace(/[🌡️☀️🌧️❄️🌨⛅🌤🌦🌩⛈🌫]/g, '').trim();
+                         html += `<div class="weather-item"><strong>Condition</strong><br>${cleanCondition}</div>`;
+                     }
+                     if (data.humidity !== undefined) html += `<div class="weather-item"><strong>💧 Humidity</strong><br>${data.humidity}%</div>`;
+                     if (data.wind) html += `<div class="weather-item"><strong>💨 Wind</strong><br>${data.wind}</div>`;
+                     html += '</div>';
+                 }
+                 
+                 if (data.stale) {
+                     html += `<div class="stale">⚠️ Live weather is unavailable; showing the last known conditions${formatAsOf(data.as_of)}.</div>`;
+                 }
+                 
+                 if (data.limerick) {
+                     html += `<div class="limerick">${data.limerick}</div>`;
+                 }
+             }
+             
+             const message = document.createElement('div');
+             message.className = 'message';
+             message.innerHTML = html;
+             chatBox.appendChild(message);
+             chatBox.scrollTop = chatBox.scrollHeight;
+             return message;
+         }
+        
+         // Comparison table: one row per location, with current conditions or
+         // one column per forecast day
+         function renderComparison(entries) {
+             const clean = text => (text || '').replace(/[🌡️☀️🌧️❄️🌨⛅🌤🌦🌩⛈🌫]/g, '').trim();
+             const reference = entries.find(entry => !entry.error) || {};
+             const days = reference.forecast ? reference.forecast.map(day => day.date) : null;
+             const columns = days ? days.map(formatDate) : ['Temp', 'Condition', '💧 Humidity', '💨 Wind'];
+             
+             let html = '<table class="comparison"><tr><th>📍 Location</th>';
+             columns.forEach(column => { html += `<th>${column}</th>`; });
+             html += '</tr>';
+             
+             entries.forEach(entry => {
+                 html += `<tr><td><strong>${entry.location}</strong>${entry.stale ? ` <span class="stale">(last known${formatAsOf(entry.as_of)})</span>` : ''}</td>`;
+                 if (entry.error) {
+                     html += `<td class="error" colspan="${columns.length}">${entry.error}</td>`;
+                 } else if (days) {
+                     days.forEach(date => {
+                         const day = (entry.forecast || []).find(d => d.date === date);
+                         html += day ? `<td>${day.high} / ${day.low}<br>${clean(day.condition)}</td>` : '<td>–</td>';
+                     });
+                 } else {
+                     html += `<td>${entry.temperature}</td><td>${clean(entry.condition)}</td><td>${entry.humidity}%</td><td>${entry.wind}</td>`;
+                 }
+                 html += '</tr>';
+             });
+             
+             return html + '</table>';
+         }
+        
          // Helper function to format date nicely
          function formatDate(dateStr) {
              const date = new Date(dateStr);
@@ -382,6 +695,12 @@ HTML_TEMPLATE = """
              return `${dayName}, ${monthName} ${dayNum}`;
          }
          
+         // " from 14:30" for a stale response's as_of epoch, or nothing if unknown
+         function formatAsOf(epoch) {
+             if (!epoch) return '';
+             return ' from ' + new Date(epoch * 1000).toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' });
+         }
+         
          // Allow Enter key to send
          document.getElementById('queryInput').addEventListener('keypress', function(e) {
              if (e.key === 'Enter') sendQuery();
@@ -395,6 +714,154 @@ HTML_TEMPLATE = """
 """
 
 
+def build_static_page(html):
+    """
+    Encode a page once into identity, gzip and (if available) brotli
+    variants, each with its own strong ETag derived from the content hash
+    """
+    raw = html.encode("utf-8")
+    digest = hashlib.sha256(raw).hexdigest()[:32]
+    
+    variants = {"identity": raw, "gzip": gzip.compress(raw, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(raw, quality=11)
+    
+    return {
+        encoding: {"body": body, "etag": f'"{digest}-{encoding}"'}
+        for encoding, body in variants.items()
+    }
+
+
+def choose_encoding(accept_encoding, available):
+    """Pick the best content coding the client accepts: br, then gzip, then identity"""
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.strip().lower()] = quality
+    
+    for encoding in ["br", "gzip"]:
+        if encoding in available and accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return "identity"
+
+
+# The chat page never changes at runtime, so it is encoded and hashed once
+CHAT_PAGE = build_static_page(HTML_TEMPLATE)
+
+
+def configure_hedging(env):
+    """Apply the HEDGE_UPSTREAMS var (comma-separated upstream names, "" for none)"""
+    names = getattr(env, "HEDGE_UPSTREAMS", None)
+    HEDGE_UPSTREAMS.clear()
+    if names is None:
+        HEDGE_UPSTREAMS.update(DEFAULT_HEDGE_UPSTREAMS)
+    else:
+        HEDGE_UPSTREAMS.update(name.strip() for name in str(names).split(",") if name.strip())
+
+
+async def send_upstream(upstream, url, **options):
+    """
+    Send one upstream request through UPSTREAM_CLIENT, counting responses by
+    status and timing them for /api/metrics
+    """
+    started = time.perf_counter()
+    try:
+        response = await UPSTREAM_CLIENT.send(upstream, url, **options)
+    except Exception:
+        METRICS.inc("upstream_responses_total", upstream=upstream, status="error")
+        raise
+    METRICS.inc("upstream_responses_total", upstream=upstream, status=str(response.status))
+    METRICS.observe("upstream_duration_seconds", (time.perf_counter() - started) * 1000, upstream=upstream)
+    return response
+
+
+def hedge_delay(upstream):
+    """Seconds to wait before hedging: the upstream's p95 once enough calls have been timed"""
+    timeout = UPSTREAM_TIMEOUTS.get(upstream, REQUEST_DEADLINE)
+    histogram = METRICS.histogram("upstream_duration_seconds", upstream=upstream)
+    if histogram.count < HEDGE_MIN_SAMPLES:
+        return min(HEDGE_DEFAULT_DELAY, timeout / 2)
+    return min(max(histogram.quantile(0.95) / 1000, HEDGE_MIN_DELAY), timeout / 2)
+
+
+async def hedged_send(upstream, url, **options):
+    """
+    Send a request and, if it hasn't answered after hedge_delay(), a second
+    identical one. The first usable response (no exception, status below
+    500) wins and the other request is cancelled.
+    """
+    primary = asyncio.ensure_future(send_upstream(upstream, url, **options))
+    pending = {primary}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=hedge_delay(upstream))
+        if done:
+            return primary.result()
+
+        METRICS.inc("hedges_total", upstream=upstream, result="fired")
+        log.debug("Upstream", "Hedging %s request", upstream)
+        hedge = asyncio.ensure_future(send_upstream(upstream, url, **options))
+        pending.add(hedge)
+
+        failed = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and task.result().status < 500:
+                    if task is hedge:
+                        METRICS.inc("hedges_total", upstream=upstream, result="won")
+                    return task.result()
+                failed = failed or task
+
+        # Neither answered usefully; surface the first failure as-is
+        return failed.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def fetch_upstream(upstream, url, **options):
+    """
+    Send an upstream request through its circuit breaker, cancelled after
+    UPSTREAM_TIMEOUTS[upstream] seconds. GETs to upstreams in
+    HEDGE_UPSTREAMS are hedged.
+
+    Raises CircuitOpen without sending anything while the breaker is open,
+    and DeadlineExceeded on timeout.
+    """
+    breaker = BREAKERS[upstream]
+    breaker.check()
+    
+    method = options.get("method", "GET")
+    if method == "GET" and upstream in HEDGE_UPSTREAMS:
+        call = hedged_send(upstream, url, **options)
+    else:
+        call = send_upstream(upstream, url, **options)
+    
+    started = time.perf_counter()
+    try:
+        response = await run_with_timeout(call, UPSTREAM_TIMEOUTS.get(upstream, REQUEST_DEADLINE), f"{upstream} request")
+    except DeadlineExceeded:
+        METRICS.inc("upstream_responses_total", upstream=upstream, status="timeout")
+        breaker.record(True, (time.perf_counter() - started) * 1000)
+        raise
+    except asyncio.CancelledError:
+        breaker.release()
+        raise
+    except Exception:
+        breaker.record(True, (time.perf_counter() - started) * 1000)
+        raise
+    
+    breaker.record(response.status == 429 or response.status >= 500, (time.perf_counter() - started) * 1000)
+    return response
+
+
 async def call_workers_ai(prompt, account_id, api_token):
     """Call Cloudflare Workers AI to convert natural language to JSON structure"""
     try:
@@ -407,11 +874,14 @@ Rules:
 - Default to "metric" unless Fahrenheit/imperial is mentioned
 - Default to "now" unless a specific timeframe is mentioned
 - Extract the location name for "q"
+- When several locations are compared, list them all in "locations" and set "q" to the first
 - Output ONLY valid JSON, no other text
 
 Examples:
 Input: "What's the weather in Paris?"
-Output: {"intent": "get_weather", "q": "Paris", "units": "metric", "timeframe": "now"}"""
+Output: {"intent": "get_weather", "q": "Paris", "units": "metric", "timeframe": "now"}
+Input: "Compare the weather in Paris, Rome and Berlin"
+Output: {"intent": "get_weather", "q": "Paris", "locations": ["Paris", "Rome", "Berlin"], "units": "metric", "timeframe": "now"}"""
         
         payload = {
             "messages": [
@@ -420,202 +890,483 @@ Output: {"intent": "get_weather", "q": "Paris", "units": "metric", "timeframe":
             ]
         }
         
-        print(f"[Workers AI] Parsing query: {prompt}")
+        log.debug("Workers AI", "Parsing query: %s", prompt)
         
         headers = Headers.new()
         headers.set("Authorization", f"Bearer {api_token}")
         headers.set("Content-Type", "application/json")
-        # Log payload (for debugging)
-        print(f"[Workers AI] Request payload messages count: {len(payload.get('messages', []))}")
         
-        response = await fetch(url, method="POST", headers=headers, body=json.dumps(payload))
+        with log.stage("parse_ai"):
+            response = await fetch_upstream("parse_ai", url, method="POST", headers=headers, body=json.dumps(payload))
+            
+            if not response.ok:
+                error_text = await response.text()
+                raise Exception(f"Workers AI API error (HTTP {response.status}): {error_text[:100]}")
+            
+            result_js = await response.json()
         
-        print(f"[Workers AI] Response status: {response.status}")
+        # Read only the fields we need instead of converting the whole response
+        success = getattr(result_js, 'success', False)
+        result = getattr(result_js, 'result', None)
+        if success and result is not None:
+            return getattr(result, 'response', None)
         
-        if not response.ok:
-            print("a1")
-            error_text = await response.text()
-            print("a2")
-            print(f"[Workers AI] Error response: {error_text}")
-            print("a3")
-            raise Exception(f"Workers AI API error (HTTP {response.status}): {error_text[:100]}")
-        print("a4")
-        result_js = await response.json()
-        print("a5")
-        # Convert JsProxy to Python dict for easier access
-        result = result_js.to_py()
-        print("a6")
-        print(f"[Workers AI] Response success: {result.get('success')}")
-        print("a7")
-        print(f"[Workers AI] Response keys: {list(result.keys())}")
-        print("a8")
-
-        if result.get('result'):
-            print("a9")
-            print(f"[Workers AI] Response has result: True")
-        if result.get('errors'):
-            print("a10")
-            print(f"[Workers AI] Errors: {result.get('errors')}")
-        if result.get("success") and result.get("result"):
-            print("a11")
-            ai_response = result["result"]["response"]
-            print("a12")
-            print(f"[Workers AI] Successfully parsed query")
-            print("a13")
-            return ai_response
-        else:
-            print("a14")
-            # Handle errors - check if errors array exists and has items
-            errors = result.get('errors', [])
-            if errors and len(errors) > 0:
-                error_msg = errors[0]
-            else:
-                error_msg = "AI returned no result"
-            print("a15")
-            print(f"[Workers AI] Error: {error_msg}")
-            print("a16")
-            raise Exception(f"Workers AI failed: {error_msg}")
+        errors_js = getattr(result_js, 'errors', None)
+        errors = errors_js.to_py() if errors_js is not None else []
+        error_msg = errors[0] if errors else "AI returned no result"
+        raise Exception(f"Workers AI failed: {error_msg}")
             
+    except (DeadlineExceeded, CircuitOpen):
+        raise
     except Exception as e:
-        print("a20")
-        print(f"[Workers AI] Exception: {str(e)}")
-        print("a21")
+        log.warning("Workers AI", "%s", e)
         raise Exception(f"AI query parsing failed: {str(e)}")
 
 
-async def get_weather(query_params, api_key):
-    """Call WeatherAPI.com to get weather data"""
+def parse_ai_query(ai_response):
+    """Extract and validate the query dict from the Workers AI response text"""
+    json_start = ai_response.find('{')
+    if json_start == -1:
+        raise Exception("AI response doesn't contain valid JSON")
+    
+    # raw_decode stops at the end of the first object, so trailing chatter
+    # (or a second example object) from the model doesn't break parsing
+    query_params, _ = json.JSONDecoder().raw_decode(ai_response[json_start:])
+    
+    if not isinstance(query_params, dict) or query_params.get("intent") != "get_weather":
+        raise Exception("AI couldn't identify a location in your query")
+    
+    locations = query_params.get("locations")
+    locations = [str(loc).strip() for loc in locations if str(loc).strip()] if isinstance(locations, list) else []
+    location = str(query_params.get("q") or "").strip() or (locations[0] if locations else "")
+    if not location:
+        raise Exception("AI couldn't identify a location in your query")
+    
+    return build_query_params(location, query_params.get("units"), query_params.get("timeframe"), locations)
+
+
+def build_query_params(location, units=None, timeframe=None, locations=None):
+    """
+    Query params dict with units and timeframe normalised to supported values.
+    Comparisons of two or more distinct locations also carry "locations".
+    """
+    query_params = {"intent": "get_weather", "q": location}
+    
+    distinct = []
+    for loc in [location] + list(locations or []):
+        if loc.lower() not in [existing.lower() for existing in distinct]:
+            distinct.append(loc)
+    if len(distinct) > 1:
+        query_params["locations"] = distinct[:MAX_COMPARE_LOCATIONS]
+    
+    query_params["units"] = "imperial" if units == "imperial" else "metric"
+    query_params["timeframe"] = timeframe if timeframe in ["now", "today", "tomorrow", "7d"] else "now"
+    return query_params
+
+
+def parse_cache_key(query):
+    """KV-safe cache key for a user query"""
+    return hashlib.sha256(normalize_query(query).encode("utf-8")).hexdigest()[:32]
+
+
+class AIRequestError(Exception):
+    """Workers AI could not be reached or returned an empty response"""
+
+
+class LocationNotFound(Exception):
+    """WeatherAPI.com doesn't know the requested location"""
+
+
+class WeatherAPIError(Exception):
+    """WeatherAPI.com failed (5xx, an error payload), as opposed to rejecting the location"""
+
+
+async def parse_query(env, user_query, account_id, api_token, coordinates=None):
+    """
+    Turn a natural-language query into query params: the deterministic fast
+    path first, then the parse cache, and only then Workers AI. Queries that
+    name no place ("what's the weather here?") use coordinates, the client's
+    (lat, lon) from request.cf, when they are known.
+    
+    Raises AIRequestError when the AI call fails, DeadlineExceeded when it
+    times out, CircuitOpen when Workers AI is failing fast,
+    json.JSONDecodeError when its output isn't JSON, and Exception when the
+    output isn't a usable query.
+    """
+    if coordinates is not None:
+        query_params = parse_local_query(user_query)
+        if query_params:
+            query_params["q"] = geo_location(*coordinates)
+            # Derived from the caller's IP, so it is kept out of the public history
+            query_params["geolocated"] = True
+            record_parse("geolocation")
+            log.annotate(parse="geolocation")
+            log.debug("Parse", "Location-less query, using request location: %s", query_params)
+            return query_params
+    
+    query_params = fast_parse(user_query)
+    if query_params:
+        record_parse("fast_path")
+        log.annotate(parse="fast_path")
+        log.debug("Parse", "Fast-path parsed query: %s", query_params)
+        return query_params
+    
+    parse_key = parse_cache_key(user_query)
+    query_params = await PARSE_CACHE.get(env, parse_key)
+    if query_params:
+        record_parse("cache")
+        log.annotate(parse="cache")
+        log.debug("Parse", "Parse cache hit: %s", query_params)
+        return query_params
+    
+    record_parse("llm_fallback")
+    log.annotate(parse="llm_fallback")
     try:
-        base_url = "http://api.weatherapi.com/v1/"
-        
-        location = query_params.get("q", "")
-        units = query_params.get("units", "metric")
-        timeframe = query_params.get("timeframe", "now")
-        
-        if not location:
-            raise Exception("No location specified in query")
-        
-        print(f"[Weather] Fetching weather for: {location} (units: {units}, timeframe: {timeframe})")
-        # Determine endpoint and parameters based on timeframe
-        if timeframe in ["now", "today"]:
-            # Current weather
-            url = f"{base_url}current.json?key={api_key}&q={location}"
-        else:
-            # Forecast weather (3-day forecast)
-            days = 7 if timeframe == "7d" else 3
-            url = f"{base_url}forecast.json?key={api_key}&q={location}&days={days}"
-        
-        # Log the request (without exposing full API key)
-        masked_url = url.replace(api_key, f"{api_key[:8]}...{api_key[-4:]}")
-        print(f"[WeatherAPI Request] URL: {masked_url}")
-        print(f"[WeatherAPI Request] Location: {location}, Units: {units}, Timeframe: {timeframe}")
-        
-        response = await fetch(url)
-        
-        # Log the response status
-        print(f"[WeatherAPI Response] Status: {response.status} {response.statusText if hasattr(response, 'statusText') else ''}")
+        # Concurrent identical queries share one Workers AI call
+        ai_response = await PARSE_FLIGHTS.do(parse_key, call_workers_ai, user_query, account_id, api_token)
+        if not ai_response:
+            raise Exception("AI returned empty response")
+    except (DeadlineExceeded, CircuitOpen):
+        raise
+    except Exception as e:
+        raise AIRequestError(str(e))
+    
+    query_params = parse_ai_query(ai_response)
+    log.debug("Parse", "Parsed query: %s", query_params)
+    
+    # Only validated parses are cached
+    await PARSE_CACHE.set(env, parse_key, query_params)
+    return query_params
+
+
+def parse_coordinates(location):
+    """(lat, lon) if a location string is a coordinate pair, else None"""
+    match = COORDINATES_PATTERN.match(location)
+    if not match:
+        return None
+    lat, lon = float(match.group(1)), float(match.group(2))
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return lat, lon
+
+
+def geo_location(lat, lon):
+    """Location string for the centre of the geohash cell containing a point"""
+    _, center_lat, center_lon = geohash.bucket(lat, lon, GEO_BUCKET_PRECISION)
+    return f"{center_lat:.4f},{center_lon:.4f}"
+
+
+def request_coordinates(request):
+    """The client's (lat, lon) from Cloudflare's request.cf geolocation, or None"""
+    cf = getattr(request, "cf", None)
+    if cf is None:
+        return None
+    try:
+        lat, lon = float(getattr(cf, "latitude", None)), float(getattr(cf, "longitude", None))
+    except (TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return lat, lon
+
+
+def canonical_location(location):
+    """
+    Canonical form of a location string: the gazetteer name of a known place,
+    the centre of the geohash cell for coordinates, otherwise unchanged
+    """
+    coordinates = parse_coordinates(location)
+    if coordinates is not None:
+        return geo_location(*coordinates)
+    place = gazetteer.lookup(location)
+    return place.name if place is not None else location
+
+
+def weather_cache_key(location):
+    """
+    Cache key for a location's weather snapshot. Gazetteer places are keyed
+    on their id and coordinates on their geohash cell, so every alias of a
+    place, and every point in a cell, shares one snapshot.
+    """
+    coordinates = parse_coordinates(location)
+    if coordinates is not None:
+        return f"snapshot:geo:{geohash.encode(*coordinates, GEO_BUCKET_PRECISION)}"
+    place = gazetteer.lookup(location)
+    if place is not None:
+        return f"snapshot:place:{place.id}"
+    canonical = re.sub(r"\s+", " ", location.lower()).strip(" ,.")
+    return f"snapshot:{hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:32]}"
+
+
+def weather_cache_ttl(snapshot):
+    """
+    TTL for a cached snapshot. WeatherAPI refreshes current conditions every
+    15 minutes, so the snapshot expires shortly after the next expected
+    upstream update.
+    """
+    last_updated = snapshot.last_updated_epoch
+    if not last_updated:
+        return SNAPSHOT_CACHE_TTL
+    next_update = last_updated + SNAPSHOT_CACHE_TTL
+    return min(max(next_update - time.time(), MIN_WEATHER_CACHE_TTL), SNAPSHOT_CACHE_TTL)
+
+
+async def fetch_weather_snapshot(location, api_key):
+    """
+    Fetch the canonical weather snapshot for a location from WeatherAPI.com.
+    
+    A single forecast.json call returns current conditions plus the full
+    forecast, so every timeframe and unit system is served from one fetch.
+    Gazetteer places are requested by coordinates.
+    """
+    place = gazetteer.lookup(location)
+    q = place.query if place is not None else location
+    # q is user input: "&", "#" and the like must not end or extend the query string
+    query = urlencode(
+        [("key", api_key), ("q", q), ("days", SNAPSHOT_DAYS), ("aqi", "no"), ("alerts", "no")], safe=",", quote_via=quote
+    )
+    url = f"http://api.weatherapi.com/v1/forecast.json?{query}"
+    
+    log.debug("WeatherAPI", "Fetching %s", location)
+    
+    with log.stage("weatherapi"):
+        response = await fetch_upstream("weatherapi", url)
         
         if not response.ok:
             error_text = await response.text()
             if response.status == 400:
-                print(f"[WeatherAPI Response] Error: Location '{location}' not found")
-                raise Exception(f"Location '{location}' not found. Please check the spelling or try a different location.")
-            print(f"[WeatherAPI Response] Error: HTTP {response.status} - {error_text[:100]}")
-            raise Exception(f"Weather API error (HTTP {response.status}): Unable to fetch weather data")
+                raise LocationNotFound(f"Location '{location}' not found. Please check the spelling or try a different location.")
+            log.warning("WeatherAPI", "HTTP %s - %s", response.status, error_text[:100])
+            raise WeatherAPIError(f"Weather API error (HTTP {response.status}): Unable to fetch weather data")
         
+        # Project only the fields we use instead of converting the whole payload
+        # (24 hourly entries per forecast day) with to_py()
         data_js = await response.json()
-        # Convert JsProxy to Python dict for easier access
-        data = data_js.to_py()
-        
-        # Log the response data (truncated for readability)
-        print(f"[WeatherAPI Response] Data received for: {data.get('location', {}).get('name', 'Unknown')}")
-        if 'current' in data:
-            print(f"[WeatherAPI Response] Current temp: {data['current'].get('temp_c')}°C / {data['current'].get('temp_f')}°F")
-            print(f"[WeatherAPI Response] Condition: {data['current']['condition'].get('text', 'N/A')}")
-        
-        # Check for API error response
-        if 'error' in data:
-            error_msg = data['error'].get('message', 'Weather API error')
-            print(f"[WeatherAPI Response] API Error: {error_msg}")
-            raise Exception(f"Weather API error: {error_msg}")
-        
-        # Validate response structure
-        if 'location' not in data:
-            raise Exception("Invalid weather data received: missing location information")
-        
-        if 'current' not in data and 'forecast' not in data:
+    
+    # Check for API error response
+    error_js = getattr(data_js, 'error', None)
+    if error_js is not None:
+        error_msg = getattr(error_js, 'message', None) or 'Weather API error'
+        log.warning("WeatherAPI", "API error: %s", error_msg)
+        raise WeatherAPIError(f"Weather API error: {error_msg}")
+    
+    return WeatherSnapshot.from_js(data_js)
+
+
+async def refresh_weather_snapshot(env, cache_key, location, api_key):
+    """
+    Fetch a location's snapshot from WeatherAPI.com and store it in the
+    weather cache. Locations WeatherAPI doesn't know are remembered in
+    NOT_FOUND_CACHE.
+    """
+    try:
+        snapshot = await fetch_weather_snapshot(location, api_key)
+    except LocationNotFound:
+        await NOT_FOUND_CACHE.set(env, cache_key, True)
+        raise
+    await WEATHER_CACHE.set(env, cache_key, snapshot, ttl=weather_cache_ttl(snapshot))
+    return snapshot
+
+
+async def revalidate_weather_snapshot(env, cache_key, location, api_key):
+    """
+    Background refresh of a recently expired snapshot. Another isolate may
+    already have refreshed it in KV; otherwise it is fetched through
+    WEATHER_FLIGHTS so it shares any fetch already running for the location.
+    Failures are logged and the expired copy stays cached.
+    """
+    try:
+        if await WEATHER_CACHE.get(env, cache_key):
+            METRICS.inc("weather_revalidations_total", result="kv")
+            return
+        await WEATHER_FLIGHTS.do(cache_key, refresh_weather_snapshot, env, cache_key, location, api_key)
+        METRICS.inc("weather_revalidations_total", result="refreshed")
+    except Exception as e:
+        METRICS.inc("weather_revalidations_total", result="failed")
+        log.info("Weather", "Background refresh for %s failed: %s", location, e)
+    finally:
+        WEATHER_REVALIDATING.discard(cache_key)
+
+
+def schedule_weather_revalidation(ctx, env, cache_key, location, api_key):
+    """Start a background refresh of an expired snapshot unless one is already running"""
+    if cache_key in WEATHER_REVALIDATING:
+        return
+    # Claimed before the task first runs, so concurrent requests can't start a second one
+    WEATHER_REVALIDATING.add(cache_key)
+    run_in_background(ctx, revalidate_weather_snapshot(env, cache_key, location, api_key))
+
+
+def build_weather_response(snapshot, units, timeframe):
+    """Derive the response for one timeframe and unit system from a snapshot"""
+    location_name = f"{snapshot.name}, {snapshot.country}"
+    
+    if timeframe in ["now", "today"]:
+        if not snapshot.has_current:
             raise Exception("Invalid weather data received: missing weather information")
         
         # Determine temperature and wind units
         if units == "imperial":
-            temp_unit = "°F"
-            wind_unit = "mph"
-            temp_value = data.get('current', {}).get('temp_f', 'N/A')
-            wind_value = data.get('current', {}).get('wind_mph', 'N/A')
+            temperature = f"{snapshot.temp_f}°F"
+            wind = f"{snapshot.wind_mph} mph"
         else:
-            temp_unit = "°C"
-            wind_unit = "kph"
-            temp_value = data.get('current', {}).get('temp_c', 'N/A')
-            wind_value = data.get('current', {}).get('wind_kph', 'N/A')
-        
-        if timeframe in ["now", "today"]:
-            # Current weather response
-            print(f"[Weather] Successfully fetched current weather for {data['location']['name']}")
-            return {
-                "location": f"{data['location']['name']}, {data['location']['country']}",
-                "temperature": f"{temp_value}{temp_unit}",
-                "condition": data['current']['condition']['text'],
-                "humidity": data['current']['humidity'],
-                "wind": f"{wind_value} {wind_unit}"
-            }
+            temperature = f"{snapshot.temp_c}°C"
+            wind = f"{snapshot.wind_kph} kph"
+        
+        # Current weather response
+        return {
+            "location": location_name,
+            "temperature": temperature,
+            "condition": snapshot.condition,
+            "humidity": snapshot.humidity,
+            "wind": wind
+        }
+    
+    # Forecast response: "tomorrow" keeps the 3-day view, "7d" the full week
+    days = TIMEFRAME_FORECAST_DAYS.get(timeframe, 3)
+    forecast_list = []
+    for day in snapshot.days[:days]:
+        if units == "imperial":
+            high = f"{day.maxtemp_f}°F"
+            low = f"{day.mintemp_f}°F"
         else:
-            # Forecast response
-            if 'forecast' not in data or 'forecastday' not in data['forecast']:
-                raise Exception("Forecast data not available for this location")
-            
-            forecast_list = []
-            for day in data['forecast']['forecastday']:
-                try:
-                    if units == "imperial":
-                        high = f"{day['day']['maxtemp_f']}°F"
-                        low = f"{day['day']['mintemp_f']}°F"
-                    else:
-                        high = f"{day['day']['maxtemp_c']}°C"
-                        low = f"{day['day']['mintemp_c']}°C"
-                    
-                    forecast_list.append({
-                        "date": day['date'],
-                        "condition": day['day']['condition']['text'],
-                        "high": high,
-                        "low": low
-                    })
-                except KeyError as ke:
-                    print(f"[Weather] Warning: Missing data in forecast day: {ke}")
-                    continue
-            
-            if not forecast_list:
-                raise Exception("No valid forecast data available")
-            
-            print(f"[Weather] Successfully fetched {len(forecast_list)}-day forecast for {data['location']['name']}")
-            return {
-                "location": f"{data['location']['name']}, {data['location']['country']}",
-                "forecast": forecast_list
-            }
+            high = f"{day.maxtemp_c}°C"
+            low = f"{day.mintemp_c}°C"
+        
+        forecast_list.append({
+            "date": day.date,
+            "condition": day.condition,
+            "high": high,
+            "low": low
+        })
+    
+    if not forecast_list:
+        raise Exception("No valid forecast data available")
+    
+    return {
+        "location": location_name,
+        "forecast": forecast_list
+    }
+
+
+async def get_weather(query_params, api_key, env=None, ctx=None):
+    """
+    Get weather data for a parsed query, derived from the location's cached
+    snapshot. A snapshot that expired within WEATHER_REVALIDATE_WINDOW is
+    served immediately and refreshed in the background (kept alive by
+    ctx.waitUntil). If the snapshot can't be refreshed because WeatherAPI is
+    failing, slow or behind an open breaker, the last known good snapshot is
+    used instead and the response is marked "stale", with its "as_of" time.
+    
+    The location is canonicalized (gazetteer place or geohash cell) first,
+    and locations WeatherAPI recently rejected raise LocationNotFound without
+    calling it.
+    """
+    try:
+        location = query_params.get("q", "")
+        units = query_params.get("units", "metric")
+        timeframe = query_params.get("timeframe", "now")
+        
+        if not location:
+            raise Exception("No location specified in query")
+        
+        location = canonical_location(location)
+        cache_key = weather_cache_key(location)
+        stale = False
+        snapshot, expired = await WEATHER_CACHE.lookup(env, cache_key, WEATHER_REVALIDATE_WINDOW)
+        if snapshot and expired:
+            log.debug("Weather", "Serving expired snapshot for %s while it is refreshed", location)
+            schedule_weather_revalidation(ctx, env, cache_key, location, api_key)
+        elif snapshot:
+            log.debug("Weather", "Snapshot cache hit for %s", location)
+        elif await NOT_FOUND_CACHE.get(env, cache_key):
+            log.debug("Weather", "Negative cache hit for %s", location)
+            raise LocationNotFound(f"Location '{location}' not found. Please check the spelling or try a different location.")
+        else:
+            try:
+                # Concurrent misses for the same location share one upstream fetch
+                snapshot = await WEATHER_FLIGHTS.do(cache_key, refresh_weather_snapshot, env, cache_key, location, api_key)
+            except LocationNotFound:
+                raise
+            except Exception as e:
+                snapshot = await WEATHER_CACHE.get_stale(env, cache_key)
+                if snapshot is None:
+                    raise
+                reason = "circuit_open" if isinstance(e, CircuitOpen) else "timeout" if isinstance(e, DeadlineExceeded) else "error"
+                METRICS.inc("stale_responses_total", reason=reason)
+                log.warning("Weather", "Serving last known weather for %s: %s", location, e)
+                stale = True
+        
+        # Only locations that resolved are counted, so unknown ones are never pre-warmed
+        track_location(ctx, env, cache_key, location)
+        response = build_weather_response(snapshot, units, timeframe)
+        if stale:
+            response["stale"] = True
+            response["as_of"] = snapshot.last_updated_epoch
+        return response
             
+    except (DeadlineExceeded, CircuitOpen):
+        raise
+    except WeatherAPIError as e:
+        raise WeatherAPIError(f"Weather fetch failed: {str(e)}")
     except Exception as e:
-        print(f"[Weather] Exception occurred: {str(e)}")
         # Re-raise the exception to be handled by the caller
         raise Exception(f"Weather fetch failed: {str(e)}")
 
 
-async def generate_limerick(location, weather_condition, temperature, account_id, api_token):
-    """Generate a limerick about the city and its weather"""
-    try:
-        print(f"[Limerick] Generating limerick for {location}")
-        
-        url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/ai/run/@cf/meta/llama-3-8b-instruct"
-        
-        prompt = f"""Write a fun, creative limerick (5-line poem with AABBA rhyme scheme) about {location} and its current weather. Make sure to include something about the regional cuisine and it's history.
+def track_location(ctx, env, cache_key, location):
+    """Count a request for a location, merging this isolate's counts into KV when due"""
+    POPULARITY.record(cache_key, location)
+    if POPULARITY.due():
+        run_in_background(ctx, POPULARITY.flush(env, POPULARITY.take()))
+
+
+async def compare_weather(query_params, api_key, env=None, ctx=None):
+    """
+    Weather for every location in a comparison query, fetched concurrently
+    through get_weather (so each location still uses the snapshot cache).
+    Locations that fail are reported inline; raises only if all of them fail,
+    re-raising DeadlineExceeded or CircuitOpen if that is why one failed, so
+    the caller still answers 504 or 503 rather than 400.
+    """
+    locations = query_params["locations"]
+    results = await asyncio.gather(
+        *[get_weather(dict(query_params, q=location), api_key, env, ctx) for location in locations],
+        return_exceptions=True
+    )
+    
+    comparison = []
+    for location, result in zip(locations, results):
+        if isinstance(result, Exception):
+            comparison.append({"location": location, "error": str(result)})
+        else:
+            comparison.append(result)
+    
+    if all("error" in entry for entry in comparison):
+        for result in results:
+            if isinstance(result, (DeadlineExceeded, CircuitOpen)):
+                raise result
+        raise Exception(comparison[0]["error"])
+    
+    return {
+        "location": " vs ".join(entry["location"] for entry in comparison),
+        "timeframe": query_params.get("timeframe", "now"),
+        "comparison": comparison
+    }
+
+
+async def get_weather_for_query(query_params, api_key, env=None, ctx=None):
+    """Weather for a parsed query: a single location, or a comparison of several"""
+    if query_params.get("locations"):
+        return await compare_weather(query_params, api_key, env, ctx)
+    return await get_weather(query_params, api_key, env, ctx)
+
+
+def build_limerick_request(location, weather_condition, temperature, account_id, api_token, stream=False):
+    """Build the Workers AI URL, headers and JSON body for a limerick request"""
+    url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/ai/run/@cf/meta/llama-3-8b-instruct"
+    
+    prompt = f"""Write a fun, creative limerick (5-line poem with AABBA rhyme scheme) about {location} and its current weather. Make sure to include something about the regional cuisine and it's history.
 
 Weather details:
 - Location: {location}
@@ -623,119 +1374,666 @@ Weather details:
 - Temperature: {temperature}
 
 Output ONLY the limerick, no other text."""
+    
+    payload = {
+        "messages": [
+            {"role": "system", "content": "You are a creative poet who writes fun limericks. Output only the limerick poem, nothing else."},
+            {"role": "user", "content": prompt}
+        ]
+    }
+    if stream:
+        payload["stream"] = True
+    
+    headers = Headers.new()
+    headers.set("Authorization", f"Bearer {api_token}")
+    headers.set("Content-Type", "application/json")
+    
+    return url, headers, json.dumps(payload)
+
+
+def clean_limerick(text):
+    """Strip whitespace and stray quotes the model sometimes wraps the poem in"""
+    return text.strip().strip('"').strip("'")
+
+
+async def generate_limerick(location, weather_condition, temperature, account_id, api_token):
+    """Generate a limerick about the city and its weather"""
+    try:
+        log.debug("Limerick", "Generating limerick for %s", location)
         
-        payload = {
-            "messages": [
-                {"role": "system", "content": "You are a creative poet who writes fun limericks. Output only the limerick poem, nothing else."},
-                {"role": "user", "content": prompt}
-            ]
-        }
-        
-        headers = Headers.new()
-        headers.set("Authorization", f"Bearer {api_token}")
-        headers.set("Content-Type", "application/json")
-        
-        response = await fetch(url, method="POST", headers=headers, body=json.dumps(payload))
-        
-        if not response.ok:
-            print(f"[Limerick] Warning: Failed to generate limerick (HTTP {response.status})")
-            return None
+        url, headers, body = build_limerick_request(location, weather_condition, temperature, account_id, api_token)
         
-        result_js = await response.json()
-        # Convert JsProxy to Python dict for easier access
-        result = result_js.to_py()
+        with log.stage("limerick_ai"):
+            response = await fetch_upstream("limerick_ai", url, method="POST", headers=headers, body=body)
+            
+            if not response.ok:
+                log.warning("Limerick", "Failed to generate limerick (HTTP %s)", response.status)
+                return None
+            
+            result_js = await response.json()
+        # Read only the fields we need instead of converting the whole response
+        result = getattr(result_js, 'result', None)
         
-        if result.get("success") and result.get("result"):
-            limerick = result["result"]["response"].strip().strip('"').strip("'")
-            print(f"[Limerick] Successfully generated limerick")
-            return limerick
+        if getattr(result_js, 'success', False) and result is not None and getattr(result, 'response', None):
+            return clean_limerick(result.response)
         else:
-            print(f"[Limerick] Warning: No limerick in response")
+            log.warning("Limerick", "No limerick in response")
             return None
             
     except Exception as e:
-        print(f"[Limerick] Non-critical error: {str(e)}")
+        log.warning("Limerick", "Non-critical error: %s", e)
         # Limerick generation is optional, so don't raise exception
         return None
 
 
+def limerick_cache_key(location, weather_condition, temperature):
+    """
+    Cache key for limericks: canonical location, condition text and a
+    temperature bucket, so nearly identical weather shares a pool of variants
+    """
+    match = re.match(r"\s*(-?\d+(?:\.\d+)?)\s*°?\s*([CF])?", str(temperature))
+    if match:
+        degrees = float(match.group(1))
+        if match.group(2) == "F":
+            degrees = (degrees - 32) * 5 / 9
+        bucket = str(int(degrees // LIMERICK_TEMPERATURE_BUCKET))
+    else:
+        bucket = "na"
+    
+    canonical = "|".join([
+        re.sub(r"\s+", " ", str(location).lower()).strip(" ,."),
+        re.sub(r"\s+", " ", str(weather_condition).lower()).strip(),
+        bucket
+    ])
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32]
+
+
+async def get_cached_limerick(env, cache_key):
+    """
+    Return a random variant once the key's pool is full. While the pool is
+    still filling, return None so a fresh limerick is generated and added.
+    """
+    pool = await LIMERICK_CACHE.get(env, cache_key)
+    if pool and len(pool) >= LIMERICK_POOL_SIZE:
+        LIMERICK_STATS["hits"] += 1
+        log.debug("Limerick", "Cache hit (%d variants)", len(pool))
+        return random.choice(pool)
+    LIMERICK_STATS["misses"] += 1
+    return None
+
+
+async def store_limerick(env, cache_key, limerick):
+    """Add a freshly generated limerick to its key's pool of variants"""
+    if not limerick:
+        return
+    pool = list(await LIMERICK_CACHE.get(env, cache_key) or [])
+    pool = (pool + [limerick])[-LIMERICK_POOL_SIZE:]
+    await LIMERICK_CACHE.set(env, cache_key, pool)
+
+
+def limerick_hit_rate():
+    total = LIMERICK_STATS["hits"] + LIMERICK_STATS["misses"]
+    return LIMERICK_STATS["hits"] / total if total else 0.0
+
+
+async def get_limerick(env, location, weather_condition, temperature, account_id, api_token):
+    """Limerick for the location and weather, from the limerick cache or Workers AI"""
+    cache_key = limerick_cache_key(location, weather_condition, temperature)
+    limerick = await get_cached_limerick(env, cache_key)
+    if limerick:
+        return limerick
+    
+    # Concurrent requests for the same key share one generated variant
+    return await LIMERICK_FLIGHTS.do(
+        cache_key, generate_and_store_limerick,
+        env, cache_key, location, weather_condition, temperature, account_id, api_token
+    )
+
+
+async def generate_and_store_limerick(env, cache_key, location, weather_condition, temperature, account_id, api_token):
+    limerick = await generate_limerick(location, weather_condition, temperature, account_id, api_token)
+    await store_limerick(env, cache_key, limerick)
+    return limerick
+
+
+async def stream_limerick(location, weather_condition, temperature, account_id, api_token):
+    """
+    Generate a limerick with Workers AI streaming enabled, yielding text
+    tokens as they arrive. Workers AI streams server-sent events of the form
+    'data: {"response": "..."}' terminated by 'data: [DONE]'.
+    """
+    log.debug("Limerick", "Streaming limerick for %s", location)
+    
+    url, headers, body = build_limerick_request(location, weather_condition, temperature, account_id, api_token, stream=True)
+    
+    response = await fetch_upstream("limerick_ai", url, method="POST", headers=headers, body=body)
+    
+    if not response.ok or response.body is None:
+        raise Exception(f"Failed to stream limerick (HTTP {response.status})")
+    
+    reader = response.body.getReader()
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    while True:
+        chunk = await reader.read()
+        if chunk.done:
+            break
+        buffer += decoder.decode(chunk.value.to_bytes()).replace("\r\n", "\n")
+        
+        # Events are separated by blank lines; keep any partial event buffered
+        *events, buffer = buffer.split("\n\n")
+        for event in events:
+            for line in event.splitlines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    return
+                token = json.loads(data).get("response")
+                if token:
+                    yield token
+
+
 async def get_global_history(env):
     """Retrieve global chat history from KV"""
     try:
-        stored = await env.CHAT_HISTORY.get("global_chat_history")
-        if stored:
-            history = json.loads(stored)
-            print(f"[KV] Retrieved {len(history)} entries from global history")
-            return history
-        return []
+        with log.stage("kv"):
+            stored = await env.CHAT_HISTORY.get("global_chat_history")
+        return json.loads(stored) if stored else []
     except Exception as e:
-        print(f"[KV] Error getting history: {e}")
+        log.warning("KV", "Error getting history: %s", e)
         return []
 
 
-async def save_to_global_history(env, query, response_data):
-    """Save conversation to global KV, keeping last 4 entries"""
+def cache_history_response(history):
+    """Serialise history once and keep it, with its ETag, for GET /api/history"""
+    body = json.dumps(history)
+    HISTORY_RESPONSE_CACHE["body"] = body
+    HISTORY_RESPONSE_CACHE["etag"] = '"' + hashlib.sha256(body.encode("utf-8")).hexdigest()[:32] + '"'
+    HISTORY_RESPONSE_CACHE["expires_at"] = time.time() + HISTORY_RESPONSE_TTL
+    return HISTORY_RESPONSE_CACHE["body"], HISTORY_RESPONSE_CACHE["etag"]
+
+
+async def get_history_response(env):
+    """
+    Serialised history and its ETag. Served from memory for a few seconds;
+    this isolate's own writes update it immediately, other isolates' writes
+    are picked up when it expires.
+    """
+    if HISTORY_RESPONSE_CACHE["body"] is not None and HISTORY_RESPONSE_CACHE["expires_at"] > time.time():
+        return HISTORY_RESPONSE_CACHE["body"], HISTORY_RESPONSE_CACHE["etag"]
+    return cache_history_response(await get_global_history(env))
+
+
+def etag_matches(if_none_match, etag):
+    """If-None-Match check (weak comparison, as RFC 9110 requires for this header)"""
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in [tag[2:] if tag.startswith("W/") else tag for tag in candidates]
+
+
+async def save_to_global_history(env, entries):
+    """Append a batch of entries to the global KV history, keeping last 4 entries"""
     try:
-        # Debug: Check if binding exists
-        print(f"[KV DEBUG] env has CHAT_HISTORY: {hasattr(env, 'CHAT_HISTORY')}")
-        if hasattr(env, 'CHAT_HISTORY'):
-            print(f"[KV DEBUG] CHAT_HISTORY type: {type(env.CHAT_HISTORY)}")
-        
         # Get existing global history
         history = await get_global_history(env)
         
-        # Create new entry
-        entry = {
-            "query": query,
-            "location": response_data.get("location", "Unknown"),
-            "timestamp": datetime.now().isoformat(),
-            "type": "forecast" if "forecast" in response_data else "current"
-        }
+        # Add to history, keeping only last 4 entries globally
+        history = (history + entries)[-4:]
         
-        # Add to history
-        history.append(entry)
-        
-        # Keep only last 4 entries globally
-        history = history[-4:]
+        # Save back to KV (no expiration - persists indefinitely)
+        with log.stage("kv"):
+            await env.CHAT_HISTORY.put("global_chat_history", json.dumps(history))
+        cache_history_response(history)
         
-        # Debug: Show what we're about to save
-        data_to_save = json.dumps(history)
-        print(f"[KV DEBUG] About to save {len(data_to_save)} bytes to key 'global_chat_history'")
-        print(f"[KV DEBUG] Data preview: {data_to_save[:100]}...")
+        log.debug("KV", "Saved %d entries to global history", len(entries))
+        return True
+    except Exception as e:
+        log.warning("KV", "Error saving history: %s", e)
+        return False
+
+
+def queue_history(ctx, env, query, response_data):
+    """
+    Queue a conversation for the global history without blocking the response.
+    
+    Entries queued within HISTORY_FLUSH_WINDOW seconds are written by a single
+    background flush, so an isolate does one KV read-modify-write per window
+    instead of one per request, and its own concurrent appends can't clobber
+    each other.
+    """
+    global HISTORY_FLUSH
+    
+    PENDING_HISTORY.append({
+        "query": query,
+        "location": response_data.get("location", "Unknown"),
+        "timestamp": datetime.now().isoformat(),
+        "type": "comparison" if "comparison" in response_data else "forecast" if "forecast" in response_data else "current"
+    })
+    
+    if HISTORY_FLUSH is None or HISTORY_FLUSH.done():
+        HISTORY_FLUSH = run_in_background(ctx, flush_history(env))
+    elif ctx is not None:
+        # Keep this invocation alive until the shared flush has finished too
+        ctx.waitUntil(create_proxy(HISTORY_FLUSH))
+
+
+async def flush_history(env):
+    """
+    Wait for the batching window, then write all pending history entries at
+    once. Entries queued while a write is in flight joined this flush rather
+    than starting their own, so keep going until none are left.
+    """
+    while PENDING_HISTORY:
+        await asyncio.sleep(HISTORY_FLUSH_WINDOW)
+        entries = PENDING_HISTORY[:]
+        del PENDING_HISTORY[:]
+        await save_to_global_history(env, entries)
+
+
+def run_in_background(ctx, coro):
+    """
+    Run a coroutine without holding up the response. With a Workers execution
+    context the invocation is kept alive via ctx.waitUntil until it finishes.
+    """
+    task = asyncio.ensure_future(coro)
+    if ctx is not None:
+        ctx.waitUntil(create_proxy(task))
+    return task
+
+
+def wants_stream(request, data):
+    """Streaming is requested with {"stream": true} or an NDJSON Accept header"""
+    accept = request.headers.get("Accept") or ""
+    return bool(data.get("stream")) or "application/x-ndjson" in accept
+
+
+async def write_chat_stream(ctx, writer, env, user_query, weather_data, account_id, api_token, deadline, history=True):
+    """
+    Write the staged NDJSON events for a streamed /chat response: the weather
+    first, then limerick tokens as Workers AI produces them, then the final
+    limerick. The limerick is cut off (and sent as null) if it would overrun
+    the request deadline. History is saved once the limerick is complete,
+    unless history is False (geolocated answers).
+    """
+    encoder = TextEncoder.new()
+    
+    async def send(event):
+        await writer.write(encoder.encode(json.dumps(event) + "\n"))
+    
+    try:
+        await send({"type": "weather", "data": weather_data})
         
-        # Save back to KV (no expiration - persists indefinitely)
-        put_result = await env.CHAT_HISTORY.put(
-            "global_chat_history",
-            data_to_save
-        )
+        # Stream the limerick (non-critical, errors are swallowed)
+        location = weather_data.get('location', 'Unknown')
+        condition = weather_data.get('condition', 'unknown weather')
+        temperature = weather_data.get('temperature', 'unknown temperature')
+        cache_key = limerick_cache_key(location, condition, temperature)
+        tokens = []
+        try:
+            weather_data['limerick'] = await get_cached_limerick(env, cache_key)
+            if not weather_data['limerick']:
+                async def stream_tokens():
+                    async for token in stream_limerick(location, condition, temperature, account_id, api_token):
+                        tokens.append(token)
+                        await send({"type": "limerick_token", "text": token})
+                
+                await deadline.run(stream_tokens(), "limerick", minimum=MIN_LIMERICK_BUDGET)
+                weather_data['limerick'] = clean_limerick("".join(tokens)) or None
+                await store_limerick(env, cache_key, weather_data['limerick'])
+        except DeadlineExceeded as e:
+            METRICS.inc("deadline_exceeded_total", stage="limerick")
+            log.info("Main", "Limerick dropped: %s", e)
+            weather_data['limerick'] = None
+        except Exception as e:
+            log.warning("Main", "Limerick streaming error (non-critical): %s", e)
+            weather_data['limerick'] = None
         
-        print(f"[KV DEBUG] Put result: {put_result}")
-        print(f"[KV] Saved to global history. Total entries: {len(history)}")
+        await send({"type": "limerick", "text": weather_data['limerick']})
+        await send({"type": "done"})
+    except Exception as e:
+        # Usually the client went away mid-stream
+        log.info("Main", "Stream write error: %s", e)
+    finally:
+        try:
+            await writer.close()
+        except Exception:
+            pass
+    
+    # Queue for the global conversation history (KV storage)
+    if history:
+        queue_history(ctx, env, user_query, weather_data)
+
+
+def stream_chat_response(ctx, env, user_query, weather_data, account_id, api_token, deadline, history=True):
+    """Return an NDJSON streaming response and write its events in the background"""
+    stream = TransformStream.new()
+    writer = stream.writable.getWriter()
+    run_in_background(ctx, write_chat_stream(ctx, writer, env, user_query, weather_data, account_id, api_token, deadline, history))
+    
+    headers = Headers.new()
+    headers.set("Content-Type", "application/x-ndjson")
+    headers.set("Cache-Control", "no-cache")
+    return Response.new(stream.readable, status=200, headers=headers)
+
+
+async def resolve_batch_item(env, item, account_id, api_token):
+    """Query params for a batch item: a query string or a {"q", "units", "timeframe"} object"""
+    if isinstance(item, dict) and str(item.get("q") or "").strip():
+        return build_query_params(str(item["q"]).strip(), item.get("units"), item.get("timeframe"))
+    
+    query = item.get("query") if isinstance(item, dict) else item
+    if isinstance(query, str) and query.strip():
+        return await parse_query(env, query.strip(), account_id, api_token)
+    
+    raise Exception("Each item must be a query string or an object with a \"q\" location")
+
+
+async def process_batch_item(ctx, env, item, semaphore, account_id, api_token, weather_api_key, include_limerick):
+    """Resolve, fetch and optionally add a limerick to one batch item; errors are reported per item"""
+    async with semaphore:
+        try:
+            query_params = await resolve_batch_item(env, item, account_id, api_token)
+            weather_data = await get_weather_for_query(query_params, weather_api_key, env, ctx)
+        except Exception as e:
+            return {"ok": False, "error": str(e)}
         
-        # Verify it was saved by reading it back immediately
-        verify = await env.CHAT_HISTORY.get("global_chat_history")
-        if verify:
-            print(f"[KV DEBUG] Verification: Successfully read back {len(verify)} bytes")
-        else:
-            print(f"[KV DEBUG] WARNING: Verification failed - could not read back the data!")
+        if include_limerick and "comparison" not in weather_data:
+            # Non-critical, as for /chat
+            try:
+                weather_data['limerick'] = await get_limerick(
+                    env,
+                    weather_data.get('location', query_params.get('q', 'Unknown')),
+                    weather_data.get('condition', 'unknown weather'),
+                    weather_data.get('temperature', 'unknown temperature'),
+                    account_id,
+                    api_token
+                )
+            except Exception as e:
+                log.warning("Batch", "Limerick generation error (non-critical): %s", e)
+                weather_data['limerick'] = None
         
-        return True
+        return {"ok": True, "data": weather_data}
+
+
+async def run_batch(ctx, env, items, concurrency, include_limerick, account_id, api_token, weather_api_key):
+    """
+    Process batch items concurrently, at most `concurrency` at a time.
+    Results come back in item order; batch queries are not added to history.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(*[
+        process_batch_item(ctx, env, item, semaphore, account_id, api_token, weather_api_key, include_limerick)
+        for item in items
+    ])
+    for index, result in enumerate(results):
+        result["index"] = index
+    return results
+
+
+def weather_api_headers(max_age):
+    headers = Headers.new()
+    headers.set("Content-Type", "application/json")
+    headers.set("Access-Control-Allow-Origin", "*")
+    headers.set("Cache-Control", f"public, max-age={max_age}")
+    headers.set("Vary", "Accept-Encoding")
+    return headers
+
+
+def geolocated_response(response):
+    """
+    A response answered from the caller's request.cf location: its URL is the
+    same for every caller, so browsers and any CDN in front must not share it
+    """
+    response.headers.set("Cache-Control", "private, no-store")
+    return response
+
+
+def weather_api_error(message, status, retry_after=None):
+    headers = Headers.new()
+    headers.set("Content-Type", "application/json")
+    headers.set("Access-Control-Allow-Origin", "*")
+    headers.set("Cache-Control", "no-store")
+    if retry_after:
+        headers.set("Retry-After", str(int(retry_after)))
+    return Response.new(json.dumps({"error": message}), status=status, headers=headers)
+
+
+async def put_edge_cache(cache_url, response):
+    try:
+        await caches.default.put(cache_url, response)
     except Exception as e:
-        print(f"[KV] Error saving history: {e}")
-        import traceback
-        print(f"[KV DEBUG] Full traceback: {traceback.format_exc()}")
-        return False
+        log.warning("API", "Error storing %s in the edge cache: %s", cache_url, e)
+
+
+async def weather_api_response(request, env, ctx):
+    """
+    GET /api/weather?q=&units=&timeframe= - weather for one location, without
+    the LLM. q is canonicalized (gazetteer place or geohash cell, or the
+    request.cf location when omitted) and the canonical URL is looked up in
+    caches.default first. Misses call get_weather and store the compact,
+    key-sorted JSON body in the edge cache in the background. Responses to
+    requests without q are marked private, since they depend on the caller.
+    """
+    url = urlsplit(request.url)
+    params = parse_qs(url.query)
+    location = params.get("q", [""])[0].strip()
+    units = params.get("units", ["metric"])[0]
+    timeframe = params.get("timeframe", ["now"])[0]
+    if units not in WEATHER_API_UNITS:
+        return weather_api_error(f"\"units\" must be one of: {', '.join(WEATHER_API_UNITS)}", 400)
+    if timeframe not in WEATHER_API_TIMEFRAMES:
+        return weather_api_error(f"\"timeframe\" must be one of: {', '.join(WEATHER_API_TIMEFRAMES)}", 400)
+    geolocated = not location
+    if geolocated:
+        coordinates = request_coordinates(request)
+        if coordinates is None:
+            return weather_api_error("\"q\" is required (a place name or \"lat,lon\")", 400)
+        location = geo_location(*coordinates)
+    
+    location = canonical_location(location)
+    query = urlencode([("q", location), ("timeframe", timeframe), ("units", units)])
+    cache_url = f"{url.scheme}://{url.netloc}/api/weather?{query}"
+    cached = await caches.default.match(cache_url)
+    if cached is not None:
+        METRICS.inc("edge_cache_total", result="hit")
+        log.annotate(edge_cache="hit")
+        # Cached responses have immutable headers; copy them so Server-Timing can be added
+        response = Response.new(cached.body, status=cached.status, headers=Headers.new(cached.headers))
+        return geolocated_response(response) if geolocated else response
+    METRICS.inc("edge_cache_total", result="miss")
+    log.annotate(edge_cache="miss")
+    
+    weather_api_key = getattr(env, "WEATHER_API_KEY", None)
+    if not weather_api_key:
+        log.error("API", "Configuration error: Missing WEATHER_API_KEY")
+        return weather_api_error("Server configuration error. Please contact the administrator.", 500)
+    
+    deadline = Deadline(REQUEST_DEADLINE)
+    query_params = {"intent": "get_weather", "q": location, "units": units, "timeframe": timeframe}
+    try:
+        with log.stage("weather"):
+            weather = await deadline.run(get_weather(query_params, weather_api_key, env, ctx), "weather", STAGE_BUDGETS["weather"])
+    except DeadlineExceeded as e:
+        METRICS.inc("deadline_exceeded_total", stage="weather")
+        log.warning("API", "Weather deadline exceeded: %s", e)
+        return weather_api_error("The weather service took too long to respond. Please try again.", 504)
+    except CircuitOpen as e:
+        log.info("API", "Weather unavailable: %s", e)
+        return weather_api_error(
+            "The weather service is temporarily unavailable. Please try again shortly.", 503, BREAKERS["weatherapi"].open_seconds
+        )
+    except WeatherAPIError as e:
+        # Upstream's fault, not the request's
+        log.warning("API", "Weather upstream error: %s", e)
+        return weather_api_error(str(e), 502)
+    except Exception as e:
+        log.info("API", "Weather fetch error: %s", e)
+        return weather_api_error(str(e), 400)
+    
+    max_age = WEATHER_API_MIN_MAX_AGE
+    entry = WEATHER_CACHE.memory.get_entry(weather_cache_key(location))
+    if entry is not None and not weather.get("stale"):
+        max_age = max(int(entry[0] - time.time()), WEATHER_API_MIN_MAX_AGE)
+    
+    body = json.dumps(weather, sort_keys=True, separators=(",", ":"))
+    run_in_background(ctx, put_edge_cache(cache_url, Response.new(body, status=200, headers=weather_api_headers(max_age))))
+    response = Response.new(body, status=200, headers=weather_api_headers(max_age))
+    return geolocated_response(response) if geolocated else response
+
+
+async def get_top_locations(env, limit):
+    """The merged popularity ranking from KV, as returned by GET /api/top-locations"""
+    merged, updated = await POPULARITY.load(env)
+    if merged is None:
+        return {"updated": None, "total": 0, "max_overestimate": 0, "locations": []}
+    return {
+        "updated": datetime.fromtimestamp(updated).isoformat(),
+        "total": merged.sketch.total,
+        # Counts are estimates: never low, and at most this much too high (with high probability)
+        "max_overestimate": merged.sketch.error_bound(),
+        "locations": [{"location": location, "count": count} for _, location, count in merged.ranked(limit)],
+    }
+
+
+def record_request_metrics(timer, method, path, status):
+    """Count the request and add its total and per-stage durations to the histograms"""
+    route = path if path in METRICS_ROUTES else "other"
+    METRICS.inc("requests_total", route=route, method=method, status=str(status))
+    METRICS.observe("request_duration_seconds", timer.elapsed_ms(), route=route)
+    for name, duration in timer.stages.items():
+        METRICS.observe("stage_duration_seconds", duration, stage=name)
+
 
+def collect_metrics():
+    """Metric families read from the existing stats counters at scrape time"""
+    caches = {"parse": PARSE_CACHE, "weather": WEATHER_CACHE, "not_found": NOT_FOUND_CACHE, "limerick": LIMERICK_CACHE}
+    flights = {"parse_ai": PARSE_FLIGHTS, "weatherapi": WEATHER_FLIGHTS, "limerick_ai": LIMERICK_FLIGHTS}
+    return [
+        ("parse_total", "counter", [({"source": source}, count) for source, count in PARSE_STATS.items()]),
+        ("parse_fast_path_ratio", "gauge", [({}, fast_path_hit_rate())]),
+        ("cache_lookups_total", "counter", [
+            ({"cache": name, "result": result}, cache.stats[result])
+            for name, cache in caches.items() for result in ("memory_hits", "kv_hits", "stale_hits", "misses")
+        ]),
+        ("cache_kv_errors_total", "counter", [({"cache": name}, cache.stats["kv_errors"]) for name, cache in caches.items()]),
+        ("cache_hit_ratio", "gauge", [({"cache": name}, cache.hit_rate()) for name, cache in caches.items()]),
+        ("cache_entries", "gauge", [({"cache": name}, len(cache.memory)) for name, cache in caches.items()]),
+        ("upstream_calls_total", "counter", [
+            ({"upstream": name, "result": result}, flight.stats[result])
+            for name, flight in flights.items() for result in ("calls", "coalesced")
+        ]),
+        ("limerick_pool_total", "counter", [({"result": result}, count) for result, count in LIMERICK_STATS.items()]),
+        ("limerick_pool_hit_ratio", "gauge", [({}, limerick_hit_rate())]),
+        ("history_responses_total", "counter", [({"result": result}, count) for result, count in HISTORY_RESPONSE_STATS.items()]),
+        ("circuit_state", "gauge", [({"upstream": name}, CIRCUIT_STATES[breaker.state]) for name, breaker in BREAKERS.items()]),
+        ("circuit_opened_total", "counter", [({"upstream": name}, breaker.stats["opened"]) for name, breaker in BREAKERS.items()]),
+        ("circuit_rejected_total", "counter", [({"upstream": name}, breaker.stats["rejected"]) for name, breaker in BREAKERS.items()]),
+    ]
+
+
+def env_int(env, name, default):
+    """Integer env var, or default if it is unset or not a number"""
+    try:
+        return int(getattr(env, name, None) or default)
+    except (TypeError, ValueError):
+        return default
+
+
+async def prewarm_location(env, cache_key, location, semaphore, include_limerick):
+    """Refresh one location's snapshot and, optionally, add a limerick to its pool"""
+    async with semaphore:
+        snapshot = await WEATHER_FLIGHTS.do(
+            cache_key, refresh_weather_snapshot, env, cache_key, location, env.WEATHER_API_KEY
+        )
+        if include_limerick:
+            # Keyed like a metric "now" /chat request, the most common kind
+            weather = build_weather_response(snapshot, "metric", "now")
+            await get_limerick(
+                env, weather["location"], weather["condition"], weather["temperature"],
+                getattr(env, "CF_ACCOUNT_ID", None), getattr(env, "CF_API_TOKEN", None)
+            )
 
-async def on_fetch(request, env):
+
+async def prewarm_popular_locations(env):
+    """
+    Refresh the snapshots of the most-requested locations before they
+    expire, within the per-run WeatherAPI budget. Returns a summary dict.
+    """
+    top_n = env_int(env, "PREWARM_TOP_N", PREWARM_TOP_N)
+    budget = env_int(env, "PREWARM_BUDGET", PREWARM_BUDGET)
+    include_limericks = str(getattr(env, "PREWARM_LIMERICKS", "false")).lower() == "true"
+    
+    # This isolate's own counts go in first
+    await POPULARITY.flush(env, POPULARITY.take())
+    
+    due = []
+    for cache_key, location, count in await POPULARITY.top(env, top_n):
+        if await NOT_FOUND_CACHE.get(env, cache_key):
+            # Counted before WeatherAPI rejected it; warming would only repeat the 400
+            continue
+        expires_in = await WEATHER_CACHE.expires_in(env, cache_key)
+        if expires_in is None or expires_in < PREWARM_HORIZON:
+            due.append((cache_key, location))
+    
+    # Most popular first; whatever is over budget waits for the next run
+    selected = due[:budget]
+    semaphore = asyncio.Semaphore(PREWARM_CONCURRENCY)
+    results = await asyncio.gather(
+        *[prewarm_location(env, cache_key, location, semaphore, include_limericks) for cache_key, location in selected],
+        return_exceptions=True
+    )
+    
+    summary = {"due": len(due), "warmed": 0, "failed": 0, "deferred": len(due) - len(selected)}
+    for (cache_key, location), result in zip(selected, results):
+        if isinstance(result, Exception):
+            summary["failed"] += 1
+            log.warning("Prewarm", "Failed to warm %s: %s", location, result)
+        else:
+            summary["warmed"] += 1
+    for result in ("warmed", "failed", "deferred"):
+        if summary[result]:
+            METRICS.inc("prewarm_total", summary[result], result=result)
+    log.info("Prewarm", "%d due, %d warmed, %d failed, %d deferred",
+             summary["due"], summary["warmed"], summary["failed"], summary["deferred"])
+    return summary
+
+
+async def on_scheduled(controller, env, ctx=None):
+    """Cron trigger handler: pre-warm the weather cache for popular locations"""
+    log.configure_logging(env)
+    configure_hedging(env)
+    if not getattr(env, "WEATHER_API_KEY", None):
+        log.error("Prewarm", "Configuration error: Missing WEATHER_API_KEY")
+        return
+    await prewarm_popular_locations(env)
+
+
+async def on_fetch(request, env, ctx=None):
     """Main fetch handler for Cloudflare Workers"""
     url = request.url
     method = request.method
     
-    # Parse URL
-    path = url.split('://')[1].split('/')[1:] if '://' in url else []
-    path = '/' + '/'.join(path) if path else '/'
+    # Parse URL (the query string is not part of the route)
+    path = urlsplit(url).path or '/'
+    
+    log.configure_logging(env)
+    configure_hedging(env)
+    timer, token = log.start_request()
+    try:
+        response = await route_request(request, env, ctx, method, path)
+    finally:
+        log.finish_request(token)
     
+    response.headers.set("Server-Timing", timer.server_timing())
+    log.log_request(timer, method, path, response.status)
+    record_request_metrics(timer, method, path, response.status)
+    return response
+
+
+async def route_request(request, env, ctx, method, path):
+    """Dispatch a request to its route handler"""
     # GET /api/history - return chat history as JSON
     if method == "GET" and path == '/api/history':
         headers = Headers.new()
@@ -743,29 +2041,128 @@ async def on_fetch(request, env):
         headers.set("Access-Control-Allow-Origin", "*")
         
         try:
-            history = await get_global_history(env)
-            return Response.new(json.dumps(history), status=200, headers=headers)
+            body, etag = await get_history_response(env)
         except Exception as e:
-            print(f"[API] Error fetching history: {e}")
+            log.warning("API", "Error fetching history: %s", e)
             return Response.new(json.dumps([]), status=200, headers=headers)
+        
+        # Let browsers and the CDN absorb polling: fresh for a few seconds,
+        # then revalidated with If-None-Match
+        headers.set("ETag", etag)
+        headers.set("Cache-Control", f"public, max-age={HISTORY_RESPONSE_TTL}, stale-while-revalidate={HISTORY_STALE_WHILE_REVALIDATE}")
+        
+        if etag_matches(request.headers.get("If-None-Match"), etag):
+            HISTORY_RESPONSE_STATS["not_modified"] += 1
+            return Response.new(None, status=304, headers=headers)
+        
+        HISTORY_RESPONSE_STATS["ok"] += 1
+        return Response.new(body, status=200, headers=headers)
+    
+    # GET /api/metrics - Prometheus text format
+    if method == "GET" and path == '/api/metrics':
+        token = getattr(env, "METRICS_TOKEN", None)
+        if token and request.headers.get("Authorization") != f"Bearer {token}":
+            return Response.new("Unauthorized", status=401)
+        
+        headers = Headers.new()
+        headers.set("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        headers.set("Cache-Control", "no-store")
+        return Response.new(METRICS.render(collect_metrics()), status=200, headers=headers)
+    
+    # GET /api/top-locations?limit=N - most-requested locations with estimated counts
+    if method == "GET" and path == '/api/top-locations':
+        headers = Headers.new()
+        headers.set("Content-Type", "application/json")
+        headers.set("Access-Control-Allow-Origin", "*")
+        
+        params = parse_qs(urlsplit(request.url).query)
+        try:
+            limit = int(params.get("limit", [TOP_LOCATIONS_DEFAULT_LIMIT])[0])
+        except ValueError:
+            return Response.new(json.dumps({"error": "\"limit\" must be a number"}), status=400, headers=headers)
+        limit = min(max(limit, 1), POPULARITY.k)
+        
+        headers.set("Cache-Control", f"public, max-age={TOP_LOCATIONS_MAX_AGE}")
+        return Response.new(json.dumps(await get_top_locations(env, limit)), status=200, headers=headers)
+    
+    # GET /api/weather?q=&units=&timeframe= - weather without the LLM, cached at the edge
+    if method == "GET" and path == '/api/weather':
+        return await weather_api_response(request, env, ctx)
+    
+    # POST /api/chat/batch - weather for many queries in one request
+    if method == "POST" and path == '/api/chat/batch':
+        # One batch can cost 100 Workers AI parses, so dashboards can be given a token
+        token = getattr(env, "BATCH_TOKEN", None)
+        if token and request.headers.get("Authorization") != f"Bearer {token}":
+            return Response.new("Unauthorized", status=401)
+        
+        headers = Headers.new()
+        headers.set("Content-Type", "application/json")
+        
+        try:
+            data = json.loads(await request.text())
+            items = data.get("items")
+            if not isinstance(items, list) or not items:
+                raise Exception("\"items\" must be a non-empty list")
+            if len(items) > BATCH_MAX_ITEMS:
+                raise Exception(f"At most {BATCH_MAX_ITEMS} items per batch")
+            concurrency = min(max(int(data.get("concurrency") or BATCH_DEFAULT_CONCURRENCY), 1), BATCH_MAX_CONCURRENCY)
+            include_limerick = data.get("limericks") is True
+        except Exception as e:
+            log.info("Batch", "Invalid request: %s", e)
+            return Response.new(json.dumps({"error": f"Invalid batch request: {str(e)}"}), status=400, headers=headers)
+        
+        cf_account_id = getattr(env, "CF_ACCOUNT_ID", None)
+        cf_api_token = getattr(env, "CF_API_TOKEN", None)
+        weather_api_key = getattr(env, "WEATHER_API_KEY", None)
+        if not all([cf_account_id, cf_api_token, weather_api_key]):
+            log.error("Batch", "Configuration error: Missing API credentials")
+            return Response.new(
+                json.dumps({"error": "Server configuration error. Please contact the administrator."}),
+                status=500,
+                headers=headers
+            )
+        
+        log.annotate(items=len(items), concurrency=concurrency)
+        results = await run_batch(ctx, env, items, concurrency, include_limerick, cf_account_id, cf_api_token, weather_api_key)
+        succeeded = sum(1 for result in results if result["ok"])
+        return Response.new(
+            json.dumps({"results": results, "succeeded": succeeded, "failed": len(results) - succeeded}),
+            status=200,
+            headers=headers
+        )
     
     # GET / or /chat - return HTML interface
     if method == "GET" and path in ['/', '/chat']:
+        encoding = choose_encoding(request.headers.get("Accept-Encoding"), CHAT_PAGE)
+        page = CHAT_PAGE[encoding]
+        
         headers = Headers.new()
-        headers.set("Content-Type", "text/html")
-        return Response.new(HTML_TEMPLATE, status=200, headers=headers)
+        headers.set("Content-Type", "text/html; charset=utf-8")
+        headers.set("ETag", page["etag"])
+        headers.set("Vary", "Accept-Encoding")
+        headers.set("Cache-Control", f"public, max-age={CHAT_PAGE_MAX_AGE}, stale-while-revalidate={CHAT_PAGE_STALE_WHILE_REVALIDATE}")
+        
+        if etag_matches(request.headers.get("If-None-Match"), page["etag"]):
+            return Response.new(None, status=304, headers=headers)
+        
+        if encoding == "identity":
+            return Response.new(to_js(page["body"]), status=200, headers=headers)
+        
+        # The body is already compressed, so stop the runtime encoding it again
+        headers.set("Content-Encoding", encoding)
+        return Response.new(to_js(page["body"]), status=200, headers=headers, encodeBody="manual")
     
     # POST /chat - handle weather query
     elif method == "POST" and path == '/chat':
+        deadline = Deadline(REQUEST_DEADLINE)
         try:
-            print(f"[Main] Received POST request to /chat")
-            
             # Parse request body
             try:
                 body = await request.text()
                 data = json.loads(body)
             except Exception as e:
-                print(f"[Main] Error parsing request body: {str(e)}")
+                log.info("Main", "Error parsing request body: %s", e)
                 headers = Headers.new()
                 headers.set("Content-Type", "application/json")
                 return Response.new(
@@ -777,7 +2174,7 @@ async def on_fetch(request, env):
             user_query = data.get('query', '').strip()
             
             if not user_query:
-                print(f"[Main] Error: Empty query")
+                log.info("Main", "Empty query")
                 headers = Headers.new()
                 headers.set("Content-Type", "application/json")
                 return Response.new(
@@ -786,7 +2183,7 @@ async def on_fetch(request, env):
                     headers=headers
                 )
             
-            print(f"[Main] Processing query: {user_query}")
+            log.debug("Main", "Processing query: %s", user_query)
             
             # Get environment variables
             try:
@@ -797,7 +2194,7 @@ async def on_fetch(request, env):
                 if not all([cf_account_id, cf_api_token, weather_api_key]):
                     raise Exception("Missing API credentials")
             except Exception as e:
-                print(f"[Main] Configuration error: {str(e)}")
+                log.error("Main", "Configuration error: %s", e)
                 headers = Headers.new()
                 headers.set("Content-Type", "application/json")
                 return Response.new(
@@ -806,15 +2203,36 @@ async def on_fetch(request, env):
                     headers=headers
                 )
             
-            # Call Workers AI to parse the query
+            # Fast path, then parse cache, then Workers AI
             try:
-                ai_response = await call_workers_ai(user_query, cf_account_id, cf_api_token)
+                with log.stage("parse"):
+                    query_params = await deadline.run(
+                        parse_query(env, user_query, cf_account_id, cf_api_token, request_coordinates(request)),
+                        "parse", STAGE_BUDGETS["parse"]
+                    )
                 
-                if not ai_response:
-                    raise Exception("AI returned empty response")
-                    
-            except Exception as e:
-                print(f"[Main] AI parsing error: {str(e)}")
+            except DeadlineExceeded as e:
+                METRICS.inc("deadline_exceeded_total", stage="parse")
+                log.warning("Main", "Parse deadline exceeded: %s", e)
+                headers = Headers.new()
+                headers.set("Content-Type", "application/json")
+                return Response.new(
+                    json.dumps({"error": "Understanding your query took too long. Please try again."}), 
+                    status=504,
+                    headers=headers
+                )
+            except CircuitOpen as e:
+                log.info("Main", "Query parsing unavailable: %s", e)
+                headers = Headers.new()
+                headers.set("Content-Type", "application/json")
+                headers.set("Retry-After", str(int(BREAKERS["parse_ai"].open_seconds)))
+                return Response.new(
+                    json.dumps({"error": "AI query parsing is temporarily unavailable. Simple phrasings like 'weather in Paris' still work."}), 
+                    status=503,
+                    headers=headers
+                )
+            except AIRequestError as e:
+                log.warning("Main", "AI parsing error: %s", e)
                 headers = Headers.new()
                 headers.set("Content-Type", "application/json")
                 return Response.new(
@@ -822,25 +2240,8 @@ async def on_fetch(request, env):
                     status=500,
                     headers=headers
                 )
-            
-            # Parse AI response as JSON
-            try:
-                json_start = ai_response.find('{')
-                json_end = ai_response.rfind('}') + 1
-                
-                if json_start == -1 or json_end == 0:
-                    raise Exception("AI response doesn't contain valid JSON")
-                
-                json_str = ai_response[json_start:json_end]
-                query_params = json.loads(json_str)
-                
-                if query_params.get("intent") != "get_weather" or "q" not in query_params:
-                    raise Exception("AI couldn't identify a location in your query")
-                    
-                print(f"[Main] Parsed query: {query_params}")
-                
             except json.JSONDecodeError as e:
-                print(f"[Main] JSON parsing error: {str(e)}")
+                log.warning("Main", "JSON parsing error: %s", e)
                 headers = Headers.new()
                 headers.set("Content-Type", "application/json")
                 return Response.new(
@@ -849,7 +2250,7 @@ async def on_fetch(request, env):
                     headers=headers
                 )
             except Exception as e:
-                print(f"[Main] Query validation error: {str(e)}")
+                log.info("Main", "Query validation error: %s", e)
                 headers = Headers.new()
                 headers.set("Content-Type", "application/json")
                 return Response.new(
@@ -860,11 +2261,33 @@ async def on_fetch(request, env):
             
             # Get weather data
             try:
-                weather_data = await get_weather(query_params, weather_api_key)
-                print(f"[Main] Successfully fetched weather data")
+                with log.stage("weather"):
+                    weather_data = await deadline.run(
+                        get_weather_for_query(query_params, weather_api_key, env, ctx), "weather", STAGE_BUDGETS["weather"]
+                    )
                 
+            except DeadlineExceeded as e:
+                METRICS.inc("deadline_exceeded_total", stage="weather")
+                log.warning("Main", "Weather deadline exceeded: %s", e)
+                headers = Headers.new()
+                headers.set("Content-Type", "application/json")
+                return Response.new(
+                    json.dumps({"error": "The weather service took too long to respond. Please try again."}), 
+                    status=504,
+                    headers=headers
+                )
+            except CircuitOpen as e:
+                log.info("Main", "Weather unavailable: %s", e)
+                headers = Headers.new()
+                headers.set("Content-Type", "application/json")
+                headers.set("Retry-After", str(int(BREAKERS["weatherapi"].open_seconds)))
+                return Response.new(
+                    json.dumps({"error": "The weather service is temporarily unavailable. Please try again shortly."}), 
+                    status=503,
+                    headers=headers
+                )
             except Exception as e:
-                print(f"[Main] Weather fetch error: {str(e)}")
+                log.info("Main", "Weather fetch error: %s", e)
                 headers = Headers.new()
                 headers.set("Content-Type", "application/json")
                 return Response.new(
@@ -873,31 +2296,53 @@ async def on_fetch(request, env):
                     headers=headers
                 )
             
-            # Generate limerick (non-critical, errors are swallowed)
-            try:
-                location = weather_data.get('location', query_params.get('q', 'Unknown'))
-                condition = weather_data.get('condition', 'unknown weather')
-                temperature = weather_data.get('temperature', 'unknown temperature')
-                
-                limerick = await generate_limerick(location, condition, temperature, cf_account_id, cf_api_token)
-                weather_data['limerick'] = limerick
-                
-            except Exception as e:
-                print(f"[Main] Limerick generation error (non-critical): {str(e)}")
+            # Comparisons are answered in one JSON response without a limerick
+            if "comparison" in weather_data:
                 weather_data['limerick'] = None
             
-            # Save to global conversation history (KV storage)
-            await save_to_global_history(env, user_query, weather_data)
+            # Streaming mode: return the weather now and stream the limerick
+            elif wants_stream(request, data):
+                return stream_chat_response(
+                    ctx, env, user_query, weather_data, cf_account_id, cf_api_token, deadline,
+                    history=not query_params.get("geolocated")
+                )
+            
+            # Generate limerick with whatever time is left (non-critical, errors are swallowed)
+            else:
+                try:
+                    location = weather_data.get('location', query_params.get('q', 'Unknown'))
+                    condition = weather_data.get('condition', 'unknown weather')
+                    temperature = weather_data.get('temperature', 'unknown temperature')
+                    
+                    with log.stage("limerick"):
+                        weather_data['limerick'] = await deadline.run(
+                            get_limerick(env, location, condition, temperature, cf_account_id, cf_api_token),
+                            "limerick",
+                            minimum=MIN_LIMERICK_BUDGET
+                        )
+                    
+                except DeadlineExceeded as e:
+                    # The limerick is optional, so it is what gets dropped when time runs short
+                    METRICS.inc("deadline_exceeded_total", stage="limerick")
+                    log.info("Main", "Limerick dropped: %s", e)
+                    weather_data['limerick'] = None
+                except Exception as e:
+                    log.warning("Main", "Limerick generation error (non-critical): %s", e)
+                    weather_data['limerick'] = None
+            
+            # Save to global conversation history (KV storage) in the background. Answers
+            # for the caller's own location ("weather here") would reveal where they are
+            if not query_params.get("geolocated"):
+                queue_history(ctx, env, user_query, weather_data)
             
             # Return successful response
-            print(f"[Main] Returning successful response")
             headers = Headers.new()
             headers.set("Content-Type", "application/json")
             return Response.new(json.dumps(weather_data), status=200, headers=headers)
             
         except Exception as e:
             # Catch-all for any unexpected errors
-            print(f"[Main] Unexpected error: {str(e)}")
+            log.error("Main", "Unexpected error: %s", e)
             headers = Headers.new()
             headers.set("Content-Type", "application/json")
             return Response.new(
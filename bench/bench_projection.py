@@ -0,0 +1,122 @@
+"""
+Benchmark: full to_py() conversion vs. WeatherSnapshot projection
+
+Runs under plain CPython against a recorded 7-day WeatherAPI.com forecast
+payload. FakeJsProxy mimics Pyodide's JsProxy: attribute access wraps nested
+objects lazily and to_py() deep-converts everything, counting how many JS
+values cross the boundary. Absolute timings differ inside workerd, where each
+crossing is more expensive; the conversion counts carry over directly.
+
+Usage:
+    python bench/bench_projection.py [payload.json] [--repeat N]
+"""
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from weather_snapshot import WeatherSnapshot  # noqa: E402
+
+DEFAULT_PAYLOAD = os.path.join(ROOT, "bench", "fixtures", "nicosia_forecast_7d.json")
+
+
+class FakeJsProxy:
+    """Minimal stand-in for a Pyodide JsProxy over a JSON value"""
+
+    conversions = 0
+
+    def __init__(self, value):
+        self._value = value
+
+    @classmethod
+    def wrap(cls, value):
+        cls.conversions += 1
+        if isinstance(value, (dict, list)):
+            return cls(value)
+        return value
+
+    def __getattr__(self, name):
+        if isinstance(self._value, dict) and name in self._value:
+            return FakeJsProxy.wrap(self._value[name])
+        raise AttributeError(name)
+
+    def __iter__(self):
+        return (FakeJsProxy.wrap(item) for item in self._value)
+
+    def __len__(self):
+        return len(self._value)
+
+    def to_py(self):
+        return _deep_convert(self._value)
+
+
+def _deep_convert(value):
+    FakeJsProxy.conversions += 1
+    if isinstance(value, dict):
+        return {key: _deep_convert(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_deep_convert(item) for item in value]
+    return value
+
+
+def full_conversion(proxy):
+    """The previous approach: to_py() the whole payload, then pick fields"""
+    data = proxy.to_py()
+    return WeatherSnapshot.from_js(data)
+
+
+def projection(proxy):
+    """Read only the needed fields straight off the proxy"""
+    return WeatherSnapshot.from_js(proxy)
+
+
+def measure(name, func, payload, repeat):
+    FakeJsProxy.conversions = 0
+    func(FakeJsProxy(payload))
+    conversions = FakeJsProxy.conversions
+
+    seconds = min(timeit.repeat(lambda: func(FakeJsProxy(payload)), number=repeat, repeat=5)) / repeat
+
+    tracemalloc.start()
+    func(FakeJsProxy(payload))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{name:<18} {seconds * 1e6:>10.1f} µs {conversions:>12,} {peak / 1024:>12.1f} KiB")
+    return seconds, conversions, peak
+
+
+def main():
+    args = sys.argv[1:]
+    repeat = 200
+    if "--repeat" in args:
+        index = args.index("--repeat")
+        repeat = int(args[index + 1])
+        del args[index:index + 2]
+    path = args[0] if args else DEFAULT_PAYLOAD
+
+    with open(path, encoding="utf-8") as f:
+        payload = json.load(f)
+
+    days = len(payload.get("forecast", {}).get("forecastday", []))
+    print(f"Payload: {os.path.basename(path)} ({os.path.getsize(path) / 1024:.1f} KiB, {days} forecast days)\n")
+    print(f"{'approach':<18} {'time/call':>13} {'conversions':>12} {'peak memory':>16}")
+
+    full = measure("to_py() + pick", full_conversion, payload, repeat)
+    projected = measure("projection", projection, payload, repeat)
+
+    print(f"\nSpeed-up: {full[0] / projected[0]:.1f}x, "
+          f"{full[1] / projected[1]:.0f}x fewer conversions, "
+          f"{full[2] / projected[2]:.1f}x less peak memory")
+
+    snapshot = projection(FakeJsProxy(payload))
+    print(f"Cached snapshot size: {len(json.dumps(snapshot.to_dict()))} bytes "
+          f"(payload: {len(json.dumps(payload))} bytes)")
+
+
+if __name__ == '__main__':
+    main()
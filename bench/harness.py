@@ -0,0 +1,259 @@
+"""
+Run the Worker's on_fetch under plain CPython.
+
+install() puts bench/jsshim on sys.path so `from js import ...` and
+`from pyodide.ffi import ...` resolve to the stand-ins, then imports app.
+MemoryKV, Env and ExecutionContext replace the Workers bindings, and
+SimulatedUpstreams answers WeatherAPI.com and Workers AI calls from the
+recorded Nicosia payload after a configurable delay; network_fetch sends
+them for real, for recording live cassettes (see upstream_client).
+
+    app, js = install()
+    upstreams = SimulatedUpstreams(weather_latency=0.15, ai_latency=0.4)
+    upstreams.install(js)
+    env, ctx = Env(), ExecutionContext()
+    response = await call(app, env, ctx, "POST", "/chat", {"query": "weather in Paris"})
+    await scheduled(app, env, ctx)  # one cron run of on_scheduled
+"""
+import asyncio
+import copy
+import importlib
+import json
+import os
+import random
+import re
+import sys
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import parse_qs, urlparse
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH)
+SHIM = os.path.join(BENCH, "jsshim")
+FORECAST_FIXTURE = os.path.join(BENCH, "fixtures", "nicosia_forecast_7d.json")
+
+
+def install():
+    """Import app against the js/pyodide shims; returns (app, js)"""
+    for path in (ROOT, SHIM):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    js = importlib.import_module("js")
+    if not hasattr(js, "FETCH_HANDLER"):
+        raise Exception(f"'js' resolved to {js.__file__}, not the shim in {SHIM}")
+    return importlib.import_module("app"), js
+
+
+class MemoryKV:
+    """In-memory KV namespace honouring expirationTtl, with optional simulated latency"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.entries = {}  # key -> (expires_at or None, value)
+        self.stats = {"gets": 0, "puts": 0}
+
+    async def get(self, key, *args, **options):
+        self.stats["gets"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= time.time():
+            del self.entries[key]
+            return None
+        return value
+
+    async def put(self, key, value, expirationTtl=None, **options):
+        self.stats["puts"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        expires_at = time.time() + expirationTtl if expirationTtl else None
+        self.entries[key] = (expires_at, value)
+
+    async def delete(self, key):
+        self.entries.pop(key, None)
+
+
+class Env:
+    """Worker bindings: credentials, a CHAT_HISTORY MemoryKV and quiet logging by default"""
+
+    def __init__(self, kv_latency=0.0, **overrides):
+        self.CF_ACCOUNT_ID = "bench-account"
+        self.CF_API_TOKEN = "bench-token"
+        self.WEATHER_API_KEY = "bench-weather-api-key"
+        self.CHAT_HISTORY = MemoryKV(kv_latency)
+        self.LOG_LEVEL = "warning"
+        self.LOG_SAMPLE_RATE = "0"
+        for name, value in overrides.items():
+            setattr(self, name, value)
+
+
+class ExecutionContext:
+    """Collects ctx.waitUntil() work so it can be awaited before exiting"""
+
+    def __init__(self):
+        self.pending = []
+
+    def waitUntil(self, task):
+        self.pending.append(task)
+
+    async def drain(self):
+        while self.pending:
+            tasks, self.pending = self.pending, []
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class SimulatedUpstreams:
+    """
+    Fake WeatherAPI.com and Workers AI endpoints. Each call sleeps for its
+    latency (scaled by a random factor within +/- jitter) before answering;
+    a tail_share of calls are tail_factor times slower still, and an
+    error_share of calls answer 503. Locations starting with "zz" or listed
+    in unknown_locations are unknown to WeatherAPI.
+    """
+
+    LIMERICK = (
+        "A city of sun by the sea,\n"
+        "Where halloumi is grilled just for me,\n"
+        "With the clouds drifting by,\n"
+        "Under warm winter sky,\n"
+        "It's as pleasant as weather can be!"
+    )
+
+    def __init__(self, weather_latency=0.0, ai_latency=0.0, limerick_latency=None, jitter=0.0, tail_share=0.0,
+                 tail_factor=1.0, error_share=0.0, seed=None, unknown_locations=()):
+        self.weather_latency = weather_latency
+        self.ai_latency = ai_latency
+        self.limerick_latency = ai_latency if limerick_latency is None else limerick_latency
+        self.jitter = jitter
+        self.tail_share = tail_share
+        self.tail_factor = tail_factor
+        self.error_share = error_share
+        self.unknown_locations = {location.lower() for location in unknown_locations}
+        self.random = random.Random(seed)
+        self.calls = {"weatherapi": 0, "parse_ai": 0, "limerick_ai": 0}
+        with open(FORECAST_FIXTURE, encoding="utf-8") as f:
+            self.forecast = json.load(f)
+
+    def install(self, js):
+        self.js = js
+        js.FETCH_HANDLER = self.handle
+        return self
+
+    async def delay(self, latency):
+        if latency:
+            if self.tail_share and self.random.random() < self.tail_share:
+                latency *= self.tail_factor
+            await asyncio.sleep(latency * self.random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    async def handle(self, url, method, headers, body):
+        if self.error_share and self.random.random() < self.error_share:
+            await self.delay(self.weather_latency if "api.weatherapi.com" in url else self.ai_latency)
+            return self.js.Response.json_response({"error": "Service Unavailable"}, status=503)
+        if "api.weatherapi.com" in url:
+            return await self.weather(url)
+        payload = json.loads(body)
+        if payload["messages"][0]["content"].startswith("You are a weather query parser"):
+            return await self.parse(payload["messages"][-1]["content"])
+        return await self.limerick(payload.get("stream", False))
+
+    async def weather(self, url):
+        self.calls["weatherapi"] += 1
+        await self.delay(self.weather_latency)
+        location = parse_qs(urlparse(url).query).get("q", [""])[0]
+        if not location or location.lower().startswith("zz") or location.lower() in self.unknown_locations:
+            return self.js.Response.json_response({"error": {"code": 1006, "message": "No matching location found."}}, status=400)
+        data = copy.deepcopy(self.forecast)
+        data["location"]["name"] = self.place_name(location)
+        # As if WeatherAPI had just published this update
+        data["current"]["last_updated_epoch"] = int(time.time())
+        return self.js.Response.json_response(data)
+
+    @staticmethod
+    def place_name(location):
+        """WeatherAPI names coordinates after the place they fall in; the gazetteer stands in for its database"""
+        match = re.fullmatch(r"\s*(-?[\d.]+)\s*,\s*(-?[\d.]+)\s*", location)
+        if match:
+            import gazetteer
+            lat, lon = float(match.group(1)), float(match.group(2))
+            for place_id, name, country, place_lat, place_lon, aliases, regions in gazetteer.PLACES:
+                if abs(place_lat - lat) < 0.1 and abs(place_lon - lon) < 0.1:
+                    return name
+            return f"{lat:.2f},{lon:.2f}"
+        return location.split(",")[0].strip().title()
+
+    async def parse(self, query):
+        """Roughly what the model does: pick the place name out of the query"""
+        self.calls["parse_ai"] += 1
+        await self.delay(self.ai_latency)
+        places = re.findall(r"\b(?:in|for|at)\s+([A-Z][\w'.-]*(?:\s+[A-Z][\w'.-]*)*)", query) or re.findall(r"\b[A-Z][a-z]+\b", query)
+        parsed = {"intent": "get_weather", "q": places[-1] if places else "Nicosia", "units": "metric", "timeframe": "now"}
+        return self.js.Response.json_response({"success": True, "errors": [], "result": {"response": json.dumps(parsed)}})
+
+    async def limerick(self, stream):
+        self.calls["limerick_ai"] += 1
+        if not stream:
+            await self.delay(self.limerick_latency)
+            return self.js.Response.json_response({"success": True, "errors": [], "result": {"response": self.LIMERICK}})
+
+        # Server-sent events, one word per event, spread over the latency
+        tokens = re.findall(r"\S+\s*", self.LIMERICK)
+        events = [f"data: {json.dumps({'response': token})}\n\n" for token in tokens] + ["data: [DONE]\n\n"]
+        headers = self.js.Headers({"Content-Type": "text/event-stream"})
+        return self.js.Response(self.js.ReadableStream.from_chunks(events, self.limerick_latency / len(events)), 200, headers)
+
+
+async def network_fetch(url, method, headers, body):
+    """FETCH_HANDLER that makes real HTTP requests (urllib, in a worker thread)"""
+    js = sys.modules["js"]
+    request = urllib.request.Request(
+        url,
+        data=body.encode("utf-8") if body else None,
+        method=method,
+        headers=dict(headers.items()) if headers is not None else {}
+    )
+
+    def send():
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return response.status, response.headers.get("Content-Type"), response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers.get("Content-Type"), e.read()
+
+    status, content_type, data = await asyncio.to_thread(send)
+    return js.Response(data, status, js.Headers({"Content-Type": content_type or "application/json"}))
+
+
+class ScheduledController:
+    """The controller passed to on_scheduled: the cron pattern and scheduled time (ms)"""
+
+    def __init__(self, cron):
+        self.cron = cron
+        self.scheduledTime = time.time() * 1000
+
+
+async def scheduled(app, env, ctx, cron="*/5 * * * *"):
+    """Run on_scheduled once, as a cron trigger would, and wait for its background work"""
+    await app.on_scheduled(ScheduledController(cron), env, ctx)
+    await ctx.drain()
+
+
+async def call(app, env, ctx, method, path, body=None, headers=None, cf=None):
+    """
+    Send one request through on_fetch and read the full body; returns
+    (response, body bytes). cf stands in for request.cf, e.g.
+    {"latitude": "51.5", "longitude": "-0.12", "country": "GB"}.
+    """
+    js = sys.modules["js"]
+    request = js.Request.new(
+        f"https://weatherappy.test{path}",
+        method=method,
+        headers=headers,
+        body=json.dumps(body) if body is not None else None,
+        cf=cf
+    )
+    response = await app.on_fetch(request, env, ctx)
+    return response, await response.bytes()
@@ -0,0 +1,292 @@
+"""
+CPython stand-in for the `js` module Pyodide exposes inside workerd.
+
+Provides just enough of Response, Request, Headers, fetch, caches,
+TextEncoder and TransformStream for app.on_fetch to run unmodified. bench/harness.py puts
+this directory on sys.path. It is not importable as `js` from the Worker
+itself, so it can never shadow the real module in a deployed bundle.
+
+fetch() is dispatched to FETCH_HANDLER, an async callable taking
+(url, method, headers, body) and returning a Response; the harness installs
+simulated upstreams there.
+"""
+import asyncio
+import json
+import time
+
+
+class JsProxy:
+    """Read-only view of a JSON value with JsProxy-style attribute access"""
+
+    def __init__(self, value):
+        self._value = value
+
+    def __getattr__(self, name):
+        if isinstance(self._value, dict) and name in self._value:
+            return wrap(self._value[name])
+        raise AttributeError(name)
+
+    def __iter__(self):
+        return (wrap(item) for item in self._value)
+
+    def __len__(self):
+        return len(self._value)
+
+    def __getitem__(self, index):
+        return wrap(self._value[index])
+
+    def to_py(self):
+        return json.loads(json.dumps(self._value))
+
+
+def wrap(value):
+    return JsProxy(value) if isinstance(value, (dict, list)) else value
+
+
+class Uint8Array(bytes):
+    """Bytes with the to_bytes() conversion Pyodide offers on typed arrays"""
+
+    def to_bytes(self):
+        return bytes(self)
+
+
+class Headers:
+    """Case-insensitive header map"""
+
+    def __init__(self, init=None):
+        self._headers = {}
+        for name, value in (init or {}).items():
+            self.set(name, value)
+
+    @classmethod
+    def new(cls, init=None):
+        return cls(init)
+
+    def set(self, name, value):
+        self._headers[name.lower()] = str(value)
+
+    def get(self, name):
+        return self._headers.get(name.lower())
+
+    def has(self, name):
+        return name.lower() in self._headers
+
+    def delete(self, name):
+        self._headers.pop(name.lower(), None)
+
+    def items(self):
+        return self._headers.items()
+
+
+class _Chunk:
+    def __init__(self, done, value=None):
+        self.done = done
+        self.value = value
+
+
+class ReadableStream:
+    """Single-reader stream of Uint8Array chunks backed by an asyncio.Queue"""
+
+    def __init__(self):
+        self._queue = asyncio.Queue()
+
+    @classmethod
+    def from_chunks(cls, chunks, delay=0.0):
+        """A stream that yields chunks (str or bytes), optionally delay seconds apart"""
+        stream = cls()
+
+        async def produce():
+            for chunk in chunks:
+                if delay:
+                    await asyncio.sleep(delay)
+                await stream._queue.put(Uint8Array(chunk.encode("utf-8") if isinstance(chunk, str) else chunk))
+            await stream._queue.put(None)
+
+        asyncio.ensure_future(produce())
+        return stream
+
+    def getReader(self):
+        return self
+
+    async def read(self):
+        value = await self._queue.get()
+        return _Chunk(True) if value is None else _Chunk(False, value)
+
+    async def read_all(self):
+        """Drain the stream into bytes (harness helper, not part of the JS API)"""
+        data = b""
+        while True:
+            chunk = await self.read()
+            if chunk.done:
+                return data
+            data += chunk.value
+
+
+class _Writer:
+    def __init__(self, stream):
+        self._stream = stream
+
+    async def write(self, value):
+        await self._stream._queue.put(value)
+
+    async def close(self):
+        await self._stream._queue.put(None)
+
+
+class _WritableStream:
+    def __init__(self, readable):
+        self._readable = readable
+
+    def getWriter(self):
+        return _Writer(self._readable)
+
+
+class TransformStream:
+    """Identity transform: whatever is written comes out of readable"""
+
+    def __init__(self):
+        self.readable = ReadableStream()
+        self.writable = _WritableStream(self.readable)
+
+    @classmethod
+    def new(cls):
+        return cls()
+
+
+class TextEncoder:
+    @classmethod
+    def new(cls):
+        return cls()
+
+    def encode(self, text):
+        return Uint8Array(text.encode("utf-8"))
+
+
+class Response:
+    """
+    Response with a str, bytes, ReadableStream or empty body. As in JS, body
+    is a ReadableStream (or None) whatever the response was built from.
+    """
+
+    def __init__(self, body=None, status=200, headers=None, statusText="", **options):
+        self._body = body
+        self._stream = body if isinstance(body, ReadableStream) else None
+        self.status = status
+        self.statusText = statusText
+        self.headers = headers if headers is not None else Headers()
+        if isinstance(self.headers, dict):
+            self.headers = Headers(self.headers)
+        self.ok = 200 <= status < 300
+        self.options = options
+
+    @classmethod
+    def new(cls, body=None, status=200, headers=None, **options):
+        return cls(body, status, headers, **options)
+
+    @classmethod
+    def json_response(cls, value, status=200):
+        """Response with a JSON body (harness helper)"""
+        return cls(json.dumps(value), status, Headers({"Content-Type": "application/json"}))
+
+    @property
+    def body(self):
+        if self._stream is None and self._body is not None:
+            self._stream = ReadableStream.from_chunks([self._body])
+        return self._stream
+
+    async def bytes(self):
+        if self._stream is not None:
+            return await self._stream.read_all()
+        if self._body is None:
+            return b""
+        return self._body.encode("utf-8") if isinstance(self._body, str) else bytes(self._body)
+
+    async def text(self):
+        return (await self.bytes()).decode("utf-8")
+
+    async def json(self):
+        return wrap(json.loads(await self.text()))
+
+
+class Request:
+    """Incoming request as seen by on_fetch"""
+
+    def __init__(self, url, method="GET", headers=None, body=None, cf=None):
+        self.url = url
+        self.method = method
+        self.headers = headers if isinstance(headers, Headers) else Headers(headers)
+        self.cf = wrap(cf) if cf is not None else None
+        self._body = body
+
+    @classmethod
+    def new(cls, url, method="GET", headers=None, body=None, cf=None):
+        return cls(url, method, headers, body, cf)
+
+    async def text(self):
+        return self._body or ""
+
+    async def json(self):
+        return json.loads(await self.text())
+
+
+class Object:
+    @staticmethod
+    def fromEntries(entries):
+        return dict(entries)
+
+
+class Cache:
+    """
+    In-memory Workers Cache API: entries keyed on URL, kept for the
+    response's s-maxage or max-age, never stored with no-store or private
+    """
+
+    def __init__(self):
+        self.entries = {}  # url -> (expires_at, status, headers, body)
+        self.stats = {"hits": 0, "misses": 0, "puts": 0}
+
+    @staticmethod
+    def _url(key):
+        return key.url if isinstance(key, Request) else key
+
+    async def match(self, key):
+        entry = self.entries.get(self._url(key))
+        if entry is None or entry[0] <= time.time():
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        _, status, headers, body = entry
+        return Response(body, status, Headers(headers))
+
+    async def put(self, key, response):
+        directives = {}
+        for part in (response.headers.get("Cache-Control") or "").split(","):
+            name, _, value = part.strip().lower().partition("=")
+            directives[name] = value
+        if "no-store" in directives or "private" in directives:
+            return
+        max_age = directives.get("s-maxage") or directives.get("max-age")
+        if not max_age:
+            return
+        self.stats["puts"] += 1
+        body = await response.bytes()
+        self.entries[self._url(key)] = (time.time() + int(max_age), response.status, dict(response.headers.items()), body)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class CacheStorage:
+    def __init__(self):
+        self.default = Cache()
+
+
+caches = CacheStorage()
+
+FETCH_HANDLER = None
+
+
+async def fetch(url, method="GET", headers=None, body=None, **options):
+    if FETCH_HANDLER is None:
+        raise Exception(f"No fetch handler installed for {method} {url}")
+    return await FETCH_HANDLER(url, method, headers, body)
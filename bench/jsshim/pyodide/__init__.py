@@ -0,0 +1 @@
+"""CPython stand-in for the parts of Pyodide the Worker imports"""
@@ -0,0 +1,12 @@
+"""
+pyodide.ffi stand-ins. Under CPython there is no JS boundary, so proxies and
+conversions are identities.
+"""
+
+
+def create_proxy(obj):
+    return obj
+
+
+def to_js(obj, **options):
+    return obj
@@ -0,0 +1,268 @@
+"""
+Load generator: concurrent POST /chat, GET /, GET /api/history and
+GET /api/weather traffic
+against on_fetch under CPython, with simulated upstream and KV latencies.
+
+All requests share one module instance, so this behaves like a single warm
+isolate: in-memory caches and single-flight groups carry over between
+requests. Chat queries are drawn from a Zipf-like distribution over cities,
+with a share of phrasings the fast path leaves to Workers AI, a share naming
+the city by an alias or variant spelling ("NYC", "new york") and a share of
+misspelled cities WeatherAPI doesn't know. With --here-share, that share of
+chat queries name no place ("what's the weather here?") and carry a
+request.cf position scattered around a few metro areas.
+
+With --cassette, upstream calls are replayed from a recorded cassette (see
+bench/record_cassette.py) instead of simulated, and chat queries are drawn
+from the queries it was recorded with. Latencies are the recorded ones unless
+--replay-latency is given.
+
+Usage:
+    python bench/loadgen.py [--requests N] [--concurrency C] [--mix chat=70,page=20,history=10]
+                            [--weather-latency MS] [--ai-latency MS] [--limerick-latency MS]
+                            [--kv-latency MS] [--jitter F] [--tail-share F] [--tail-factor F] [--error-share F]
+                            [--llm-share F] [--alias-share F] [--typo-share F] [--here-share F]
+                            [--stream] [--no-hedge] [--seed S]
+                            [--cassette PATH [--replay-latency MS] [--latency-scale F]]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import Env, ExecutionContext, SimulatedUpstreams, call, install  # noqa: E402
+
+CITIES = [
+    "London", "Paris", "Tokyo", "New York", "Nicosia", "Berlin", "Rome", "Madrid", "Sydney", "Toronto",
+    "Dubai", "Singapore", "Istanbul", "Amsterdam", "Lisbon", "Vienna", "Prague", "Seoul", "Cairo", "Oslo",
+]
+
+# Other ways people write some of the cities above
+ALIASES = {
+    "London": ["london", "London, UK", "London, England"],
+    "Paris": ["paris", "Paris, France"],
+    "Tokyo": ["tokyo", "Tokyo, Japan"],
+    "New York": ["NYC", "new york", "New York City", "NY"],
+    "Nicosia": ["Lefkosia", "nicosia"],
+    "Berlin": ["berlin", "Berlin, Germany"],
+    "Rome": ["Roma", "rome"],
+    "Madrid": ["madrid"],
+    "Sydney": ["sydney", "Sydney, Australia"],
+    "Toronto": ["toronto"],
+}
+
+# Misspellings WeatherAPI can't resolve (SimulatedUpstreams answers 400 for them)
+TYPOS = ["Lodnon", "Pairs", "Tokoyo", "Berlni", "Nicsoia", "Madird", "Syndey", "Torotno"]
+
+# Location-less queries, answered from the request's geolocation
+HERE_QUERIES = ["What's the weather here?", "weather near me", "local forecast tomorrow", "is it raining", "weather"]
+
+# (lat, lon) of metro areas that --here-share users are scattered around (~10km)
+METROS = [(51.51, -0.13), (40.71, -74.01), (35.68, 139.69), (48.86, 2.35), (35.17, 33.36)]
+METRO_SPREAD = 0.1
+
+TEMPLATES = [
+    "What's the weather in {city}?",
+    "weather in {city}",
+    "{city} forecast tomorrow",
+    "7 day forecast for {city} in fahrenheit",
+    "How's the weather looking in {city} today?",
+]
+
+# Phrasings the fast path does not handle, so they go to the parse cache or Workers AI
+LLM_TEMPLATES = [
+    "Is it going to rain in {city}?",
+    "Do I need a jacket in {city}?",
+]
+
+
+def make_query(rng, llm_share, alias_share=0.0, typo_share=0.0):
+    city = rng.choices(CITIES, weights=[1 / (rank + 1) for rank in range(len(CITIES))])[0]
+    roll = rng.random() if alias_share or typo_share else 1.0
+    if roll < typo_share:
+        city = rng.choice(TYPOS)
+    elif roll < typo_share + alias_share and city in ALIASES:
+        city = rng.choice(ALIASES[city])
+    templates = LLM_TEMPLATES if rng.random() < llm_share else TEMPLATES
+    return rng.choice(templates).format(city=city)
+
+
+def make_here_query(rng):
+    lat, lon = rng.choice(METROS)
+    cf = {"latitude": f"{rng.gauss(lat, METRO_SPREAD / 2):.4f}", "longitude": f"{rng.gauss(lon, METRO_SPREAD / 2):.4f}"}
+    return rng.choice(HERE_QUERIES), cf
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight)
+    unknown = set(mix) - {"chat", "page", "history", "api"}
+    if unknown:
+        raise SystemExit(f"Unknown traffic types in --mix: {', '.join(sorted(unknown))}")
+    return mix
+
+
+async def run(args):
+    app, js = install()
+    upstreams = replay = None
+    if args.cassette:
+        from upstream_client import ReplayClient
+        replay = ReplayClient(
+            args.cassette,
+            latency=args.replay_latency / 1000 if args.replay_latency is not None else None,
+            latency_scale=args.latency_scale
+        )
+        app.UPSTREAM_CLIENT = replay
+    else:
+        upstreams = SimulatedUpstreams(
+            weather_latency=args.weather_latency / 1000,
+            ai_latency=args.ai_latency / 1000,
+            limerick_latency=(args.limerick_latency if args.limerick_latency is not None else args.ai_latency) / 1000,
+            jitter=args.jitter,
+            tail_share=args.tail_share,
+            tail_factor=args.tail_factor,
+            error_share=args.error_share,
+            seed=args.seed,
+            unknown_locations=TYPOS
+        ).install(js)
+    env = Env(kv_latency=args.kv_latency / 1000) if args.hedge else Env(kv_latency=args.kv_latency / 1000, HEDGE_UPSTREAMS="")
+    ctx = ExecutionContext()
+    rng = random.Random(args.seed)
+    mix = parse_mix(args.mix)
+
+    plan = rng.choices(list(mix), weights=list(mix.values()), k=args.requests)
+    requests = []
+    for kind in plan:
+        if kind == "chat":
+            cf = None
+            if replay:
+                query = rng.choice(replay.cassette["queries"])
+            elif args.here_share and rng.random() < args.here_share:
+                query, cf = make_here_query(rng)
+            else:
+                query = make_query(rng, args.llm_share, args.alias_share, args.typo_share)
+            body = {"query": query}
+            if args.stream:
+                body["stream"] = True
+            requests.append(("POST /chat", "POST", "/chat", body, None, cf))
+        elif kind == "api":
+            city = rng.choices(CITIES, weights=[1 / (rank + 1) for rank in range(len(CITIES))])[0]
+            query = urlencode({"q": city, "timeframe": rng.choice(["now", "tomorrow", "7d"])})
+            requests.append(("GET /api/weather", "GET", f"/api/weather?{query}", None, None, None))
+        elif kind == "page":
+            requests.append(("GET /", "GET", "/", None, {"Accept-Encoding": "gzip, deflate, br"}, None))
+        else:
+            requests.append(("GET /api/history", "GET", "/api/history", None, None, None))
+
+    latencies = {}
+    errors = {}
+    queue = asyncio.Queue()
+    for request in requests:
+        queue.put_nowait(request)
+
+    async def worker():
+        while not queue.empty():
+            label, method, path, body, headers, cf = queue.get_nowait()
+            started = time.perf_counter()
+            response, _ = await call(app, env, ctx, method, path, body, headers, cf)
+            latencies.setdefault(label, []).append((time.perf_counter() - started) * 1000)
+            if response.status >= 400:
+                errors[label] = errors.get(label, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - started
+    await ctx.drain()
+
+    print(f"{args.requests} requests in {elapsed:.2f}s ({args.requests / elapsed:,.1f} req/s), concurrency {args.concurrency}")
+    if replay:
+        latency = f"{args.replay_latency:g}ms" if args.replay_latency is not None else "recorded"
+        print(f"Replaying {args.cassette} (latency {latency} x{args.latency_scale:g}), kv {args.kv_latency:g}ms\n")
+    else:
+        tail = f", {args.tail_share:.0%} of calls x{args.tail_factor:g}" if args.tail_share else ""
+        tail += f", {args.error_share:.0%} errors" if args.error_share else ""
+        print(f"Simulated latency: weatherapi {args.weather_latency:g}ms, workers ai {args.ai_latency:g}ms, "
+              f"kv {args.kv_latency:g}ms, jitter ±{args.jitter:.0%}{tail}\n")
+    print(f"{'route':<18} {'count':>7} {'errors':>7} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    all_latencies = []
+    for label, values in sorted(latencies.items()):
+        values.sort()
+        all_latencies.extend(values)
+        print(f"{label:<18} {len(values):>7} {errors.get(label, 0):>7} "
+              f"{percentile(values, 0.5):>9.1f} {percentile(values, 0.99):>9.1f} {values[-1]:>9.1f}")
+    all_latencies.sort()
+    print(f"{'all':<18} {len(all_latencies):>7} {sum(errors.values()):>7} "
+          f"{percentile(all_latencies, 0.5):>9.1f} {percentile(all_latencies, 0.99):>9.1f} {all_latencies[-1]:>9.1f}")
+
+    if replay:
+        print(f"\nUpstream calls: {replay.stats['replayed']} replayed, {replay.stats['missing']} not in cassette")
+    else:
+        calls = ", ".join(f"{name} {count}" for name, count in upstreams.calls.items())
+        print(f"\nUpstream calls: {calls}")
+    print(f"KV operations: {env.CHAT_HISTORY.stats['gets']} gets, {env.CHAT_HISTORY.stats['puts']} puts")
+    print(f"Weather cache hit ratio: {app.WEATHER_CACHE.hit_rate():.1%}")
+    not_found = app.NOT_FOUND_CACHE.stats
+    if not_found["memory_hits"] or not_found["kv_hits"]:
+        print(f"Unknown locations answered from the not-found cache: {not_found['memory_hits'] + not_found['kv_hits']}")
+
+    edge = js.caches.default.stats
+    if edge["hits"] or edge["puts"]:
+        print(f"Edge cache (GET /api/weather): {edge['hits']} hits, {edge['misses']} misses")
+
+    hedges = app.METRICS.counters.get("hedges_total", {})
+    fired = sum(count for labels, count in hedges.items() if ("result", "fired") in labels)
+    won = sum(count for labels, count in hedges.items() if ("result", "won") in labels)
+    print(f"Hedged requests: {fired} fired, {won} won")
+    breakers = ", ".join(f"{name} opened {breaker.stats['opened']}x, {breaker.stats['rejected']} rejected"
+                         for name, breaker in app.BREAKERS.items() if breaker.stats["opened"])
+    if breakers:
+        print(f"Circuit breakers: {breakers}")
+    stale = app.METRICS.counters.get("stale_responses_total", {})
+    if stale:
+        print(f"Stale weather served: {sum(stale.values())}")
+    deadlines = app.METRICS.counters.get("deadline_exceeded_total", {})
+    if deadlines:
+        print("Deadline exceeded: " + ", ".join(f"{dict(labels)['stage']} {count}" for labels, count in sorted(deadlines.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive concurrent traffic through on_fetch under CPython")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--mix", default="chat=70,page=20,history=10", help="traffic weights for chat, page, history and api")
+    parser.add_argument("--weather-latency", type=float, default=150, help="simulated WeatherAPI.com latency (ms)")
+    parser.add_argument("--ai-latency", type=float, default=400, help="simulated Workers AI parse latency (ms)")
+    parser.add_argument("--limerick-latency", type=float, default=None, help="simulated limerick latency (ms, default: --ai-latency)")
+    parser.add_argument("--kv-latency", type=float, default=10, help="simulated KV latency (ms)")
+    parser.add_argument("--jitter", type=float, default=0.2, help="latency jitter as a fraction, e.g. 0.2 for ±20%%")
+    parser.add_argument("--tail-share", type=float, default=0.0, help="share of upstream calls that hit the slow tail")
+    parser.add_argument("--tail-factor", type=float, default=10.0, help="how many times slower tail calls are")
+    parser.add_argument("--error-share", type=float, default=0.0, help="share of upstream calls that answer 503")
+    parser.add_argument("--llm-share", type=float, default=0.1, help="share of chat queries the fast path can't parse")
+    parser.add_argument("--alias-share", type=float, default=0.0, help="share of chat queries naming the city by an alias")
+    parser.add_argument("--typo-share", type=float, default=0.0, help="share of chat queries for a misspelled, unknown city")
+    parser.add_argument("--here-share", type=float, default=0.0, help="share of chat queries that name no place and use request.cf")
+    parser.add_argument("--stream", action="store_true", help="request streamed NDJSON /chat responses")
+    parser.add_argument("--no-hedge", dest="hedge", action="store_false", help="turn off hedging of WeatherAPI requests")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--cassette", help="replay upstream calls from this cassette instead of simulating them")
+    parser.add_argument("--replay-latency", type=float, default=None, help="fixed replay latency (ms) instead of the recorded ones")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="multiply replay latencies by this factor")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
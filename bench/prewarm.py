@@ -0,0 +1,91 @@
+"""
+Exercise the scheduled pre-warming job under CPython.
+
+Sends chat traffic over a Zipf-like spread of cities so the popularity
+counts are merged into KV, ages every cached snapshot to just before expiry,
+then runs on_scheduled as the cron trigger would and reports how many
+WeatherAPI calls that took. Snapshots that weren't refreshed are then
+expired, and a final round of traffic shows how many requests still had to
+go to WeatherAPI.
+
+Usage:
+    python bench/prewarm.py [--requests N] [--top-n N] [--budget N] [--limericks]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import Env, ExecutionContext, SimulatedUpstreams, call, install, scheduled  # noqa: E402
+from loadgen import CITIES  # noqa: E402
+
+
+def age_snapshots(app, env, expires_in, within=None):
+    """
+    Make cached snapshots, in memory and KV, expire in expires_in seconds
+    (negative for already expired); only those expiring within `within`
+    seconds if given
+    """
+    now = time.time()
+    for key, (expires_at, value) in list(app.WEATHER_CACHE.memory.entries.items()):
+        if within is None or expires_at < now + within:
+            app.WEATHER_CACHE.memory.entries[key] = (now + expires_in, value)
+    prefix = app.WEATHER_CACHE.kv_key("")
+    for key, (kv_expires_at, stored) in list(env.CHAT_HISTORY.entries.items()):
+        entry = json.loads(stored) if key.startswith(prefix) else None
+        if entry and (within is None or entry["expires_at"] < now + within):
+            entry["expires_at"] = now + expires_in
+            env.CHAT_HISTORY.entries[key] = (kv_expires_at, json.dumps(entry))
+
+
+async def run(args):
+    app, js = install()
+    upstreams = SimulatedUpstreams(weather_latency=0.05, ai_latency=0.05, seed=args.seed).install(js)
+    env = Env(PREWARM_TOP_N=str(args.top_n), PREWARM_BUDGET=str(args.budget),
+              PREWARM_LIMERICKS="true" if args.limericks else "false")
+    ctx = ExecutionContext()
+    rng = random.Random(args.seed)
+    weights = [1 / (rank + 1) for rank in range(len(CITIES))]
+
+    async def traffic(count):
+        for _ in range(count):
+            city = rng.choices(CITIES, weights=weights)[0]
+            await call(app, env, ctx, "POST", "/chat", {"query": f"weather in {city}"})
+        await ctx.drain()
+
+    # Merge counts on every request so the cron run sees all of them
+    app.POPULARITY.flush_interval = 0
+    await traffic(args.requests)
+    for key, location, count in await app.POPULARITY.top(env, args.top_n):
+        print(f"{location:<12} {count:>5}")
+
+    # Everything is about to expire when the cron runs
+    age_snapshots(app, env, expires_in=60)
+    before = upstreams.calls["weatherapi"]
+    await scheduled(app, env, ctx)
+    print(f"\nCron run: {upstreams.calls['weatherapi'] - before} WeatherAPI calls (budget {args.budget})")
+
+    # Time passes: whatever wasn't warmed expires past the revalidation window
+    age_snapshots(app, env, expires_in=-app.WEATHER_REVALIDATE_WINDOW - 1, within=120)
+    before = upstreams.calls["weatherapi"]
+    await traffic(args.requests)
+    print(f"Traffic after warming: {upstreams.calls['weatherapi'] - before} WeatherAPI calls for {args.requests} requests")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the scheduled pre-warming job against simulated traffic")
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--top-n", type=int, default=10)
+    parser.add_argument("--budget", type=int, default=10)
+    parser.add_argument("--limericks", action="store_true", help="also fill limerick pools")
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Record an upstream cassette by running queries through on_fetch.
+
+Each query is sent once as a plain POST /chat and once streamed, so the
+cassette holds both kinds of limerick responses. With --live the requests go
+to the real WeatherAPI.com and Workers AI endpoints using the CF_ACCOUNT_ID,
+CF_API_TOKEN and WEATHER_API_KEY environment variables; otherwise they are
+answered by SimulatedUpstreams from the recorded Nicosia payload.
+
+Usage:
+    python bench/record_cassette.py [--live] [--out PATH] [query ...]
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import BENCH, Env, ExecutionContext, SimulatedUpstreams, call, install, network_fetch  # noqa: E402
+
+DEFAULT_QUERIES = [
+    "What's the weather in Nicosia?",
+    "Nicosia forecast tomorrow",
+    "7 day forecast for Nicosia in fahrenheit",
+    "Is it going to rain in Nicosia?",
+]
+DEFAULT_CASSETTE = os.path.join(BENCH, "cassettes", "nicosia.json")
+
+
+async def record(args):
+    app, js = install()
+    from upstream_client import FetchClient, RecordingClient
+
+    if args.live:
+        missing = [name for name in ("CF_ACCOUNT_ID", "CF_API_TOKEN", "WEATHER_API_KEY") if not os.environ.get(name)]
+        if missing:
+            raise SystemExit(f"--live needs {', '.join(missing)} in the environment")
+        js.FETCH_HANDLER = network_fetch
+        env = Env(**{name: os.environ[name] for name in ("CF_ACCOUNT_ID", "CF_API_TOKEN", "WEATHER_API_KEY")})
+    else:
+        SimulatedUpstreams(weather_latency=0.15, ai_latency=0.4, jitter=0.2, seed=1).install(js)
+        env = Env()
+
+    recorder = RecordingClient(FetchClient(), args.out)
+    app.UPSTREAM_CLIENT = recorder
+    ctx = ExecutionContext()
+
+    for query in args.queries:
+        for stream in (False, True):
+            response, _ = await call(app, env, ctx, "POST", "/chat", {"query": query, "stream": stream})
+            print(f"{response.status} {'streamed' if stream else 'json    '} {query}")
+    await ctx.drain()
+
+    recorder.save(source="live" if args.live else "simulated", queries=args.queries)
+    print(f"\nRecorded {len(recorder.interactions)} interactions to {args.out}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record upstream interactions to a cassette")
+    parser.add_argument("queries", nargs="*", default=DEFAULT_QUERIES)
+    parser.add_argument("--live", action="store_true", help="call the real upstreams instead of the simulated ones")
+    parser.add_argument("--out", default=DEFAULT_CASSETTE)
+    asyncio.run(record(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,559 @@
+"""
+Checks for the Worker's parsing, caching, streaming and resilience
+behaviour, run under CPython through bench/harness.py:
+python -m pytest -q bench
+
+Each test gets a freshly imported app (so module-level caches, breakers and
+queues start empty) answered by SimulatedUpstreams with no latency, and
+drives it with asyncio.run, so no async pytest plugin is needed.
+"""
+import asyncio
+import importlib
+import json
+import os
+
+import pytest
+
+from harness import BENCH, Env, ExecutionContext, SimulatedUpstreams, call, install
+
+
+@pytest.fixture
+def worker():
+    """(app, js, upstreams) with app's module state reset"""
+    app, js = install()
+    app = importlib.reload(app)
+    js.caches.default.clear()
+    upstreams = SimulatedUpstreams().install(js)
+    return app, js, upstreams
+
+
+def test_tiered_cache_reads_through_to_kv(worker):
+    from cache import TieredCache
+
+    async def run():
+        env = Env()
+        await TieredCache("t", max_entries=8, ttl=60).set(env, "key", {"a": 1})
+        # Another isolate: empty memory, same KV
+        other = TieredCache("t", max_entries=8, ttl=60)
+        assert await other.get(env, "key") == {"a": 1}
+        assert await other.get(env, "key") == {"a": 1}
+        assert other.stats["kv_hits"] == 1 and other.stats["memory_hits"] == 1
+
+    asyncio.run(run())
+
+
+def test_tiered_cache_keeps_expired_entries_for_revalidation(worker):
+    from cache import TieredCache
+
+    async def run():
+        env = Env()
+        cache = TieredCache("t", max_entries=8, ttl=60, stale_ttl=60)
+        await cache.set(env, "key", "value", ttl=0.01)
+        await asyncio.sleep(0.02)
+        assert await cache.get(env, "key") is None
+        assert await cache.lookup(env, "key", max_stale=60) == ("value", True)
+        assert await cache.lookup(env, "key", max_stale=0) == (None, False)
+        assert await cache.get_stale(env, "key") == "value"
+
+    asyncio.run(run())
+
+
+def test_single_flight_coalesces_concurrent_calls(worker):
+    from cache import SingleFlight
+
+    async def run():
+        flights, started = SingleFlight(), []
+
+        async def fetch(value):
+            started.append(value)
+            await asyncio.sleep(0.01)
+            return value * 2
+
+        results = await asyncio.gather(*[flights.do("key", fetch, 21) for _ in range(5)])
+        assert results == [42] * 5
+        assert started == [21]
+        assert flights.stats == {"calls": 1, "coalesced": 4}
+        assert not flights.in_flight and not flights.waiters
+
+    asyncio.run(run())
+
+
+def test_single_flight_cancels_work_nobody_awaits(worker):
+    from cache import SingleFlight
+
+    async def run():
+        flights, cancelled = SingleFlight(), []
+
+        async def slow():
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(flights.do("key", slow), 0.01)
+        await asyncio.sleep(0)
+        assert cancelled == [True]
+        assert not flights.in_flight and not flights.waiters
+
+    asyncio.run(run())
+
+
+def test_circuit_breaker_opens_probes_and_closes(worker):
+    from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen
+
+    async def run():
+        breaker = CircuitBreaker("test", window=4, min_calls=4, open_seconds=0.02)
+        for failed in (False, True, False, True):
+            assert breaker.allow()
+            breaker.record(failed, 10)
+        assert breaker.state == OPEN
+        with pytest.raises(CircuitOpen):
+            breaker.check()
+
+        # After open_seconds one probe goes through; a failed probe reopens
+        await asyncio.sleep(0.03)
+        assert breaker.allow() and breaker.state == HALF_OPEN
+        assert not breaker.allow()
+        breaker.record(True, 10)
+        assert breaker.state == OPEN
+
+        await asyncio.sleep(0.03)
+        assert breaker.allow()
+        breaker.record(False, 10)
+        assert breaker.state == CLOSED
+        assert breaker.stats["opened"] == 2
+
+    asyncio.run(run())
+
+
+def test_open_weather_breaker_serves_stale_snapshot_or_503(worker):
+    app, js, upstreams = worker
+
+    async def run():
+        env, ctx = Env(), ExecutionContext()
+        response, _ = await call(app, env, ctx, "GET", "/api/weather?q=Oslo")
+        assert response.status == 200
+        # Age Oslo's snapshot past the revalidation window, so only get_stale() finds it
+        key = app.weather_cache_key(app.canonical_location("Oslo"))
+        snapshot = app.WEATHER_CACHE.memory.get(key)
+        app.WEATHER_CACHE.memory.set(key, snapshot, ttl=-2 * app.WEATHER_REVALIDATE_WINDOW)
+        await env.CHAT_HISTORY.delete(app.WEATHER_CACHE.kv_key(key))
+        app.BREAKERS["weatherapi"]._open("test")
+
+        response, body = await call(app, env, ctx, "POST", "/chat", {"query": "weather in Oslo"})
+        assert response.status == 200
+        assert json.loads(body)["stale"] is True
+
+        response, _ = await call(app, env, ctx, "POST", "/chat", {"query": "weather in Lima"})
+        assert response.status == 503
+        assert response.headers.get("Retry-After") == str(int(app.BREAKERS["weatherapi"].open_seconds))
+        await ctx.drain()
+
+    asyncio.run(run())
+
+
+def test_history_flush_writes_entries_queued_during_a_write(worker):
+    app, js, upstreams = worker
+    app.HISTORY_FLUSH_WINDOW = 0.01
+
+    async def run():
+        env, ctx = Env(kv_latency=0.05), ExecutionContext()
+        app.queue_history(ctx, env, "first", {"location": "Oslo"})
+        app.queue_history(ctx, env, "second", {"location": "Lima"})
+        # Lands while the first batch's KV read-modify-write is in flight
+        await asyncio.sleep(0.03)
+        app.queue_history(ctx, env, "third", {"location": "Rome"})
+        await ctx.drain()
+
+        stored = json.loads(await env.CHAT_HISTORY.get("global_chat_history"))
+        assert sorted(entry["query"] for entry in stored) == ["first", "second", "third"]
+        assert app.PENDING_HISTORY == []
+
+    asyncio.run(run())
+
+
+def test_gazetteer_spellings_share_one_snapshot(worker):
+    app, js, upstreams = worker
+    import gazetteer
+
+    assert gazetteer.lookup("NYC").id == "new-york-us"
+    assert gazetteer.lookup("New York City, US").id == "new-york-us"
+    assert gazetteer.lookup("São Paulo").id == "sao-paulo-br"
+    assert gazetteer.lookup("Paris, Texas") is None
+
+    async def run():
+        env, ctx = Env(), ExecutionContext()
+        for location in ("NYC", "new york", "New York City, US"):
+            await app.get_weather({"q": location}, env.WEATHER_API_KEY, env, ctx)
+        assert upstreams.calls["weatherapi"] == 1
+        await ctx.drain()
+
+    asyncio.run(run())
+
+
+def test_unknown_locations_are_negatively_cached_and_not_counted(worker):
+    app, js, upstreams = worker
+
+    async def run():
+        env, ctx = Env(), ExecutionContext()
+        for _ in range(3):
+            with pytest.raises(Exception, match="not found"):
+                await app.get_weather({"q": "Zzyzxville"}, env.WEATHER_API_KEY, env, ctx)
+        assert upstreams.calls["weatherapi"] == 1
+        assert app.POPULARITY.pending.sketch.total == 0
+        await ctx.drain()
+
+    asyncio.run(run())
+
+
+def test_cassette_replays_every_recorded_query(worker):
+    app, js, upstreams = worker
+    from upstream_client import ReplayClient
+
+    replay = ReplayClient(os.path.join(BENCH, "cassettes", "nicosia.json"), latency=0)
+    app.UPSTREAM_CLIENT = replay
+
+    async def run():
+        env, ctx = Env(), ExecutionContext()
+        for query in replay.cassette["queries"]:
+            response, body = await call(app, env, ctx, "POST", "/chat", {"query": query})
+            assert response.status == 200, body
+            assert json.loads(body)["location"].startswith("Nicosia")
+        await ctx.drain()
+
+    asyncio.run(run())
+    assert replay.stats["missing"] == 0
+    assert replay.stats["replayed"] > 0
+
+
+def test_weather_api_encodes_q_and_reports_upstream_failures_as_502(worker):
+    app, js, upstreams = worker
+    from urllib.parse import parse_qs, urlsplit
+
+    sent = []
+
+    async def record(url, method, headers, body):
+        sent.append(parse_qs(urlsplit(url).query))
+        return await upstreams.handle(url, method, headers, body)
+
+    js.FETCH_HANDLER = record
+
+    async def run():
+        env, ctx = Env(), ExecutionContext()
+        for q, expected in (("Springfield%26days%3D1", "Springfield&days=1"), ("Foo%23bar", "Foo#bar")):
+            response, _ = await call(app, env, ctx, "GET", f"/api/weather?q={q}")
+            assert response.status == 200
+            assert sent[-1]["q"] == [expected]
+            assert sent[-1]["days"] == [str(app.SNAPSHOT_DAYS)]
+
+        upstreams.error_share = 1.0
+        response, _ = await call(app, env, ctx, "GET", "/api/weather?q=Lima")
+        assert response.status == 502
+        assert response.headers.get("Cache-Control") == "no-store"
+        await ctx.drain()
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("query, locations", [
+    ("compare weather in Paris, Rome and Berlin", ["Paris", "Rome", "Berlin"]),
+    ("compare Paris, France and Rome, Italy", ["Paris, France", "Rome, Italy"]),
+    ("compare the weather in Washington, DC and New York", ["Washington, DC", "New York"]),
+    ("Tokyo vs Seoul weather", ["Tokyo", "Seoul"]),
+    ("compare weather in Portland, Oregon and Seattle", None),
+    ("compare London, Singapore and Tokyo", None),
+])
+def test_comparison_keeps_qualified_places_together(worker, query, locations):
+    from query_parser import fast_parse
+
+    parsed = fast_parse(query)
+    assert (parsed and parsed["locations"]) == locations
+
+
+def test_geolocated_answers_stay_out_of_global_history(worker):
+    app, js, upstreams = worker
+    app.HISTORY_FLUSH_WINDOW = 0.01
+    cf = {"latitude": "51.5", "longitude": "-0.12", "country": "GB"}
+
+    async def run():
+        env, ctx = Env(), ExecutionContext()
+        for headers in (None, {"Accept": "application/x-ndjson"}):
+            response, _ = await call(app, env, ctx, "POST", "/chat", {"query": "what's the weather here?"}, headers, cf)
+            assert response.status == 200
+        await ctx.drain()
+        assert await env.CHAT_HISTORY.get("global_chat_history") is None
+
+        await call(app, env, ctx, "POST", "/chat", {"query": "weather in Oslo"}, cf=cf)
+        await ctx.drain()
+        stored = json.loads(await env.CHAT_HISTORY.get("global_chat_history"))
+        assert [entry["query"] for entry in stored] == ["weather in Oslo"]
+
+    asyncio.run(run())
+
+
+def test_batch_reports_item_errors_and_bounds_concurrency(worker):
+    app, js, upstreams = worker
+    upstreams.weather_latency = 0.01
+    in_flight, peak = [0], [0]
+
+    async def track(url, method, headers, body):
+        in_flight[0] += 1
+        peak[0] = max(peak[0], in_flight[0])
+        try:
+            return await upstreams.handle(url, method, headers, body)
+        finally:
+            in_flight[0] -= 1
+
+    js.FETCH_HANDLER = track
+
+    async def run():
+        env, ctx = Env(BATCH_TOKEN="secret"), ExecutionContext()
+        items = [{"q": city} for city in ("Oslo", "Lima", "Rome", "Cairo", "Seoul", "Tokyo")] + [{"q": "Zzyzxville"}, 42]
+        response, _ = await call(app, env, ctx, "POST", "/api/chat/batch", {"items": items})
+        assert response.status == 401
+
+        auth = {"Authorization": "Bearer secret"}
+        response, body = await call(app, env, ctx, "POST", "/api/chat/batch", {"items": items, "concurrency": 2}, auth)
+        assert response.status == 200
+        data = json.loads(body)
+        assert [result["ok"] for result in data["results"]] == [True] * 6 + [False, False]
+        assert "not found" in data["results"][6]["error"]
+        assert (data["succeeded"], data["failed"]) == (6, 2)
+        # Limericks are opt-in for batches
+        assert "limerick" not in data["results"][0]["data"] and upstreams.calls["limerick_ai"] == 0
+        assert peak[0] == 2
+        await ctx.drain()
+
+    asyncio.run(run())
+
+
+def test_fast_path_corpus(worker):
+    from query_parser import run_corpus
+
+    assert run_corpus()
+
+
+def test_chat_stream_sends_weather_then_limerick_tokens_then_done(worker):
+    app, js, upstreams = worker
+    upstreams.limerick_latency = 0.02
+
+    async def run():
+        env, ctx = Env(), ExecutionContext()
+        headers = {"Accept": "application/x-ndjson"}
+        response, body = await call(app, env, ctx, "POST", "/chat", {"query": "weather in Oslo"}, headers)
+        assert response.status == 200
+        assert response.headers.get("Content-Type") == "application/x-ndjson"
+        events = [json.loads(line) for line in body.decode("utf-8").splitlines()]
+        types = [event["type"] for event in events]
+        assert types[0] == "weather" and types[-2:] == ["limerick", "done"]
+        assert set(types[1:-2]) == {"limerick_token"}
+        assert "".join(event["text"] for event in events[1:-2]).strip() == events[-2]["text"]
+        assert events[0]["data"]["location"].startswith("Oslo")
+        await ctx.drain()
+
+    asyncio.run(run())
+
+
+def test_history_is_served_with_etag_and_revalidated_with_304(worker):
+    app, js, upstreams = worker
+    app.HISTORY_FLUSH_WINDOW = 0.01
+
+    async def run():
+        env, ctx = Env(), ExecutionContext()
+        await call(app, env, ctx, "POST", "/chat", {"query": "weather in Oslo"})
+        await ctx.drain()
+
+        response, body = await call(app, env, ctx, "GET", "/api/history")
+        assert response.status == 200
+        assert [entry["query"] for entry in json.loads(body)] == ["weather in Oslo"]
+        etag = response.headers.get("ETag")
+        assert etag and "max-age" in response.headers.get("Cache-Control")
+
+        response, body = await call(app, env, ctx, "GET", "/api/history", headers={"If-None-Match": etag})
+        assert response.status == 304 and body == b""
+
+        # This isolate's own writes change the ETag straight away
+        await call(app, env, ctx, "POST", "/chat", {"query": "weather in Lima"})
+        await ctx.drain()
+        response, _ = await call(app, env, ctx, "GET", "/api/history", headers={"If-None-Match": etag})
+        assert response.status == 200 and response.headers.get("ETag") != etag
+
+    asyncio.run(run())
+
+
+def test_chat_page_is_precompressed_and_revalidated_per_encoding(worker):
+    app, js, upstreams = worker
+    import gzip
+
+    async def run():
+        env, ctx = Env(), ExecutionContext()
+        response, plain = await call(app, env, ctx, "GET", "/")
+        assert response.status == 200 and response.headers.get("Content-Encoding") is None
+        assert response.headers.get("Vary") == "Accept-Encoding"
+
+        response, body = await call(app, env, ctx, "GET", "/", headers={"Accept-Encoding": "gzip, deflate"})
+        assert response.headers.get("Content-Encoding") == "gzip"
+        assert gzip.decompress(body) == plain
+        etag = response.headers.get("ETag")
+
+        response, body = await call(app, env, ctx, "GET", "/", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+        assert response.status == 304 and body == b""
+        # The identity variant has its own ETag
+        response, _ = await call(app, env, ctx, "GET", "/", headers={"If-None-Match": etag})
+        assert response.status == 200
+
+    asyncio.run(run())
+
+
+def test_slow_weather_request_is_hedged_and_the_hedge_wins(worker):
+    app, js, upstreams = worker
+    app.HEDGE_DEFAULT_DELAY = 0.02
+    sent = []
+
+    async def first_one_stalls(url, method, headers, body):
+        sent.append(url)
+        if len(sent) == 1:
+            await asyncio.sleep(1)
+        return await upstreams.handle(url, method, headers, body)
+
+    js.FETCH_HANDLER = first_one_stalls
+
+    async def run():
+        env, ctx = Env(), ExecutionContext()
+        started = asyncio.get_running_loop().time()
+        response, _ = await call(app, env, ctx, "GET", "/api/weather?q=Oslo")
+        assert response.status == 200
+        assert asyncio.get_running_loop().time() - started < 0.5
+        assert len(sent) == 2
+        hedges = app.METRICS.counters["hedges_total"]
+        assert hedges[(("result", "fired"), ("upstream", "weatherapi"))] == 1
+        assert hedges[(("result", "won"), ("upstream", "weatherapi"))] == 1
+        await ctx.drain()
+
+    asyncio.run(run())
+
+
+def test_limerick_is_dropped_when_it_would_overrun_the_deadline(worker):
+    app, js, upstreams = worker
+    app.REQUEST_DEADLINE = 0.3
+    app.MIN_LIMERICK_BUDGET = 0.05
+    upstreams.limerick_latency = 1.0
+
+    async def run():
+        env, ctx = Env(), ExecutionContext()
+        started = asyncio.get_running_loop().time()
+        response, body = await call(app, env, ctx, "POST", "/chat", {"query": "weather in Oslo"})
+        assert response.status == 200
+        assert asyncio.get_running_loop().time() - started < 0.6
+        data = json.loads(body)
+        assert data["location"].startswith("Oslo") and data["limerick"] is None
+        assert app.METRICS.counters["deadline_exceeded_total"][(("stage", "limerick"),)] == 1
+        await ctx.drain()
+
+    asyncio.run(run())
+
+
+def test_comparison_keeps_503_and_504_when_every_location_fails(worker):
+    app, js, upstreams = worker
+    query = {"query": "compare weather in Oslo and Lima"}
+
+    async def run():
+        env, ctx = Env(), ExecutionContext()
+        app.BREAKERS["weatherapi"]._open("test")
+        response, _ = await call(app, env, ctx, "POST", "/chat", query)
+        assert response.status == 503 and response.headers.get("Retry-After")
+
+        app.BREAKERS["weatherapi"].state = app.CLOSED
+        app.UPSTREAM_TIMEOUTS["weatherapi"] = 0.02
+        upstreams.weather_latency = 0.2
+        response, _ = await call(app, env, ctx, "POST", "/chat", query)
+        assert response.status == 504
+
+        # One location answering is enough for a 200, with the other's error inline
+        upstreams.weather_latency = 0
+        app.UPSTREAM_TIMEOUTS["weatherapi"] = 3.0
+        response, body = await call(app, env, ctx, "POST", "/chat", {"query": "compare weather in Oslo and Zzyzxville"})
+        assert response.status == 200
+        assert ["error" in entry for entry in json.loads(body)["comparison"]] == [False, True]
+        await ctx.drain()
+
+    asyncio.run(run())
+
+
+def test_prewarm_warms_most_popular_first_within_budget(worker):
+    app, js, upstreams = worker
+    cities = ["Oslo", "Lima", "Rome", "Cairo", "Seoul", "Tokyo"]
+
+    async def run():
+        env = Env(PREWARM_TOP_N="10", PREWARM_BUDGET="3")
+        for rank, city in enumerate(cities):
+            location = app.canonical_location(city)
+            for _ in range(len(cities) - rank):
+                app.POPULARITY.record(app.weather_cache_key(location), location)
+
+        summary = await app.prewarm_popular_locations(env)
+        assert summary == {"due": 6, "warmed": 3, "failed": 0, "deferred": 3}
+        assert upstreams.calls["weatherapi"] == 3
+        for city in cities:
+            cached = await app.WEATHER_CACHE.get(env, app.weather_cache_key(app.canonical_location(city)))
+            assert (cached is not None) == (city in cities[:3])
+
+        # The next run picks up what was deferred
+        summary = await app.prewarm_popular_locations(env)
+        assert summary == {"due": 3, "warmed": 3, "failed": 0, "deferred": 0}
+
+    asyncio.run(run())
+
+
+def test_count_min_top_k_merges_and_decays(worker):
+    from popularity import HeavyHitters
+
+    first, second = HeavyHitters(k=3), HeavyHitters(k=3)
+    for key, count in (("a", 50), ("b", 30), ("c", 20), ("d", 5)):
+        for _ in range(count):
+            first.record(key, key.upper())
+    for key, count in (("d", 60), ("e", 10)):
+        for _ in range(count):
+            second.record(key, key.upper())
+
+    # Estimates never under-count, and d was evicted from first's top 3
+    assert first.sketch.estimate("a") >= 50 and "d" not in first.top
+    first.merge(second)
+    assert [key for key, _, _ in first.ranked()] == ["d", "a", "b"]
+    assert first.sketch.total == 175
+
+    restored = HeavyHitters.from_dict(json.loads(json.dumps(first.to_dict())))
+    assert restored.ranked() == first.ranked()
+
+    first.decay()
+    assert [(key, estimate) for key, _, estimate in first.ranked()][:2] == [("d", 32), ("a", 25)]
+    assert first.sketch.total == 87
+
+
+def test_weather_api_edge_cache_and_private_geolocated_responses(worker):
+    app, js, upstreams = worker
+    edge = js.caches.default
+
+    async def run():
+        env, ctx = Env(), ExecutionContext()
+        response, first = await call(app, env, ctx, "GET", "/api/weather?q=NYC")
+        await ctx.drain()
+        assert response.status == 200 and response.headers.get("Cache-Control").startswith("public, max-age=")
+        # Another spelling of the same place is answered from the edge cache
+        response, second = await call(app, env, ctx, "GET", "/api/weather?q=New%20York%20City,%20US")
+        assert second == first and edge.stats["hits"] == 1
+        assert upstreams.calls["weatherapi"] == 1
+
+        # Without q the answer depends on the caller, so it must not be shared downstream
+        cf = {"latitude": "51.5", "longitude": "-0.12", "country": "GB"}
+        for expected_hits in (1, 2):
+            response, _ = await call(app, env, ctx, "GET", "/api/weather", cf=cf)
+            await ctx.drain()
+            assert response.status == 200
+            assert response.headers.get("Cache-Control") == "private, no-store"
+            assert edge.stats["hits"] == expected_hits
+        assert all(js.Headers(entry[2]).get("Cache-Control").startswith("public") for entry in edge.entries.values())
+
+    asyncio.run(run())
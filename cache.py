@@ -0,0 +1,288 @@
+"""
+Small caching helpers shared by the Worker.
+
+LRUCache is a bounded in-isolate cache with per-entry TTLs. TieredCache puts
+one in front of a KV namespace so entries survive isolate restarts and are
+shared between isolates, while hot keys are still answered from memory.
+Either can keep entries for stale_ttl seconds past expiry, for get_stale()
+to fall back on when a value can't be refreshed and for lookup() to serve
+while it is refreshed in the background (stale-while-revalidate).
+SingleFlight coalesces concurrent cache misses for the same key onto one
+upstream call.
+"""
+import asyncio
+import json
+import time
+from collections import OrderedDict
+
+import telemetry as log
+
+
+def cache_namespace(env):
+    """KV namespace used for caches: a dedicated CACHE_KV binding if configured, else CHAT_HISTORY"""
+    return getattr(env, "CACHE_KV", None) or getattr(env, "CHAT_HISTORY", None)
+
+
+class LRUCache:
+    """Bounded in-isolate LRU cache with per-entry expiry"""
+
+    def __init__(self, max_entries, ttl, stale_ttl=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+
+        expires_at, value = entry
+        now = time.time()
+        if expires_at <= now:
+            if expires_at + self.stale_ttl <= now:
+                del self.entries[key]
+            self.stats["expired"] += 1
+            self.stats["misses"] += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return value
+
+    def get_entry(self, key):
+        """(expires_at, value) for key, expired or not, while it is within stale_ttl of expiry"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] + self.stale_ttl <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def get_stale(self, key):
+        """Value for key even if it has expired, as long as it is within stale_ttl of expiry"""
+        entry = self.get_entry(key)
+        return entry[1] if entry is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.entries[key] = (time.time() + (ttl or self.ttl), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class TieredCache:
+    """
+    In-isolate LRU backed by KV. Values are kept as-is in memory; encode and
+    decode convert them to and from a JSON-serialisable form for KV. Entries
+    are kept (but not returned by get()) for stale_ttl seconds after expiry.
+    """
+
+    # KV rejects expirationTtl values below 60 seconds
+    KV_MIN_TTL = 60
+
+    def __init__(self, prefix, max_entries, ttl, encode=None, decode=None, stale_ttl=0):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.encode = encode or (lambda value: value)
+        self.decode = decode or (lambda value: value)
+        self.memory = LRUCache(max_entries, ttl, stale_ttl)
+        self.stats = {"memory_hits": 0, "kv_hits": 0, "misses": 0, "kv_errors": 0, "stale_hits": 0}
+
+    def kv_key(self, key):
+        return f"{self.prefix}:{key}"
+
+    async def get(self, env, key):
+        """Return the cached value for key, or None on a miss"""
+        value = self.memory.get(key)
+        if value is not None:
+            self.stats["memory_hits"] += 1
+            return value
+
+        kv = cache_namespace(env)
+        if kv is not None:
+            try:
+                with log.stage("kv"):
+                    stored = await kv.get(self.kv_key(key))
+                if stored:
+                    entry = json.loads(stored)
+                    remaining = entry["expires_at"] - time.time()
+                    if remaining > 0:
+                        value = self.decode(entry["value"])
+                        self.memory.set(key, value, ttl=remaining)
+                        self.stats["kv_hits"] += 1
+                        return value
+            except Exception as e:
+                self.stats["kv_errors"] += 1
+                log.warning("Cache", "Error reading %s from KV: %s", self.kv_key(key), e)
+
+        self.stats["misses"] += 1
+        return None
+
+    async def lookup(self, env, key, max_stale):
+        """
+        (value, expired) for stale-while-revalidate: a fresh value, or one
+        that expired at most max_stale seconds ago (expired=True) for the
+        caller to serve while it refreshes the entry. (None, False) on a miss.
+        """
+        now = time.time()
+        entry = self.memory.get_entry(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > now:
+                self.stats["memory_hits"] += 1
+                return value, False
+            if expires_at + max_stale > now:
+                self.stats["stale_hits"] += 1
+                return value, True
+
+        kv = cache_namespace(env)
+        if kv is not None:
+            try:
+                with log.stage("kv"):
+                    stored = await kv.get(self.kv_key(key))
+                if stored:
+                    entry = json.loads(stored)
+                    remaining = entry["expires_at"] - now
+                    if remaining > -max_stale:
+                        value = self.decode(entry["value"])
+                        self.memory.set(key, value, ttl=remaining)
+                        if remaining > 0:
+                            self.stats["kv_hits"] += 1
+                            return value, False
+                        self.stats["stale_hits"] += 1
+                        return value, True
+            except Exception as e:
+                self.stats["kv_errors"] += 1
+                log.warning("Cache", "Error reading %s from KV: %s", self.kv_key(key), e)
+
+        self.stats["misses"] += 1
+        return None, False
+
+    async def expires_in(self, env, key):
+        """
+        Seconds until key expires (negative once it has), or None if it isn't
+        cached. KV is checked even on a memory hit, since another isolate may
+        have refreshed the entry since.
+        """
+        entry = self.memory.get_entry(key)
+        expires_at = entry[0] if entry is not None else None
+
+        kv = cache_namespace(env)
+        if kv is not None:
+            try:
+                with log.stage("kv"):
+                    stored = await kv.get(self.kv_key(key))
+                if stored:
+                    stored_expires_at = json.loads(stored)["expires_at"]
+                    expires_at = stored_expires_at if expires_at is None else max(expires_at, stored_expires_at)
+            except Exception as e:
+                self.stats["kv_errors"] += 1
+                log.warning("Cache", "Error reading %s from KV: %s", self.kv_key(key), e)
+
+        return expires_at - time.time() if expires_at is not None else None
+
+    async def get_stale(self, env, key):
+        """
+        The last value stored for key, fresh or expired within stale_ttl, or
+        None. For serving something when the value can't be refreshed.
+        """
+        value = self.memory.get_stale(key)
+        if value is None:
+            kv = cache_namespace(env)
+            if kv is None:
+                return None
+            try:
+                with log.stage("kv"):
+                    stored = await kv.get(self.kv_key(key))
+                if stored:
+                    entry = json.loads(stored)
+                    if entry["expires_at"] + self.stale_ttl > time.time():
+                        value = self.decode(entry["value"])
+            except Exception as e:
+                self.stats["kv_errors"] += 1
+                log.warning("Cache", "Error reading %s from KV: %s", self.kv_key(key), e)
+
+        if value is not None:
+            self.stats["stale_hits"] += 1
+        return value
+
+    async def set(self, env, key, value, ttl=None):
+        """Store value in memory and KV; KV failures are logged, not raised"""
+        ttl = ttl or self.ttl
+        self.memory.set(key, value, ttl=ttl)
+
+        kv = cache_namespace(env)
+        if kv is None:
+            return
+        try:
+            entry = json.dumps({"expires_at": time.time() + ttl, "value": self.encode(value)})
+            with log.stage("kv"):
+                await kv.put(self.kv_key(key), entry, expirationTtl=max(int(ttl + self.stale_ttl), self.KV_MIN_TTL))
+        except Exception as e:
+            self.stats["kv_errors"] += 1
+            log.warning("Cache", "Error writing %s to KV: %s", self.kv_key(key), e)
+
+    def hit_rate(self):
+        hits = self.stats["memory_hits"] + self.stats["kv_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls for the same key onto one in-flight task.
+
+    The first caller for a key starts the work; callers that arrive while it
+    is running await the same task and share its result or exception. If
+    every caller gives up (e.g. a stage deadline cancels them), the task is
+    cancelled too rather than left running with nothing to keep the
+    invocation alive.
+    """
+
+    def __init__(self):
+        self.in_flight = {}
+        self.waiters = {}  # task -> callers currently awaiting it
+        self.stats = {"calls": 0, "coalesced": 0}
+
+    async def do(self, key, func, *args):
+        task = self.in_flight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["calls"] += 1
+            task = asyncio.ensure_future(func(*args))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda done, key=key: self._forget(key, done))
+
+        self.waiters[task] = self.waiters.get(task, 0) + 1
+        try:
+            # Shield so one cancelled waiter doesn't cancel the shared work
+            return await asyncio.shield(task)
+        finally:
+            remaining = self.waiters.pop(task) - 1
+            if remaining:
+                self.waiters[task] = remaining
+            elif not task.done():
+                # The last waiter was cancelled; later callers start afresh
+                self._forget(key, task)
+                task.cancel()
+
+    def _forget(self, key, task):
+        if self.in_flight.get(key) is task:
+            del self.in_flight[key]
+        if task.done() and not task.cancelled():
+            # Mark the exception retrieved even if no waiter was left to see it
+            task.exception()
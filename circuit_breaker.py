@@ -0,0 +1,103 @@
+"""
+Per-upstream circuit breakers.
+
+A breaker watches the outcome and duration of the last `window` calls to one
+upstream. Once at least `min_calls` have been seen and too many of them
+failed or were slow, it opens: calls are rejected straight away with
+CircuitOpen instead of waiting on an upstream that is known to be in
+trouble. After `open_seconds` it goes half-open and lets a single probe call
+through; if the probe succeeds the breaker closes, otherwise it opens again.
+
+Breakers are per isolate, so each isolate trips on its own traffic.
+"""
+import time
+from collections import deque
+
+import telemetry as log
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    """The upstream's breaker is open, so the call was not attempted"""
+
+
+class CircuitBreaker:
+    """Error-rate and slow-call-rate breaker with half-open probing"""
+
+    def __init__(self, name, window=20, min_calls=10, failure_rate=0.5, slow_call_ms=2000.0, slow_rate=0.8,
+                 open_seconds=30.0):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_ms = slow_call_ms
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self.calls = deque(maxlen=window)  # (failed, slow) per recent call
+        self.opened_at = 0.0
+        self.probing = False
+        self.stats = {"opened": 0, "rejected": 0}
+
+    def allow(self):
+        """Whether a call may go ahead now. Half-open breakers allow one probe at a time."""
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.open_seconds:
+                self.stats["rejected"] += 1
+                return False
+            self.state = HALF_OPEN
+            self.probing = False
+            log.info("Circuit", "%s half-open, probing", self.name)
+
+        if self.state == HALF_OPEN:
+            if self.probing:
+                self.stats["rejected"] += 1
+                return False
+            self.probing = True
+        return True
+
+    def check(self):
+        """Raise CircuitOpen unless a call may go ahead"""
+        if not self.allow():
+            raise CircuitOpen(f"{self.name} is unavailable (circuit open)")
+
+    def record(self, failed, duration_ms):
+        """Record the outcome of a call that allow() let through"""
+        slow = duration_ms >= self.slow_call_ms
+        if self.state == HALF_OPEN:
+            self.probing = False
+            if failed or slow:
+                self._open("probe failed" if failed else f"probe took {duration_ms:.0f}ms")
+            else:
+                self.state = CLOSED
+                self.calls.clear()
+                log.info("Circuit", "%s closed", self.name)
+            return
+
+        if self.state == OPEN:
+            # A call that started before the breaker opened
+            return
+
+        self.calls.append((failed, slow))
+        if len(self.calls) < self.min_calls:
+            return
+        failures = sum(1 for call_failed, _ in self.calls if call_failed)
+        slow_calls = sum(1 for _, call_slow in self.calls if call_slow)
+        if failures >= self.failure_rate * len(self.calls):
+            self._open(f"{failures} of the last {len(self.calls)} calls failed")
+        elif slow_calls >= self.slow_rate * len(self.calls):
+            self._open(f"{slow_calls} of the last {len(self.calls)} calls took over {self.slow_call_ms:.0f}ms")
+
+    def release(self):
+        """A call ended without an outcome (it was cancelled); frees the half-open probe slot"""
+        if self.state == HALF_OPEN:
+            self.probing = False
+
+    def _open(self, reason):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.calls.clear()
+        self.stats["opened"] += 1
+        log.warning("Circuit", "%s opened for %.0fs: %s", self.name, self.open_seconds, reason)
@@ -0,0 +1,47 @@
+"""
+Time budgets for requests and upstream calls.
+
+A Deadline is created when a request arrives and each stage runs under
+Deadline.run(), which cancels the stage once it overruns its own cap or the
+time left in the request, whichever is sooner. Per-call upstream timeouts
+raise the same DeadlineExceeded, so callers handle both alike.
+"""
+import asyncio
+import time
+
+
+class DeadlineExceeded(Exception):
+    """A stage or upstream call ran out of time"""
+
+
+async def run_with_timeout(coro, timeout, what):
+    """Await coro, cancelling it and raising DeadlineExceeded after timeout seconds"""
+    if timeout <= 0:
+        coro.close()
+        raise DeadlineExceeded(f"No time left for {what}")
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(f"{what} timed out after {timeout:.1f}s")
+
+
+class Deadline:
+    """Time budget for one request, shared by its stages"""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self):
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    async def run(self, coro, what, cap=None, minimum=0.0):
+        """
+        Run a stage within the remaining budget, capped at cap seconds. The
+        stage is not started at all if less than minimum seconds are left.
+        """
+        timeout = self.remaining() if cap is None else min(cap, self.remaining())
+        if timeout < minimum:
+            coro.close()
+            raise DeadlineExceeded(f"Only {timeout:.1f}s left, not enough for {what}")
+        return await run_with_timeout(coro, timeout, what)
@@ -0,0 +1,218 @@
+"""
+Local gazetteer for canonicalizing location strings.
+
+"NYC", "new york" and "New York City, US" are different strings but one
+place. lookup() maps any known name or alias, optionally qualified by a
+country or region ("Paris, France", "Portland, OR"), to a Place with a
+canonical id and coordinates, so the weather cache can key on the place
+instead of on how it was typed. A qualifier that doesn't match the place
+("Paris, Texas") means the string is not that place and lookup() returns
+None.
+
+Names are normalized (case, accents, punctuation and spacing folded) and
+kept in one sorted array searched with bisect, so the index is a few
+kilobytes and a lookup is O(log n) with no per-request allocation beyond
+the normalized string.
+"""
+import re
+import unicodedata
+from bisect import bisect_left
+
+# code -> names and abbreviations accepted as a qualifier
+COUNTRIES = {
+    "AE": "United Arab Emirates|uae",
+    "AR": "Argentina",
+    "AT": "Austria",
+    "AU": "Australia",
+    "BE": "Belgium",
+    "BR": "Brazil",
+    "CA": "Canada",
+    "CH": "Switzerland",
+    "CN": "China|prc",
+    "CY": "Cyprus",
+    "CZ": "Czech Republic|czechia",
+    "DE": "Germany|deutschland",
+    "DK": "Denmark",
+    "EG": "Egypt",
+    "ES": "Spain|espana",
+    "FI": "Finland",
+    "FR": "France",
+    "GB": "United Kingdom|uk|great britain|britain|england|scotland",
+    "GR": "Greece",
+    "HK": "Hong Kong",
+    "HU": "Hungary",
+    "ID": "Indonesia",
+    "IE": "Ireland",
+    "IL": "Israel",
+    "IN": "India",
+    "IT": "Italy|italia",
+    "JP": "Japan",
+    "KE": "Kenya",
+    "KR": "South Korea|korea",
+    "MX": "Mexico",
+    "NG": "Nigeria",
+    "NL": "Netherlands|holland|the netherlands",
+    "NO": "Norway",
+    "NZ": "New Zealand",
+    "PE": "Peru",
+    "PL": "Poland",
+    "PT": "Portugal",
+    "RU": "Russia",
+    "SE": "Sweden",
+    "SG": "Singapore",
+    "TH": "Thailand",
+    "TR": "Turkey|turkiye",
+    "US": "United States|usa|united states of america|america",
+    "ZA": "South Africa",
+}
+
+# id, name, country code, latitude, longitude, aliases (|-separated, may be empty),
+# region qualifiers (|-separated, may be empty)
+PLACES = (
+    ("amsterdam-nl", "Amsterdam", "NL", 52.37, 4.89, "", ""),
+    ("athens-gr", "Athens", "GR", 37.98, 23.73, "athina", ""),
+    ("austin-us", "Austin", "US", 30.27, -97.74, "", "tx|texas"),
+    ("bangkok-th", "Bangkok", "TH", 13.75, 100.5, "krung thep", ""),
+    ("barcelona-es", "Barcelona", "ES", 41.39, 2.17, "", "catalonia"),
+    ("beijing-cn", "Beijing", "CN", 39.9, 116.41, "peking", ""),
+    ("berlin-de", "Berlin", "DE", 52.52, 13.4, "", ""),
+    ("boston-us", "Boston", "US", 42.36, -71.06, "", "ma|massachusetts"),
+    ("brussels-be", "Brussels", "BE", 50.85, 4.35, "bruxelles|brussel", ""),
+    ("budapest-hu", "Budapest", "HU", 47.5, 19.04, "", ""),
+    ("buenos-aires-ar", "Buenos Aires", "AR", -34.6, -58.38, "", ""),
+    ("cairo-eg", "Cairo", "EG", 30.04, 31.24, "al qahirah", ""),
+    ("cape-town-za", "Cape Town", "ZA", -33.92, 18.42, "kaapstad", ""),
+    ("chicago-us", "Chicago", "US", 41.88, -87.63, "chi town|chi-town", "il|illinois"),
+    ("copenhagen-dk", "Copenhagen", "DK", 55.68, 12.57, "kobenhavn", ""),
+    ("delhi-in", "Delhi", "IN", 28.61, 77.21, "new delhi", ""),
+    ("dubai-ae", "Dubai", "AE", 25.2, 55.27, "", ""),
+    ("dublin-ie", "Dublin", "IE", 53.35, -6.26, "baile atha cliath", ""),
+    ("edinburgh-gb", "Edinburgh", "GB", 55.95, -3.19, "", ""),
+    ("helsinki-fi", "Helsinki", "FI", 60.17, 24.94, "", ""),
+    ("hong-kong-hk", "Hong Kong", "HK", 22.32, 114.17, "hk", ""),
+    ("istanbul-tr", "Istanbul", "TR", 41.01, 28.98, "constantinople", ""),
+    ("jakarta-id", "Jakarta", "ID", -6.21, 106.85, "", ""),
+    ("jerusalem-il", "Jerusalem", "IL", 31.77, 35.21, "", ""),
+    ("johannesburg-za", "Johannesburg", "ZA", -26.2, 28.05, "joburg|jozi", ""),
+    ("lagos-ng", "Lagos", "NG", 6.52, 3.38, "", ""),
+    ("larnaca-cy", "Larnaca", "CY", 34.92, 33.62, "larnaka", ""),
+    ("lima-pe", "Lima", "PE", -12.05, -77.04, "", ""),
+    ("limassol-cy", "Limassol", "CY", 34.68, 33.04, "lemesos", ""),
+    ("lisbon-pt", "Lisbon", "PT", 38.72, -9.14, "lisboa", ""),
+    ("london-gb", "London", "GB", 51.51, -0.13, "", ""),
+    ("los-angeles-us", "Los Angeles", "US", 34.05, -118.24, "la|l a", "ca|california"),
+    ("madrid-es", "Madrid", "ES", 40.42, -3.7, "", ""),
+    ("manchester-gb", "Manchester", "GB", 53.48, -2.24, "", ""),
+    ("melbourne-au", "Melbourne", "AU", -37.81, 144.96, "", "vic|victoria"),
+    ("mexico-city-mx", "Mexico City", "MX", 19.43, -99.13, "cdmx|ciudad de mexico", ""),
+    ("miami-us", "Miami", "US", 25.76, -80.19, "", "fl|florida"),
+    ("milan-it", "Milan", "IT", 45.46, 9.19, "milano", ""),
+    ("montreal-ca", "Montreal", "CA", 45.5, -73.57, "", "qc|quebec"),
+    ("moscow-ru", "Moscow", "RU", 55.76, 37.62, "moskva", ""),
+    ("mumbai-in", "Mumbai", "IN", 19.08, 72.88, "bombay", ""),
+    ("munich-de", "Munich", "DE", 48.14, 11.58, "munchen|muenchen", "bavaria"),
+    ("nairobi-ke", "Nairobi", "KE", -1.29, 36.82, "", ""),
+    ("new-york-us", "New York", "US", 40.71, -74.01, "nyc|new york city|ny|big apple|manhattan", "ny"),
+    ("nicosia-cy", "Nicosia", "CY", 35.17, 33.36, "lefkosia|lefkosa", ""),
+    ("osaka-jp", "Osaka", "JP", 34.69, 135.5, "", ""),
+    ("oslo-no", "Oslo", "NO", 59.91, 10.75, "", ""),
+    ("paphos-cy", "Paphos", "CY", 34.78, 32.42, "pafos", ""),
+    ("paris-fr", "Paris", "FR", 48.86, 2.35, "", ""),
+    ("prague-cz", "Prague", "CZ", 50.08, 14.44, "praha", ""),
+    ("rio-de-janeiro-br", "Rio de Janeiro", "BR", -22.91, -43.17, "rio", ""),
+    ("rome-it", "Rome", "IT", 41.9, 12.5, "roma", ""),
+    ("san-francisco-us", "San Francisco", "US", 37.77, -122.42, "sf|san fran|frisco", "ca|california"),
+    ("sao-paulo-br", "Sao Paulo", "BR", -23.55, -46.63, "", ""),
+    ("seattle-us", "Seattle", "US", 47.61, -122.33, "", "wa|washington"),
+    ("seoul-kr", "Seoul", "KR", 37.57, 126.98, "", ""),
+    ("shanghai-cn", "Shanghai", "CN", 31.23, 121.47, "", ""),
+    ("singapore-sg", "Singapore", "SG", 1.35, 103.82, "", ""),
+    ("stockholm-se", "Stockholm", "SE", 59.33, 18.07, "", ""),
+    ("sydney-au", "Sydney", "AU", -33.87, 151.21, "", "nsw|new south wales"),
+    ("tel-aviv-il", "Tel Aviv", "IL", 32.09, 34.78, "tel aviv yafo|tel aviv-yafo", ""),
+    ("tokyo-jp", "Tokyo", "JP", 35.68, 139.69, "", ""),
+    ("toronto-ca", "Toronto", "CA", 43.65, -79.38, "", "on|ontario"),
+    ("vancouver-ca", "Vancouver", "CA", 49.28, -123.12, "", "bc|british columbia"),
+    ("vienna-at", "Vienna", "AT", 48.21, 16.37, "wien", ""),
+    ("warsaw-pl", "Warsaw", "PL", 52.23, 21.01, "warszawa", ""),
+    ("washington-dc-us", "Washington", "US", 38.91, -77.04, "washington dc|washington d c|dc", "dc|d c"),
+    ("wellington-nz", "Wellington", "NZ", -41.29, 174.78, "", ""),
+    ("zurich-ch", "Zurich", "CH", 47.37, 8.54, "zuerich", ""),
+)
+
+
+class Place:
+    """A gazetteer entry: canonical id, display name, country code and coordinates"""
+
+    __slots__ = ("id", "name", "country", "lat", "lon", "qualifiers")
+
+    def __init__(self, place_id, name, country, lat, lon, qualifiers):
+        self.id = place_id
+        self.name = name
+        self.country = country
+        self.lat = lat
+        self.lon = lon
+        self.qualifiers = qualifiers  # normalized country and region names accepted after a comma
+
+    @property
+    def query(self):
+        """WeatherAPI q parameter: coordinates, which are unambiguous"""
+        return f"{self.lat},{self.lon}"
+
+
+def normalize_name(text):
+    """Fold case, accents, punctuation and spacing: "São Paulo " -> "sao paulo", "D.C." -> "dc" """
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(char for char in text if not unicodedata.combining(char)).lower()
+    text = re.sub(r"[.']", "", text)
+    return re.sub(r"[^a-z0-9]+", " ", text).strip()
+
+
+def _build_index():
+    places = []
+    entries = {}
+    for place_id, name, country, lat, lon, aliases, regions in PLACES:
+        qualifiers = {normalize_name(country)}
+        qualifiers.update(normalize_name(alias) for alias in COUNTRIES[country].split("|"))
+        qualifiers.update(normalize_name(region) for region in regions.split("|") if region)
+        places.append(Place(place_id, name, country, lat, lon, frozenset(qualifiers)))
+        for alias in [name] + [alias for alias in aliases.split("|") if alias]:
+            entries.setdefault(normalize_name(alias), len(places) - 1)
+    names = sorted(entries)
+    return tuple(places), tuple(names), tuple(entries[name] for name in names)
+
+
+_PLACES, _NAMES, _PLACE_INDEX = _build_index()
+_QUALIFIERS = frozenset().union(*(place.qualifiers for place in _PLACES))
+
+
+def _find(name):
+    index = bisect_left(_NAMES, name)
+    if index < len(_NAMES) and _NAMES[index] == name:
+        return _PLACES[_PLACE_INDEX[index]]
+    return None
+
+
+def lookup(location):
+    """The Place a location string refers to, or None if it isn't in the gazetteer"""
+    place = _find(normalize_name(location))
+    if place is not None:
+        return place
+
+    # "Name, Qualifier[, Qualifier]": every qualifier must belong to the place
+    name, _, rest = location.partition(",")
+    if not rest:
+        return None
+    place = _find(normalize_name(name))
+    if place is None:
+        return None
+    for qualifier in rest.split(","):
+        qualifier = normalize_name(qualifier)
+        if qualifier and qualifier not in place.qualifiers:
+            return None
+    return place
+
+
+def is_qualifier(text):
+    """Whether text is a country or region the gazetteer accepts after a comma ("France", "OR", "Texas")"""
+    return normalize_name(text) in _QUALIFIERS
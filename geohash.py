@@ -0,0 +1,63 @@
+"""
+Geohash encoding for bucketing coordinates.
+
+A geohash interleaves longitude and latitude bisection bits and writes them
+in base 32, so nearby points share a prefix and every prefix names a
+rectangular cell (precision 4 is about 39km x 20km at the equator,
+precision 5 about 4.9km x 4.9km). bucket() maps a point to its cell and the
+cell's centre, so everyone in the cell shares one cache key and one
+upstream lookup, and precise user coordinates are never sent upstream.
+"""
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def encode(lat, lon, precision=5):
+    """Geohash of a point, precision characters long"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True  # even bits are longitude
+    while len(chars) < precision:
+        interval, coordinate = (lon_range, lon) if even else (lat_range, lat)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits = 0
+            value = 0
+    return "".join(chars)
+
+
+def decode(geohash):
+    """Centre (lat, lon) of a geohash cell"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        value = BASE32.index(char)
+        for shift in range(4, -1, -1):
+            interval = lon_range if even else lat_range
+            middle = (interval[0] + interval[1]) / 2
+            if value >> shift & 1:
+                interval[0] = middle
+            else:
+                interval[1] = middle
+            even = not even
+    return (lat_range[0] + lat_range[1]) / 2, (lon_range[0] + lon_range[1]) / 2
+
+
+def bucket(lat, lon, precision=5):
+    """(geohash, centre lat, centre lon) of the cell containing a point"""
+    geohash = encode(lat, lon, precision)
+    center_lat, center_lon = decode(geohash)
+    return geohash, center_lat, center_lon
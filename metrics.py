@@ -0,0 +1,149 @@
+"""
+In-isolate metrics for GET /api/metrics.
+
+Histogram is a fixed-memory, HDR-style latency histogram: each power of two
+is split into SUB_BUCKETS linear buckets, so quantiles stay within a few
+percent of the true value no matter how many samples are recorded.
+MetricsRegistry holds labelled counters and histograms and renders them in
+the Prometheus text exposition format.
+
+Each isolate keeps its own metrics from the moment it starts.
+"""
+import math
+
+
+class Histogram:
+    """Log-linear histogram of millisecond durations from ~0.01ms to ~131s"""
+
+    SUB_BUCKETS = 16
+    MIN_EXPONENT = -6
+    MAX_EXPONENT = 17
+
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * ((self.MAX_EXPONENT - self.MIN_EXPONENT) * self.SUB_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def bucket(self, value):
+        """Index of the bucket holding value; out-of-range values go to the end buckets"""
+        if value <= 0:
+            return 0
+        mantissa, exponent = math.frexp(value)  # value = mantissa * 2**exponent, 0.5 <= mantissa < 1
+        if exponent <= self.MIN_EXPONENT:
+            return 0
+        if exponent > self.MAX_EXPONENT:
+            return len(self.counts) - 1
+        return (exponent - self.MIN_EXPONENT - 1) * self.SUB_BUCKETS + int((mantissa - 0.5) * 2 * self.SUB_BUCKETS)
+
+    def bucket_midpoint(self, index):
+        exponent = index // self.SUB_BUCKETS + self.MIN_EXPONENT + 1
+        width = 2.0 ** exponent / (2 * self.SUB_BUCKETS)
+        return 2.0 ** (exponent - 1) + (index % self.SUB_BUCKETS + 0.5) * width
+
+    def record(self, value):
+        self.counts[self.bucket(value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Approximate q-quantile (0-1) of the recorded values, or None if empty"""
+        if not self.count:
+            return None
+        rank = max(math.ceil(q * self.count), 1)
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(self.bucket_midpoint(index), self.max)
+        return self.max
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value is None:
+        return "NaN"
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+class MetricsRegistry:
+    """Labelled counters and millisecond histograms, rendered as Prometheus text"""
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.descriptions = {}  # name -> help text
+        self.counters = {}  # name -> {labels: value}
+        self.histograms = {}  # name -> {labels: Histogram}
+
+    def describe(self, name, description):
+        self.descriptions[name] = description
+
+    def inc(self, name, value=1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def histogram(self, name, **labels):
+        """The histogram for a name and label set, created empty if it doesn't exist yet"""
+        series = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram()
+        return histogram
+
+    def observe(self, name, duration_ms, **labels):
+        self.histogram(name, **labels).record(duration_ms)
+
+    def _header(self, lines, name, metric_type):
+        full_name = f"{self.prefix}_{name}"
+        if name in self.descriptions:
+            lines.append(f"# HELP {full_name} {self.descriptions[name]}")
+        lines.append(f"# TYPE {full_name} {metric_type}")
+        return full_name
+
+    def render(self, collected=()):
+        """
+        Prometheus text exposition of all counters and histograms, plus metrics
+        collected at scrape time as (name, type, [(labels dict, value), ...]).
+        Histograms are rendered as summaries in seconds with p50/p95/p99 quantiles.
+        """
+        lines = []
+        for name, series in sorted(self.counters.items()):
+            full_name = self._header(lines, name, "counter")
+            for labels, value in sorted(series.items()):
+                lines.append(f"{full_name}{_format_labels(labels)} {_format_value(value)}")
+
+        for name, series in sorted(self.histograms.items()):
+            full_name = self._header(lines, name, "summary")
+            for labels, histogram in sorted(series.items()):
+                for q in self.QUANTILES:
+                    quantile = histogram.quantile(q)
+                    value = quantile / 1000 if quantile is not None else None
+                    lines.append(f"{full_name}{_format_labels(labels + (('quantile', str(q)),))} {_format_value(value)}")
+                lines.append(f"{full_name}_sum{_format_labels(labels)} {_format_value(histogram.sum / 1000)}")
+                lines.append(f"{full_name}_count{_format_labels(labels)} {histogram.count}")
+
+        for name, metric_type, samples in collected:
+            full_name = self._header(lines, name, metric_type)
+            for labels, value in samples:
+                lines.append(f"{full_name}{_format_labels(tuple(sorted(labels.items())))} {_format_value(value)}")
+
+        return "\n".join(lines) + "\n"
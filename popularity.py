@@ -0,0 +1,247 @@
+"""
+Approximate request counts per location, shared between isolates through KV.
+
+Each isolate records the locations it serves in a HeavyHitters structure:
+a count-min sketch (a fixed DEPTH x WIDTH table of counters) estimates how
+often any location was requested, and a min-heap keeps the K locations with
+the highest estimates. Estimates never under-count, and over-count by at
+most e/WIDTH of all requests with probability 1 - e^-DEPTH. Recording a
+request costs DEPTH counter updates plus at most a heap operation, however
+many distinct locations there are.
+
+At most once per flush interval an isolate merges its sketch into the KV
+record (sketches add cell by cell) and re-ranks the union of both top-K
+lists against the merged sketch. Counts in KV are halved every decay
+interval so the ranking follows recent traffic. Merges are
+read-modify-write, so concurrent flushes from different isolates can
+occasionally drop a few counts; the ranking is what matters.
+"""
+import base64
+import hashlib
+import heapq
+import json
+import math
+import time
+from array import array
+
+import telemetry as log
+from cache import cache_namespace
+
+
+class CountMinSketch:
+    """Fixed-memory frequency estimates for arbitrary string keys"""
+
+    def __init__(self, width=1024, depth=4):
+        self.width = width
+        self.depth = depth
+        self.counts = array("I", [0]) * (width * depth)
+        self.total = 0
+
+    def _cells(self, key):
+        # One stable hash split into DEPTH row hashes, so every isolate maps a key to the same cells
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=4 * self.depth).digest()
+        return [
+            row * self.width + int.from_bytes(digest[4 * row:4 * row + 4], "little") % self.width
+            for row in range(self.depth)
+        ]
+
+    def add(self, key, count=1):
+        """Count key and return its new estimate"""
+        cells = self._cells(key)
+        for cell in cells:
+            self.counts[cell] += count
+        self.total += count
+        return min(self.counts[cell] for cell in cells)
+
+    def estimate(self, key):
+        return min(self.counts[cell] for cell in self._cells(key))
+
+    def error_bound(self):
+        """How far an estimate may exceed the true count (with probability 1 - e^-depth)"""
+        return math.ceil(math.e / self.width * self.total)
+
+    def merge(self, other):
+        """Add another sketch of the same dimensions into this one"""
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.total += other.total
+
+    def decay(self):
+        """Halve every counter"""
+        self.counts = array("I", (count >> 1 for count in self.counts))
+        self.total >>= 1
+
+    def to_dict(self):
+        return {
+            "width": self.width,
+            "depth": self.depth,
+            "total": self.total,
+            "counts": base64.b64encode(self.counts.tobytes()).decode("ascii"),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["width"], data["depth"])
+        sketch.counts = array("I")
+        sketch.counts.frombytes(base64.b64decode(data["counts"]))
+        sketch.total = data["total"]
+        return sketch
+
+
+class HeavyHitters:
+    """A count-min sketch plus the k keys with the highest estimated counts"""
+
+    def __init__(self, k=50, width=1024, depth=4):
+        self.k = k
+        self.sketch = CountMinSketch(width, depth)
+        self.top = {}  # key -> [estimate, location]
+        self.heap = []  # (estimate, key) for keys in top; estimates may lag behind top's
+
+    def record(self, key, location, count=1):
+        """Count one request for key (shown as location) in O(depth + log k)"""
+        self._offer(key, location, self.sketch.add(key, count))
+
+    def _offer(self, key, location, estimate):
+        entry = self.top.get(key)
+        if entry is not None:
+            # Estimates only grow, so the heap entry is refreshed lazily
+            entry[0] = estimate
+            return
+        if len(self.top) < self.k:
+            self.top[key] = [estimate, location]
+            heapq.heappush(self.heap, (estimate, key))
+            return
+
+        # Bring the smallest heap entry up to date before comparing against it
+        while self.heap[0][0] != self.top[self.heap[0][1]][0]:
+            smallest = self.heap[0][1]
+            heapq.heapreplace(self.heap, (self.top[smallest][0], smallest))
+        if estimate > self.heap[0][0]:
+            _, evicted = heapq.heapreplace(self.heap, (estimate, key))
+            del self.top[evicted]
+            self.top[key] = [estimate, location]
+
+    def _rank(self, candidates):
+        """Rebuild the top k from (key, location) candidates, re-estimated against the sketch"""
+        self.top = {}
+        self.heap = []
+        for key, location in candidates:
+            self._offer(key, location, self.sketch.estimate(key))
+
+    def merge(self, other):
+        """Add another isolate's counts and re-rank both top lists"""
+        candidates = {key: entry[1] for key, entry in self.top.items()}
+        candidates.update((key, entry[1]) for key, entry in other.top.items())
+        self.sketch.merge(other.sketch)
+        self._rank(candidates.items())
+
+    def decay(self):
+        """Halve all counts, so older traffic weighs half as much as new"""
+        self.sketch.decay()
+        self._rank([(key, entry[1]) for key, entry in self.top.items()])
+
+    def ranked(self, n=None):
+        """The top keys as (key, location, estimate), highest first"""
+        ordered = sorted(self.top.items(), key=lambda item: item[1][0], reverse=True)
+        return [(key, location, estimate) for key, (estimate, location) in ordered[:n]]
+
+    def to_dict(self):
+        return {"k": self.k, "sketch": self.sketch.to_dict(), "top": self.ranked()}
+
+    @classmethod
+    def from_dict(cls, data):
+        hitters = cls(data["k"])
+        hitters.sketch = CountMinSketch.from_dict(data["sketch"])
+        for key, location, estimate in data["top"]:
+            hitters.top[key] = [estimate, location]
+            hitters.heap.append((estimate, key))
+        heapq.heapify(hitters.heap)
+        return hitters
+
+
+class PopularityTracker:
+    """In-isolate heavy hitters, periodically merged into one KV record"""
+
+    def __init__(self, kv_key="popular_locations", flush_interval=60, decay_interval=60 * 60, k=50, width=1024, depth=4):
+        self.kv_key = kv_key
+        self.flush_interval = flush_interval
+        self.decay_interval = decay_interval
+        self.k = k
+        self.width = width
+        self.depth = depth
+        self.pending = HeavyHitters(k, width, depth)  # counts since the last flush
+        self.last_flush = time.time()
+
+    def record(self, key, location):
+        """Count one request for a location (key is its canonical cache key)"""
+        self.pending.record(key, location)
+
+    def due(self):
+        """Whether there are counts to merge and the flush interval has passed"""
+        return self.pending.sketch.total > 0 and time.time() - self.last_flush >= self.flush_interval
+
+    def take(self):
+        """Hand over the pending counts for flush() and start a new interval"""
+        pending, self.pending = self.pending, HeavyHitters(self.k, self.width, self.depth)
+        self.last_flush = time.time()
+        return pending
+
+    async def flush(self, env, pending):
+        """Merge counts from take() into the KV record, halving it first if a decay is due"""
+        kv = cache_namespace(env)
+        if kv is None or not pending.sketch.total:
+            return
+        try:
+            record = await self._read(kv)
+            now = time.time()
+            if record is None:
+                merged, decayed = HeavyHitters(self.k, self.width, self.depth), now
+            else:
+                merged, decayed = self._decode(record["hitters"]), record["decayed"]
+            if now - decayed >= self.decay_interval:
+                merged.decay()
+                decayed = now
+            merged.merge(pending)
+            record = {"updated": now, "decayed": decayed, "hitters": merged.to_dict()}
+            with log.stage("kv"):
+                await kv.put(self.kv_key, json.dumps(record))
+            log.debug("Popularity", "Merged %d requests into KV", pending.sketch.total)
+        except Exception as e:
+            log.warning("Popularity", "Error merging counts into KV: %s", e)
+
+    async def load(self, env):
+        """The merged HeavyHitters from KV and when they were last updated, or (None, None)"""
+        kv = cache_namespace(env)
+        if kv is None:
+            return None, None
+        try:
+            record = await self._read(kv)
+        except Exception as e:
+            log.warning("Popularity", "Error reading counts from KV: %s", e)
+            return None, None
+        if record is None:
+            return None, None
+        return self._decode(record["hitters"]), record["updated"]
+
+    async def top(self, env, n):
+        """The n most-requested locations as (key, location, estimated count), most requested first"""
+        merged, _ = await self.load(env)
+        return merged.ranked(n) if merged is not None else []
+
+    async def _read(self, kv):
+        """The KV record, or None if it is missing or from an older format"""
+        with log.stage("kv"):
+            stored = await kv.get(self.kv_key)
+        record = json.loads(stored) if stored else None
+        if record is None or "hitters" not in record:
+            return None
+        return record
+
+    def _decode(self, data):
+        hitters = HeavyHitters.from_dict(data)
+        sketch = hitters.sketch
+        if (sketch.width, sketch.depth, hitters.k) != (self.width, self.depth, self.k):
+            # Dimensions changed since it was written; merging would mix up cells
+            hitters = HeavyHitters(self.k, self.width, self.depth)
+        return hitters
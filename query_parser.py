@@ -0,0 +1,280 @@
+"""
+Deterministic fast-path parser for common weather query phrasings.
+
+Most traffic looks like "weather in Paris", "London forecast tomorrow" or
+"7 day forecast for Tokyo in fahrenheit". Those are parsed locally into the
+same {"intent", "q", "units", "timeframe"} dict that Workers AI produces, so
+the LLM is only called when the rules below are not confident. Comparisons
+("compare weather in Paris, Rome and Berlin", "Paris vs Rome") add a
+"locations" list, with "q" set to the first location.
+"""
+import json
+import os
+import re
+
+import gazetteer
+
+# Counters for how each query was parsed: fast path, parse cache or Workers AI
+PARSE_STATS = {"fast_path": 0, "geolocation": 0, "cache": 0, "llm_fallback": 0}
+
+UNIT_PATTERNS = [
+    (re.compile(r"\b(?:in\s+)?(?:degrees\s+)?(?:fahrenheit|imperial(?:\s+units)?)\b|°\s*f\b", re.I), "imperial"),
+    (re.compile(r"\b(?:in\s+)?(?:degrees\s+)?(?:celsius|centigrade|metric(?:\s+units)?)\b|°\s*c\b", re.I), "metric"),
+]
+
+TIMEFRAME_PATTERNS = [
+    (re.compile(r"\b(?:for\s+)?(?:the\s+)?(?:next\s+)?(?:7|seven)[\s-]*days?\b|\b(?:for\s+)?(?:this|the|next)\s+week\b|\bweekly\b", re.I), "7d"),
+    (re.compile(r"\b(?:for\s+)?tomorrow\b", re.I), "tomorrow"),
+    (re.compile(r"\b(?:for\s+)?(?:today|tonight)(?:'s)?\b", re.I), "today"),
+    (re.compile(r"\b(?:right\s+now|now|currently)\b", re.I), "now"),
+]
+
+# "weather in X", "what's the forecast for X", "how's the temperature at X"
+LEADING_PATTERN = re.compile(
+    r"^(?:(?:what(?:'s|s|\s+is)|how(?:'s|s|\s+is)|show(?:\s+me)?|tell\s+me|give\s+me|get)\s+)?"
+    r"(?:me\s+)?(?:the\s+)?(?:current\s+)?"
+    r"(?:weather|forecast|temperature|temp)(?:\s+forecast)?(?:\s+(?:like|going\s+to\s+be))?"
+    r"\s+(?:in|for|at)\s+(?P<loc>.+)$",
+    re.I,
+)
+
+# "what's it like in X", "how is it in X"
+LIKE_PATTERN = re.compile(
+    r"^(?:what(?:'s|s|\s+is)|how(?:'s|s|\s+is))\s+it(?:\s+like)?\s+(?:in|at)\s+(?P<loc>.+)$",
+    re.I,
+)
+
+# "X weather", "X forecast", "X weather forecast"
+TRAILING_PATTERN = re.compile(
+    r"^(?P<loc>.+?)\s+(?:weather|forecast|temperature)(?:\s+forecast)?$",
+    re.I,
+)
+
+# Queries that name no place: "what's the weather here", "local forecast",
+# "weather near me", "how is it outside", "is it raining"
+LOCAL_PATTERN = re.compile(
+    r"^(?:(?:(?:what(?:'s|s|\s+is)|how(?:'s|s|\s+is)|show(?:\s+me)?|tell\s+me|give\s+me|get)\s+)?"
+    r"(?:me\s+)?(?:the\s+)?(?:current\s+|local\s+)?"
+    r"(?:weather|forecast|temperature|temp)(?:\s+forecast)?(?:\s+(?:like|going\s+to\s+be|doing))?"
+    r"|(?:what(?:'s|s|\s+is)|how(?:'s|s|\s+is))\s+it(?:\s+like)?"
+    r"|is\s+it\s+(?:raining|snowing|sunny|cold|hot|warm|windy))"
+    r"(?:\s+(?:here|outside|out\s+there|near\s+me|nearby|around\s+(?:me|here)|where\s+i\s+am|in\s+my\s+area|locally))?$",
+    re.I,
+)
+
+# "compare weather in X, Y and Z", "compare the forecast between X and Y", "compare X and Y weather"
+COMPARE_PATTERN = re.compile(
+    r"^compare\s+(?:the\s+)?(?:(?:weather|forecasts?|temperatures?)(?:\s+(?:in|for|at|of|between))?\s+|between\s+)?"
+    r"(?P<loc>.+?)(?:\s+(?:weather|forecasts?|temperatures?))?$",
+    re.I,
+)
+
+# Separators between compared locations. Commas and "and" only count after
+# "compare", so "Trinidad and Tobago" stays one place; after "compare", a
+# comma followed by a known country or region ("Paris, France") qualifies the
+# place before it instead (see _split_locations).
+COMPARE_SEPARATOR = re.compile(r"\s*,\s*(?:and\s+)?|\s+(?:and|vs\.?|versus)\s+|\s*&\s*", re.I)
+VERSUS_SEPARATOR = re.compile(r"\s+(?:vs\.?|versus)\s+", re.I)
+
+MAX_COMPARE_LOCATIONS = 5
+
+# A plain place name: "Paris", "New York", "Portland, Oregon", "St. John's"
+LOCATION_PATTERN = re.compile(r"^[^\W\d_][\w .'\-]*(?:,\s*[^\W\d_][\w .'\-]*)?$")
+
+# Words that mean the location is described rather than named, e.g.
+# "the city that Scarlett Johansson was born in" - leave those to the LLM.
+# Gazetteer places ("Cape Town", "Mexico City") are accepted before this check.
+DESCRIPTIVE_WORDS = {
+    "city", "town", "hometown", "capital", "country", "where", "born",
+    "that", "which", "who", "whose", "near", "home", "birthplace",
+    "weather", "forecast", "temperature", "like", "it", "and", "or",
+    "is", "was", "my", "here", "there", "me", "local", "outside", "nearby",
+}
+
+# Prepositions and time words inside a candidate mean the phrase carries more
+# than a place ("Paris next weekend", "London in 3 days", "Tokyo in June").
+# Those go to the LLM rather than to WeatherAPI as a place name.
+NON_LOCATION_WORDS = {
+    "in", "on", "for", "at",
+    "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday",
+    "january", "february", "march", "april", "may", "june", "july", "august",
+    "september", "october", "november", "december",
+    "weekend", "weekday", "weekdays", "morning", "afternoon", "evening", "night",
+    "yesterday", "day", "days", "week", "weeks", "month", "months", "hour", "hours",
+    "next", "last", "this",
+}
+
+MAX_LOCATION_WORDS = 5
+
+
+def _extract(text, patterns, default):
+    """Return (value, text without the matched phrase) for the first matching pattern"""
+    for pattern, value in patterns:
+        if pattern.search(text):
+            return value, pattern.sub(" ", text)
+    return default, text
+
+
+def _clean_location(location):
+    """Trim filler around a candidate location and reject anything that isn't a plain name"""
+    location = re.sub(r"\s+", " ", location).strip(" ,.-")
+    location = re.sub(r"^(?:the\s+city\s+of|city\s+of)\s+", "", location, flags=re.I)
+    if not location or not LOCATION_PATTERN.match(location) or re.search(r"\d", location):
+        return None
+
+    words = re.findall(r"[^\W\d_]+", location.lower())
+    if not words or len(words) > MAX_LOCATION_WORDS:
+        return None
+    if gazetteer.lookup(location) is not None:
+        # A known place, even if its name has a descriptive word ("Cape Town", "Mexico City")
+        return location
+    if any(word in DESCRIPTIVE_WORDS or word in NON_LOCATION_WORDS for word in words):
+        return None
+    return location
+
+
+def _join_qualifiers(text, separator):
+    """
+    Split text into location names, keeping "Name, Qualifier" together when
+    the qualifier is a country or region the gazetteer knows. None when a
+    comma could be read either way ("Portland, Oregon", "London, Singapore").
+    """
+    parts = separator.split(text)
+    names = [parts[0]]
+    for between, part in zip(separator.findall(text), parts[1:]):
+        if between.strip() != ",":
+            names.append(part)
+            continue
+        is_place = gazetteer.lookup(part) is not None
+        if gazetteer.is_qualifier(part):
+            # "Washington, DC": DC is also a place, but it qualifies Washington
+            if is_place and gazetteer.lookup(f"{names[-1]}, {part}") is None:
+                return None
+            names[-1] = f"{names[-1]}, {part}"
+        elif is_place:
+            names.append(part)
+        else:
+            return None
+    return names
+
+
+def _split_locations(text, separator):
+    """Clean each separated location; None if any of them isn't a plain name"""
+    names = _join_qualifiers(text, separator)
+    if names is None:
+        return None
+    locations = []
+    for part in names:
+        location = _clean_location(part)
+        if not location:
+            return None
+        if location.lower() not in [existing.lower() for existing in locations]:
+            locations.append(location)
+    return locations[:MAX_COMPARE_LOCATIONS]
+
+
+def fast_parse(query):
+    """
+    Parse a weather query without calling Workers AI.
+
+    Returns the parsed query dict, or None when the phrasing isn't recognised
+    confidently enough and the caller should fall back to the LLM.
+    """
+    text = re.sub(r"\s+", " ", query or "").strip()
+    text = text.rstrip("?!. ")
+    if not text:
+        return None
+
+    units, text = _extract(text, UNIT_PATTERNS, "metric")
+    timeframe, text = _extract(text, TIMEFRAME_PATTERNS, "now")
+    text = re.sub(r"\s+", " ", text).strip(" ,")
+
+    match = COMPARE_PATTERN.match(text)
+    separator = COMPARE_SEPARATOR
+    if not match:
+        separator = VERSUS_SEPARATOR
+        for pattern in (LEADING_PATTERN, LIKE_PATTERN, TRAILING_PATTERN):
+            match = pattern.match(text)
+            if match:
+                break
+    if not match:
+        return None
+
+    locations = _split_locations(match.group("loc"), separator)
+    if not locations:
+        return None
+
+    query_params = {"intent": "get_weather", "q": locations[0]}
+    if len(locations) > 1:
+        query_params["locations"] = locations
+    query_params["units"] = units
+    query_params["timeframe"] = timeframe
+    return query_params
+
+
+def parse_local_query(query):
+    """
+    Parse a query that asks about the weather where the user is, without
+    naming a place. Returns the parsed query dict without "q" (the caller
+    supplies the location), or None if the query names or describes a place.
+    """
+    text = re.sub(r"\s+", " ", query or "").strip()
+    text = text.rstrip("?!. ")
+    if not text:
+        return None
+
+    units, text = _extract(text, UNIT_PATTERNS, "metric")
+    timeframe, text = _extract(text, TIMEFRAME_PATTERNS, "now")
+    text = re.sub(r"\s+", " ", text).strip(" ,")
+    if not LOCAL_PATTERN.match(text):
+        return None
+    return {"intent": "get_weather", "units": units, "timeframe": timeframe}
+
+
+def normalize_query(query):
+    """
+    Normalise a query for cache lookups so trivially different phrasings
+    ("Weather in Paris?", "weather in  paris") share one entry.
+    """
+    text = (query or "").lower().replace("\u2019", "'")
+    text = re.sub(r"[?!.\"]+", " ", text)
+    return re.sub(r"\s+", " ", text).strip(" ,")
+
+
+def record_parse(source):
+    """Count a parsed query by source: fast_path, geolocation, cache or llm_fallback"""
+    PARSE_STATS[source] += 1
+
+
+def fast_path_hit_rate():
+    """Fraction of parsed queries that were answered by the fast path"""
+    total = sum(PARSE_STATS.values())
+    return PARSE_STATS["fast_path"] / total if total else 0.0
+
+
+def run_corpus(path=None):
+    """Check fast_parse against the phrasing corpus and report the hit rate"""
+    path = path or os.path.join(os.path.dirname(os.path.abspath(__file__)), "query_corpus.json")
+    with open(path, encoding="utf-8") as f:
+        corpus = json.load(f)
+
+    hits = 0
+    failures = []
+    for case in corpus:
+        result = fast_parse(case["query"])
+        if result is not None:
+            hits += 1
+        if result != case["expected"]:
+            failures.append((case["query"], case["expected"], result))
+
+    print(f"Fast-path hits: {hits}/{len(corpus)} ({hits / len(corpus):.0%})")
+    for query, expected, result in failures:
+        print(f"❌ {query!r}\n   expected: {expected}\n   got:      {result}")
+    if not failures:
+        print("✅ All corpus phrasings parsed as expected")
+    return not failures
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(0 if run_corpus() else 1)
@@ -0,0 +1,132 @@
+"""
+Lightweight request instrumentation for the Worker.
+
+on_fetch keeps a RequestTimer for each request in a context variable. Stages
+timed anywhere below it are attributed to that request without passing the
+timer through every call, including tasks started with asyncio.gather. The
+timings become a Server-Timing header and one structured JSON log line per
+request, sampled by LOG_SAMPLE_RATE.
+
+Other logging goes through debug/info/warning/error. These only format
+their message when LOG_LEVEL lets it through.
+
+Workers only advance the clock across I/O, so stage durations measure time
+spent waiting on upstreams and KV rather than CPU time.
+"""
+import contextvars
+import json
+import random
+import time
+from contextlib import contextmanager
+
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+LOG_CONFIG = {"level": LOG_LEVELS["info"], "sample_rate": 1.0}
+
+CURRENT_TIMER = contextvars.ContextVar("current_timer", default=None)
+
+
+def configure_logging(env):
+    """Apply the LOG_LEVEL (debug|info|warning|error) and LOG_SAMPLE_RATE (0-1) vars"""
+    level = getattr(env, "LOG_LEVEL", None)
+    LOG_CONFIG["level"] = LOG_LEVELS.get(str(level).lower(), LOG_LEVELS["info"])
+
+    sample_rate = getattr(env, "LOG_SAMPLE_RATE", None)
+    try:
+        LOG_CONFIG["sample_rate"] = 1.0 if sample_rate is None else min(max(float(sample_rate), 0.0), 1.0)
+    except (TypeError, ValueError):
+        LOG_CONFIG["sample_rate"] = 1.0
+
+
+def _log(level, tag, message, args):
+    if LOG_LEVELS[level] >= LOG_CONFIG["level"]:
+        print(f"[{tag}] {message % args if args else message}")
+
+
+def debug(tag, message, *args):
+    _log("debug", tag, message, args)
+
+
+def info(tag, message, *args):
+    _log("info", tag, message, args)
+
+
+def warning(tag, message, *args):
+    _log("warning", tag, message, args)
+
+
+def error(tag, message, *args):
+    _log("error", tag, message, args)
+
+
+class RequestTimer:
+    """Stage durations in milliseconds and extra log fields for one request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.fields = {}
+
+    def add(self, name, duration_ms):
+        # Concurrent calls to the same stage (e.g. a comparison) are summed
+        self.stages[name] = self.stages.get(name, 0.0) + duration_ms
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self):
+        """Server-Timing header value: one metric per stage plus the total"""
+        metrics = [f"{name};dur={duration:.1f}" for name, duration in self.stages.items()]
+        metrics.append(f"total;dur={self.elapsed_ms():.1f}")
+        return ", ".join(metrics)
+
+
+def start_request():
+    """Start timing a request; returns the timer and a token for finish_request"""
+    timer = RequestTimer()
+    return timer, CURRENT_TIMER.set(timer)
+
+
+def finish_request(token):
+    CURRENT_TIMER.reset(token)
+
+
+@contextmanager
+def stage(name):
+    """Time the enclosed block as a stage of the current request, if any"""
+    timer = CURRENT_TIMER.get()
+    if timer is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, (time.perf_counter() - started) * 1000)
+
+
+def annotate(**fields):
+    """Add fields to the current request's log line"""
+    timer = CURRENT_TIMER.get()
+    if timer is not None:
+        timer.fields.update(fields)
+
+
+def log_request(timer, method, path, status):
+    """
+    Write the request's structured log line. Server errors are always logged;
+    other requests are sampled at LOG_SAMPLE_RATE, and only at info level or below.
+    """
+    if status < 500:
+        if LOG_CONFIG["level"] > LOG_LEVELS["info"] or random.random() >= LOG_CONFIG["sample_rate"]:
+            return
+
+    entry = {
+        "event": "request",
+        "method": method,
+        "path": path,
+        "status": status,
+        "duration_ms": round(timer.elapsed_ms(), 1),
+        "stages": {name: round(duration, 1) for name, duration in timer.stages.items()},
+    }
+    entry.update(timer.fields)
+    print(json.dumps(entry))
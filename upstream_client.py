@@ -0,0 +1,130 @@
+"""
+Pluggable client for upstream HTTP calls to WeatherAPI.com and Workers AI.
+
+app.fetch_upstream() sends every upstream request through UPSTREAM_CLIENT.
+In the Worker that is a FetchClient, which calls the runtime's fetch().
+RecordingClient wraps another client and captures each request/response pair
+in a cassette file. ReplayClient serves responses from a cassette without
+network access, after the recorded or an injected latency, so performance
+runs are repeatable offline.
+
+Cassettes never contain credentials: the WeatherAPI key and the Cloudflare
+account ID are redacted from URLs, and request headers are not stored.
+"""
+import asyncio
+import json
+import re
+import time
+
+from js import Headers, Response, fetch
+
+CASSETTE_VERSION = 1
+
+REDACTIONS = [
+    (re.compile(r"([?&]key=)[^&]*"), r"\1REDACTED"),
+    (re.compile(r"(/accounts/)[^/]+(/)"), r"\1ACCOUNT\2"),
+]
+
+
+def redact_url(url):
+    for pattern, replacement in REDACTIONS:
+        url = pattern.sub(replacement, url)
+    return url
+
+
+def interaction_key(method, url, body):
+    """What a replayed request is matched on: method, redacted URL and body"""
+    return (method.upper(), redact_url(url), body or "")
+
+
+class FetchClient:
+    """Sends requests with the runtime's fetch()"""
+
+    async def send(self, upstream, url, **options):
+        return await fetch(url, **options)
+
+
+class RecordingClient:
+    """Forwards requests to another client and records each exchange for save()"""
+
+    def __init__(self, inner, path):
+        self.inner = inner
+        self.path = path
+        self.interactions = []
+
+    async def send(self, upstream, url, **options):
+        started = time.perf_counter()
+        response = await self.inner.send(upstream, url, **options)
+        body = await response.text()
+        latency_ms = (time.perf_counter() - started) * 1000
+
+        method, _, request_body = interaction_key(options.get("method", "GET"), url, options.get("body"))
+        content_type = response.headers.get("Content-Type") or "application/json"
+        self.interactions.append({
+            "upstream": upstream,
+            "method": method,
+            "url": redact_url(url),
+            "request_body": request_body,
+            "status": response.status,
+            "content_type": content_type,
+            "body": body,
+            "latency_ms": round(latency_ms, 1),
+        })
+        return build_response(response.status, content_type, body)
+
+    def save(self, **metadata):
+        """Write the cassette; metadata (e.g. the queries that were run) is stored alongside"""
+        cassette = {"version": CASSETTE_VERSION}
+        cassette.update(metadata)
+        cassette["interactions"] = self.interactions
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(cassette, f, indent=1, ensure_ascii=False)
+            f.write("\n")
+
+
+class ReplayClient:
+    """
+    Serves recorded responses. Requests recorded more than once (e.g. the
+    limericks filling a pool) are answered in recorded order, cycling when
+    exhausted. latency (seconds) overrides the recorded per-call latency;
+    latency_scale multiplies whichever is used.
+    """
+
+    def __init__(self, path, latency=None, latency_scale=1.0):
+        with open(path, encoding="utf-8") as f:
+            self.cassette = json.load(f)
+        if self.cassette.get("version") != CASSETTE_VERSION:
+            raise Exception(f"Unsupported cassette version in {path}: {self.cassette.get('version')}")
+
+        self.latency = latency
+        self.latency_scale = latency_scale
+        self.recorded = {}
+        for interaction in self.cassette["interactions"]:
+            key = (interaction["method"], interaction["url"], interaction["request_body"])
+            self.recorded.setdefault(key, []).append(interaction)
+        self.replays = {}
+        self.stats = {"replayed": 0, "missing": 0}
+
+    async def send(self, upstream, url, **options):
+        key = interaction_key(options.get("method", "GET"), url, options.get("body"))
+        interactions = self.recorded.get(key)
+        if not interactions:
+            self.stats["missing"] += 1
+            raise Exception(f"No recorded {upstream} response for {key[0]} {key[1]}")
+
+        count = self.replays.get(key, 0)
+        self.replays[key] = count + 1
+        interaction = interactions[count % len(interactions)]
+
+        latency = self.latency if self.latency is not None else interaction["latency_ms"] / 1000
+        if latency * self.latency_scale > 0:
+            await asyncio.sleep(latency * self.latency_scale)
+
+        self.stats["replayed"] += 1
+        return build_response(interaction["status"], interaction["content_type"], interaction["body"])
+
+
+def build_response(status, content_type, body):
+    headers = Headers.new()
+    headers.set("Content-Type", content_type)
+    return Response.new(body, status=status, headers=headers)
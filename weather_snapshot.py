@@ -0,0 +1,125 @@
+"""
+Compact projection of WeatherAPI.com forecast payloads.
+
+A 7-day forecast.json response carries 24 hourly entries per day plus astro
+and air-quality data, none of which the Worker uses. Converting it with
+to_py() copies hundreds of objects across the JS/Python boundary on every
+request. WeatherSnapshot.from_js() instead reads just the fields the response
+builder needs straight off the JsProxy into small __slots__ records.
+"""
+import telemetry as log
+
+
+def _field(obj, name, default=None):
+    """Read an attribute from a JsProxy or a key from a dict"""
+    if isinstance(obj, dict):
+        return obj.get(name, default)
+    return getattr(obj, name, default)
+
+
+class DaySummary:
+    """One forecast day: date, high/low in both unit systems and condition"""
+
+    __slots__ = ("date", "maxtemp_c", "maxtemp_f", "mintemp_c", "mintemp_f", "condition")
+
+    def __init__(self, date, maxtemp_c, maxtemp_f, mintemp_c, mintemp_f, condition):
+        self.date = date
+        self.maxtemp_c = maxtemp_c
+        self.maxtemp_f = maxtemp_f
+        self.mintemp_c = mintemp_c
+        self.mintemp_f = mintemp_f
+        self.condition = condition
+
+    @classmethod
+    def from_forecastday(cls, forecastday):
+        day = _field(forecastday, "day")
+        return cls(
+            _field(forecastday, "date"),
+            _field(day, "maxtemp_c"),
+            _field(day, "maxtemp_f"),
+            _field(day, "mintemp_c"),
+            _field(day, "mintemp_f"),
+            _field(_field(day, "condition"), "text"),
+        )
+
+    def to_list(self):
+        return [self.date, self.maxtemp_c, self.maxtemp_f, self.mintemp_c, self.mintemp_f, self.condition]
+
+
+class WeatherSnapshot:
+    """Location, current conditions and daily summaries for one location"""
+
+    __slots__ = (
+        "name", "country", "last_updated_epoch", "temp_c", "temp_f",
+        "wind_kph", "wind_mph", "humidity", "condition", "days",
+    )
+
+    def __init__(self, name, country, last_updated_epoch=None, temp_c=None, temp_f=None,
+                 wind_kph=None, wind_mph=None, humidity=None, condition=None, days=()):
+        self.name = name
+        self.country = country
+        self.last_updated_epoch = last_updated_epoch
+        self.temp_c = temp_c
+        self.temp_f = temp_f
+        self.wind_kph = wind_kph
+        self.wind_mph = wind_mph
+        self.humidity = humidity
+        self.condition = condition
+        self.days = tuple(days)
+
+    @property
+    def has_current(self):
+        return self.condition is not None
+
+    @classmethod
+    def from_js(cls, data):
+        """
+        Project a WeatherAPI payload (JsProxy or dict) onto a snapshot,
+        touching only the fields we use. Raises on malformed payloads.
+        """
+        location = _field(data, "location")
+        if location is None:
+            raise Exception("Invalid weather data received: missing location information")
+
+        current = _field(data, "current")
+        forecast = _field(data, "forecast")
+        if current is None and forecast is None:
+            raise Exception("Invalid weather data received: missing weather information")
+
+        days = []
+        forecastdays = _field(forecast, "forecastday") if forecast is not None else None
+        for forecastday in forecastdays if forecastdays is not None else ():
+            day = DaySummary.from_forecastday(forecastday)
+            if day.date is None or day.maxtemp_c is None or day.condition is None:
+                log.warning("Weather", "Missing data in forecast day: %s", day.date)
+                continue
+            days.append(day)
+
+        if current is None:
+            return cls(_field(location, "name"), _field(location, "country"), days=days)
+
+        return cls(
+            _field(location, "name"),
+            _field(location, "country"),
+            _field(current, "last_updated_epoch"),
+            _field(current, "temp_c"),
+            _field(current, "temp_f"),
+            _field(current, "wind_kph"),
+            _field(current, "wind_mph"),
+            _field(current, "humidity"),
+            _field(_field(current, "condition"), "text"),
+            days,
+        )
+
+    def to_dict(self):
+        """Compact JSON-serialisable form for KV storage"""
+        return {
+            "location": [self.name, self.country],
+            "current": [self.last_updated_epoch, self.temp_c, self.temp_f, self.wind_kph,
+                        self.wind_mph, self.humidity, self.condition],
+            "days": [day.to_list() for day in self.days],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(*data["location"], *data["current"], days=[DaySummary(*day) for day in data["days"]])